@@ -0,0 +1,167 @@
+""" Times each stage of the twittp model pipeline on synthetic data.
+
+Run from the root of the repository, e.g.:
+
+    python -m benchmarks --tweets-per-second 2 --trends 20 -o results.json
+
+Results are written as JSON. Pass --compare with an earlier results file to
+fail (exit status 1) when any stage got slower by more than --tolerance.
+See benchmarks.crossover for the trend length from which the L2 norm is
+faster than the L1 one.
+"""
+import argparse
+import os
+import platform
+import random
+import sys
+import tempfile
+import numpy as np
+import scipy
+import simplejson as json
+from twittp import model as twittp_model
+from twittp.model import TrendCell, TrendLine, TrendModel, dtw_distance
+from twittp.twitter import BagOfWords, TwitterTrend
+from .common import best_time, git_revision
+from .synthetic import SyntheticData
+
+
+class Benchmark:
+    """ Generates a data set and times the pipeline stages over it. """
+
+    def __init__(self, data, repeats=3, pairs=200):
+        self.data = data
+        self.repeats = repeats
+        self.pairs = pairs
+        self.stages = {}
+
+    def time(self, name, function, repeats=None, **extra):
+        seconds, result = best_time(function, repeats or self.repeats)
+        self.stages[name] = dict(seconds=seconds, **extra)
+        print('%-24s %10.4f s' % (name, seconds), file=sys.stderr)
+        return result
+
+    def run(self, directory):
+        tweet_file = os.path.join(directory, 'tweets.json')
+        trend_file = os.path.join(directory, 'trends.json')
+        tweets = self.data.write_tweets(tweet_file)
+        snapshots = self.data.write_trends(trend_file)
+        self.counts = {'tweets': tweets, 'snapshots': snapshots}
+
+        twitter_trends = self.time('TwitterTrend.from_file',
+                                   lambda: TwitterTrend.from_file(trend_file))
+        bag_of_words = self.time('BagOfWords.from_file',
+                                 lambda: BagOfWords.from_file(tweet_file))
+
+        positive = [TrendLine.from_twitter_trend(trend)
+                    for trend in twitter_trends]
+        positive = [trend for trend in positive
+                    if len(trend) >= twittp_model.MINIMUM_TREND_SIZE]
+        random.seed(self.data.seed)
+        negative = TrendLine.construct_negative_trends(positive, bag_of_words)
+        trends = positive + negative
+
+        def populate():
+            for trend in trends:
+                trend.counts[:] = 0
+            TrendLine.populate_from_file(trends, tweet_file)
+        self.time('populate_from_file', populate, trends=len(trends))
+
+        rng = np.random.default_rng(self.data.seed)
+        pairs = rng.integers(0, len(trends), size=(self.pairs, 2))
+
+        def distances():
+            return [trends[i].distance(trends[j]) for i, j in pairs]
+        self.time('TrendLine.distance', distances, pairs=self.pairs)
+
+        def squared_distances():
+            return [trends[i].distance(trends[j], norm='l2')
+                    for i, j in pairs]
+        self.time('TrendLine.distance_l2', squared_distances,
+                  pairs=self.pairs)
+
+        def dtws():
+            return [dtw_distance(trends[i].features, trends[j].features)
+                    for i, j in pairs]
+        self.time('dtw_distance', dtws, pairs=self.pairs)
+
+        model = TrendModel(trends=trends)
+        self.time('leave_one_out',
+                  lambda: model.leave_one_out(workers=1), repeats=1)
+        self.time('sparse_matrix', model.sparse_matrix)
+        self.time('serialize', model.serialize)
+
+    def results(self):
+        return {'revision': git_revision(),
+                'python': platform.python_version(),
+                'numpy': np.__version__, 'scipy': scipy.__version__,
+                'weights': TrendCell.weights().tolist(),
+                'params': self.data.params(), 'counts': self.counts,
+                'stages': self.stages}
+
+
+def compare(results, baseline, tolerance):
+    """ Lists the stages that are more than tolerance slower than baseline.
+    """
+    regressions = []
+    for name, stage in results['stages'].items():
+        before = baseline['stages'].get(name)
+        if before is None or before['seconds'] <= 0:
+            continue
+        ratio = stage['seconds'] / before['seconds']
+        if ratio > 1 + tolerance:
+            regressions.append((name, before['seconds'], stage['seconds'],
+                                ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the twittp '
+                                     'model pipeline on synthetic data')
+    parser.add_argument('--tweets-per-second', type=float, default=2.0)
+    parser.add_argument('--trends', type=int, default=20)
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help='Skew of the word frequencies')
+    parser.add_argument('--span', type=int, default=6 * 3600,
+                        help='Seconds of tweets to generate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--pairs', type=int, default=200,
+                        help='Number of TrendLine pairs to time distances on')
+    parser.add_argument('-o', '--output', help='Write the results here '
+                        'instead of stdout')
+    parser.add_argument('--compare', help='An earlier results file to check '
+                        'for regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown before a stage counts as a '
+                        'regression')
+    args = parser.parse_args()
+
+    data = SyntheticData(tweets_per_second=args.tweets_per_second,
+                         trends=args.trends, vocabulary=args.vocabulary,
+                         zipf=args.zipf, span=args.span, seed=args.seed)
+    benchmark = Benchmark(data, repeats=args.repeats, pairs=args.pairs)
+    with tempfile.TemporaryDirectory(prefix='twittp-bench-') as directory:
+        benchmark.run(directory)
+    results = benchmark.results()
+
+    encoded = json.dumps(results, indent=2)
+    if args.output is None:
+        print(encoded)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(encoded + '\n')
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, before, after, ratio in regressions:
+            print('REGRESSION %s: %.4f s -> %.4f s (x%.2f)' %
+                  (name, before, after, ratio), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
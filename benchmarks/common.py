@@ -0,0 +1,27 @@
+""" Helpers shared by the benchmark scripts. """
+import os
+import subprocess
+import time
+
+
+def best_time(function, repeats):
+    """ Runs function repeats times, returning (best seconds, last result).
+    """
+    best = None
+    result = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def git_revision():
+    """ The commit of the working tree being benchmarked, if known. """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
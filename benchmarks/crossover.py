@@ -0,0 +1,100 @@
+""" Finds the trend length at which the FFT L2 alignment beats the L1 one.
+
+Run from the root of the repository, e.g.:
+
+    python -m benchmarks.crossover --max-length 8192 -o crossover.json
+
+For each length, random lines with the count, delta and delta_delta
+features of TrendLines are aligned against lines ratio times as long, one
+pair at a time and as a batch against a padded block, under both norms.
+Results are written as JSON, with the shortest length from which the L2
+norm was faster at every longer length.
+"""
+import argparse
+import sys
+import numpy as np
+import simplejson as json
+from twittp.distance import (alignment_distance, batch_alignment_distance,
+                             batch_squared_alignment_distance, pad_features,
+                             squared_alignment_distance)
+from twittp.model import TrendCell, TrendLine
+from .common import best_time, git_revision
+
+
+def random_line(rng, length, rate):
+    """ A TrendLine of Poisson counts with its deltas filled in. """
+    counts = rng.poisson(rate, size=length)
+    trend = TrendLine.empty('line', 0, length)
+    trend.counts[:] = counts
+    trend.compute_deltas()
+    return trend
+
+
+def crossover(timings, kind):
+    """ The shortest length from which L2 was faster at every longer one. """
+    found = None
+    for timing in reversed(timings):
+        if timing[kind + '_l2'] >= timing[kind + '_l1']:
+            break
+        found = timing['length']
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the L1 and FFT L2 '
+                                     'alignment distances by trend length')
+    parser.add_argument('--min-length', type=int, default=16)
+    parser.add_argument('--max-length', type=int, default=4096)
+    parser.add_argument('--ratio', type=float, default=2.0,
+                        help='How many times longer the other line is')
+    parser.add_argument('--lines', type=int, default=32,
+                        help='Number of lines in the batch')
+    parser.add_argument('--rate', type=float, default=3.0,
+                        help='Mean tweets per window')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('-o', '--output', help='Write the results here '
+                        'instead of stdout')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    weights = TrendCell.weights()
+    timings = []
+    length = args.min_length
+    while length <= args.max_length:
+        long_length = int(length * args.ratio)
+        query = random_line(rng, length, args.rate).features
+        lines = [random_line(rng, long_length, args.rate)
+                 for _ in range(args.lines)]
+        block, lengths = pad_features(lines)
+        other = lines[0].features
+
+        timing = {'length': length, 'other_length': long_length}
+        for norm, pair, batch in (
+                ('l1', alignment_distance, batch_alignment_distance),
+                ('l2', squared_alignment_distance,
+                 batch_squared_alignment_distance)):
+            timing['pair_' + norm], _ = best_time(
+                lambda: pair(query, other, weights), args.repeats)
+            timing['batch_' + norm], _ = best_time(
+                lambda: batch(query, block, lengths, weights), args.repeats)
+        print('%8d  pair %10.6f / %10.6f s  batch %10.6f / %10.6f s' %
+              (length, timing['pair_l1'], timing['pair_l2'],
+               timing['batch_l1'], timing['batch_l2']), file=sys.stderr)
+        timings.append(timing)
+        length *= 2
+
+    results = {'revision': git_revision(), 'params': vars(args),
+               'weights': weights.tolist(), 'timings': timings,
+               'crossover': {'pair': crossover(timings, 'pair'),
+                             'batch': crossover(timings, 'batch')}}
+    encoded = json.dumps(results, indent=2)
+    if args.output is None:
+        print(encoded)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(encoded + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import time
+import numpy as np
+import simplejson as json
+
+
+TWEET_TIME_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+TRENDS_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class SyntheticData:
+    """ Reproducible synthetic tweets and trends-endpoint snapshots.
+
+    Words of ordinary tweets are drawn from a vocabulary with Zipf-skewed
+    frequencies. Each of the trends is a hashtag with an active interval
+    (in whole 120 s windows); while it is active it is reported by every
+    trends-endpoint snapshot and is added to each tweet with probability
+    trend_rate. Like real trends, each one briefly drops out of the
+    trending list and comes back for a few windows at the end. Everything
+    is driven from one seed, so the same parameters always produce the
+    same files.
+    """
+
+    def __init__(self, tweets_per_second=2.0, trends=20, vocabulary=5000,
+                 zipf=1.1, span=6 * 3600, start_ts=1396310400,
+                 trend_windows=(15, 90), trend_rate=0.05, seed=0):
+        self.tweets_per_second = tweets_per_second
+        self.trends = trends
+        self.vocabulary = vocabulary
+        self.zipf = zipf
+        self.span = span
+        self.start_ts = start_ts - start_ts % 120
+        self.trend_windows = trend_windows
+        self.trend_rate = trend_rate
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        self.words = ['w%d' % i for i in range(vocabulary)]
+        ranks = np.arange(1, vocabulary + 1, dtype=np.float64)
+        self.word_weights = ranks ** -zipf
+        self.word_weights /= self.word_weights.sum()
+
+        windows = span // 120
+        self.trend_names = ['#trend%d' % i for i in range(trends)]
+        lengths = rng.integers(trend_windows[0], trend_windows[1] + 1,
+                               size=trends)
+        lengths = np.minimum(lengths, windows)
+        starts = rng.integers(0, windows - lengths + 1)
+        self.trend_starts = self.start_ts + starts * 120
+        self.trend_ends = self.trend_starts + lengths * 120
+        # The windows of each trend's short comeback, after a one-window gap
+        returns = np.minimum(rng.integers(1, 4, size=trends), lengths // 4)
+        self.gap_starts = self.trend_ends - (returns + 1) * 120
+        self.gap_ends = self.gap_starts + np.where(returns > 0, 120, 0)
+
+    def params(self):
+        """ The parameters of the data set, for reporting. """
+        return {'tweets_per_second': self.tweets_per_second,
+                'trends': self.trends, 'vocabulary': self.vocabulary,
+                'zipf': self.zipf, 'span': self.span,
+                'trend_windows': list(self.trend_windows),
+                'trend_rate': self.trend_rate, 'seed': self.seed}
+
+    def active(self, ts):
+        """ The indices of the trends active at a timestamp. """
+        in_gap = (self.gap_starts <= ts) & (ts < self.gap_ends)
+        return np.flatnonzero((self.trend_starts <= ts) &
+                              (ts < self.trend_ends) & ~in_gap)
+
+    def write_tweets(self, path):
+        """ Writes one tweet per line as the Twitter API encodes them.
+
+        Returns the number of tweets written.
+        """
+        rng = np.random.default_rng(self.seed + 1)
+        count = int(self.tweets_per_second * self.span)
+        timestamps = np.sort(rng.integers(self.start_ts,
+                                          self.start_ts + self.span,
+                                          size=count))
+        lengths = rng.integers(3, 15, size=count)
+        words = rng.choice(len(self.words), size=int(lengths.sum()),
+                           p=self.word_weights)
+        ends = np.cumsum(lengths)
+        with open(path, 'w') as f:
+            for i in range(count):
+                ts = int(timestamps[i])
+                text = [self.words[w] for w in words[ends[i] - lengths[i]:
+                                                     ends[i]]]
+                active = self.active(ts)
+                for k in active:
+                    if rng.random() < self.trend_rate:
+                        text.insert(int(rng.integers(0, len(text) + 1)),
+                                    self.trend_names[k])
+                tweet = {'id': i,
+                         'created_at': time.strftime(TWEET_TIME_FORMAT,
+                                                     time.gmtime(ts)),
+                         'text': ' '.join(text)}
+                f.write(json.dumps(tweet) + '\n')
+        return count
+
+    def write_trends(self, path, interval=120):
+        """ Writes a trends-endpoint snapshot every interval seconds.
+
+        Returns the number of snapshots written.
+        """
+        count = 0
+        with open(path, 'w') as f:
+            for ts in range(self.start_ts, self.start_ts + self.span,
+                            interval):
+                active = self.active(ts)
+                snapshot = {'as_of': time.strftime(TRENDS_TIME_FORMAT,
+                                                   time.gmtime(ts)),
+                            'trends': [{'name': self.trend_names[k]}
+                                       for k in active]}
+                f.write(json.dumps(snapshot) + '\n')
+                count += 1
+        return count
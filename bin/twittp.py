@@ -1,5 +1,146 @@
 import argparse
-from twittp.model import TrendModel
+import asyncio
+import sys
+import simplejson as json
+from twittp.inputs import read_lines
+from twittp.instrument import Instrument, print_progress
+from twittp.model import TrendCell, TrendModel
+from twittp.pyramid import CANDIDATES, COARSE_FACTOR
+from twittp.server import MAX_BATCH, MAX_DELAY, PredictionServer, replay
+from twittp.store import TweetStore
+from twittp.stream import (TICK_SECONDS, TrendWatcher, follow_lines,
+                           poll_lines)
+
+
+def profiled(args, run):
+    """ Calls run(instrument), profiling it as asked for on the command line.
+
+    With --profile, an Instrument is passed and its report written as JSON
+    to the given file; with --cprofile, the call is also run under cProfile
+    and the stats dumped. Otherwise run gets None and nothing is recorded.
+    """
+    instrument = None
+    if args.profile is not None or args.progress:
+        instrument = Instrument(
+            progress=print_progress if args.progress else None)
+    if args.cprofile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        result = profiler.runcall(run, instrument)
+        profiler.dump_stats(args.cprofile)
+    else:
+        result = run(instrument)
+    if args.profile is not None:
+        with open(args.profile, 'w') as f:
+            json.dump(instrument.report(), f, indent=2)
+    return result
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--profile', help='Write a JSON report of the time '
+                        'and memory each stage took to this file')
+    parser.add_argument('--cprofile', help='Also write cProfile stats of '
+                        'the run to this file')
+    parser.add_argument('--progress', action='store_true', help='Print '
+                        'progress and throughput while running')
+
+
+def build_model(args):
+    """ Builds a model from tweets and trends and saves it.
+
+    Without --output, a JSON model is printed instead.
+    """
+    model = profiled(args, lambda instrument: TrendModel.model_from_files(
+        args.trends, args.tweets, args.stopword,
+        trend_preempt=args.trend_preempt, workers=args.workers,
+        instrument=instrument, cache_dir=args.cache_dir))
+    model.norm = args.norm
+    if args.output is None:
+        print(model.serialize())
+    else:
+        model.save(args.output, format=args.format)
+
+
+def leave_one_out(args):
+    """ Prints the leave-one-out accuracy of a saved model. """
+    model = TrendModel.load(args.model)
+    accuracy = profiled(args, lambda instrument: model.leave_one_out(
+        workers=args.workers, cache_dir=args.cache_dir, metric=args.metric,
+        window=args.window, instrument=instrument, factor=args.factor,
+        candidates=args.candidates))
+    print(accuracy)
+
+
+def tune(args):
+    """ Prints the TrendCell weights with the best leave-one-out accuracy. """
+    model = TrendModel.load(args.model)
+    accuracy, weights = profiled(args, lambda instrument: model.tune_weights(
+        search=args.search, grid=args.grid, instrument=instrument))
+    print(json.dumps({'accuracy': accuracy, 'count_weight': weights[0],
+                      'delta_weight': weights[1],
+                      'delta_delta_weight': weights[2]}))
+
+
+def ingest(args):
+    """ Converts a JSON file of tweets into a TweetStore. """
+    store = TweetStore.from_file(args.tweets, args.store)
+    print('Wrote %d tweets with %d distinct words to %s' %
+          (len(store), len(store.vocab), args.store))
+
+
+def watch(args):
+    """ Scores candidate topics as tweets stream in from stdin or a file. """
+    model = TrendModel.load(args.model)
+    topics = None
+    if args.topics is not None:
+        with open(args.topics) as f:
+            topics = [line.strip() for line in f if line.strip()]
+    watcher = TrendWatcher(model, TrendCell.weights(), topics=topics,
+                           window_size=args.window_size,
+                           history=args.history)
+    if args.tweets == '-':
+        lines = poll_lines(sys.stdin, TICK_SECONDS)
+    elif args.follow:
+        lines = follow_lines(args.tweets, timeout=TICK_SECONDS)
+    else:
+        lines = read_lines(args.tweets)
+    try:
+        watcher.watch(lines)
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(watcher.report()), file=sys.stderr)
+
+
+def serve(args):
+    """ Serves predictions of a model over HTTP, or load tests the server
+    with a replay of a file of requests.
+    """
+    model = TrendModel.load(args.model)
+    server = PredictionServer(model, k=args.k, max_batch=args.max_batch,
+                              max_delay=args.max_delay / 1000)
+
+    async def run():
+        listener = await server.start(args.host, args.port, args.unix)
+        if args.replay is None:
+            address = args.unix or '%s:%d' % \
+                listener.sockets[0].getsockname()[:2]
+            print('Serving %d trends on %s' % (len(model.trends), address),
+                  file=sys.stderr)
+            async with listener:
+                await listener.serve_forever()
+        bodies = [line for line in read_lines(args.replay) if line.strip()]
+        port = listener.sockets[0].getsockname()[1] if args.unix is None \
+            else None
+        client = await replay(bodies, args.host, port, args.unix,
+                              args.concurrency)
+        listener.close()
+        await listener.wait_closed()
+        print(json.dumps({'client': client, 'server': server.report()}))
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print(json.dumps(server.report()), file=sys.stderr)
 
 
 def main():
@@ -14,21 +155,155 @@ def main():
     build_model_parser.description = 'Build a model for other actions in twittp'
 
     build_model_parser.add_argument('tweets', help='The JSON file containing '
-                                    'tweets from the Twitter API')
+                                    'tweets from the Twitter API, or a tweet '
+                                    'store made by the ingest command')
     build_model_parser.add_argument('trends', help='The JSON file containing '
                                     'trends from the Twitter API')
     build_model_parser.add_argument('--stopword', help='An optional CSV file '
                                     'containing words to ignore when '
                                     'constructing the model')
-    build_model_parser.add_argument('--trend-preempt', help='The number of'
-                                    'windows to preempt a trend by', default=0)
-    build_model_parser.set_defaults(func=TrendModel.model_from_files)
+    build_model_parser.add_argument('--trend-preempt', help='The number of '
+                                    'windows to preempt a trend by', type=int,
+                                    default=0)
+    build_model_parser.add_argument('--workers', help='The number of '
+                                    'processes to parse and count tweets '
+                                    'with', type=int, default=1)
+    build_model_parser.add_argument('--cache-dir', help='A directory to keep '
+                                    'the build in, so that rebuilding from '
+                                    'the same JSON files after more is '
+                                    'appended to them only reads what is new')
+    build_model_parser.add_argument('--norm', help='How the distances of the '
+                                    'model compare aligned windows: l1 sums '
+                                    'absolute differences, l2 squared ones '
+                                    '(faster on long trends)',
+                                    choices=['l1', 'l2'], default='l1')
+    build_model_parser.add_argument('-o', '--output', help='The file to save '
+                                    'the model to; required for the binary '
+                                    'format')
+    build_model_parser.add_argument('--format', help='The format to save the '
+                                    'model in', choices=['binary', 'json'],
+                                    default='binary')
+    add_profile_arguments(build_model_parser)
+    build_model_parser.set_defaults(func=build_model)
+
+    loo_parser = subparsers.add_parser('leave-one-out', help='Compute the '
+                                       'leave-one-out accuracy of a model')
+
+    loo_parser.description = 'Compute the leave-one-out accuracy of a model'
+
+    loo_parser.add_argument('model', help='A model saved by build-model')
+    loo_parser.add_argument('--metric', choices=['alignment', 'dtw',
+                                                 'coarse'],
+                            default='alignment', help='The distance between '
+                            'trends to use')
+    loo_parser.add_argument('--window', type=int, help='The Sakoe-Chiba '
+                            'window for the dtw metric')
+    loo_parser.add_argument('--factor', type=int, default=COARSE_FACTOR,
+                            help='The number of windows merged into one for '
+                            'the coarse metric')
+    loo_parser.add_argument('--candidates', type=int, default=CANDIDATES,
+                            help='The number of nearest trends at the coarse '
+                            'resolution to compare at full resolution')
+    loo_parser.add_argument('--workers', type=int, help='The number of '
+                            'processes computing distances; all CPUs by '
+                            'default')
+    loo_parser.add_argument('--cache-dir', help='A directory to cache the '
+                            'distance matrix in between runs')
+    add_profile_arguments(loo_parser)
+    loo_parser.set_defaults(func=leave_one_out)
+
+    tune_parser = subparsers.add_parser('tune', help='Search for the '
+                                        'TrendCell weights with the best '
+                                        'leave-one-out accuracy')
+
+    tune_parser.description = 'Search for the TrendCell weights with the ' \
+                              'best leave-one-out accuracy of a model'
+
+    tune_parser.add_argument('model', help='A model saved by build-model')
+    tune_parser.add_argument('--search', choices=['coordinate', 'grid'],
+                             default='coordinate', help='Coordinate descent '
+                             'from the current weights, or a grid search')
+    tune_parser.add_argument('--grid', type=float, nargs='+', help='The '
+                             'values to try for each weight in a grid search')
+    add_profile_arguments(tune_parser)
+    tune_parser.set_defaults(func=tune)
+
+    ingest_parser = subparsers.add_parser('ingest', help='Preprocess a file '
+                                          'of tweets so models build '
+                                          'without parsing JSON')
+
+    ingest_parser.description = 'Convert a JSON file of tweets into a ' \
+                                'memory-mapped tweet store'
+
+    ingest_parser.add_argument('tweets', help='The JSON file containing '
+                               'tweets from the Twitter API')
+    ingest_parser.add_argument('store', help='The directory to write the '
+                               'tweet store to')
+    ingest_parser.set_defaults(func=ingest)
+
+    watch_parser = subparsers.add_parser('watch', help='Predict trends from '
+                                         'a live stream of tweets')
+
+    watch_parser.description = 'Score candidate topics against a model as ' \
+                               'tweets arrive, printing predictions as JSON'
+
+    watch_parser.add_argument('model', help='A model saved by build-model')
+    watch_parser.add_argument('tweets', nargs='?', default='-',
+                              help='The file of tweets to read, or - for '
+                              'stdin (the default)')
+    watch_parser.add_argument('-f', '--follow', action='store_true',
+                              help='Keep reading the tweets file as it grows')
+    watch_parser.add_argument('--topics', help='A file with one candidate '
+                              'topic per line; by default every hashtag seen '
+                              'is a candidate')
+    watch_parser.add_argument('--window-size', help='The number of seconds '
+                              'per window', type=int, default=120)
+    watch_parser.add_argument('--history', help='The number of windows of '
+                              'each topic to score; by default the length of '
+                              'the longest trend in the model', type=int)
+    watch_parser.set_defaults(func=watch)
+
+    serve_parser = subparsers.add_parser('serve', help='Serve predictions '
+                                         'of a model over HTTP')
+
+    serve_parser.description = 'Load a model once and answer POSTs of ' \
+                               'TrendLine JSON to /predict, batching ' \
+                               'concurrent requests; GET /stats for latency ' \
+                               'and queue depth'
+
+    serve_parser.add_argument('model', help='A model saved by build-model')
+    serve_parser.add_argument('--host', default='127.0.0.1',
+                              help='The address to listen on')
+    serve_parser.add_argument('--port', type=int, default=8080,
+                              help='The port to listen on; 0 picks a free '
+                              'one')
+    serve_parser.add_argument('--unix', help='Listen on a Unix socket at '
+                              'this path instead')
+    serve_parser.add_argument('-k', type=int, default=1, help='The number of '
+                              'nearest trends that vote on a prediction')
+    serve_parser.add_argument('--max-batch', type=int, default=MAX_BATCH,
+                              help='The most requests scored together')
+    serve_parser.add_argument('--max-delay', type=float,
+                              default=MAX_DELAY * 1000, help='Milliseconds '
+                              'a batch waits for more requests')
+    serve_parser.add_argument('--replay', help='Instead of serving forever, '
+                              'send each line of this JSONL file of '
+                              'requests to the server, then print client '
+                              'and server statistics as JSON')
+    serve_parser.add_argument('--concurrency', type=int, default=16,
+                              help='The number of connections to replay '
+                              'requests over')
+    serve_parser.set_defaults(func=serve)
 
     args = command_parser.parse_args()
-    if args.func == TrendModel.model_from_files:
-        model = TrendModel.model_from_files(args.tweets, args.trends,
-                                           args.stopwords)
-        print(model.serialize_model())
+    if not hasattr(args, 'func'):
+        command_parser.print_help()
+        return
+    if args.func == build_model and args.output is None and \
+            args.format == 'binary':
+        build_model_parser.error('binary models must be saved with --output; '
+                                 'use --format json to print the model')
+    args.func(args)
 
 
 if __name__ == '__main__':
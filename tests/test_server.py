@@ -0,0 +1,60 @@
+import asyncio
+import simplejson as json
+from twittp.model import TrendLine, TrendModel
+from twittp.server import PredictionServer, read_message, write_message
+
+
+def small_model():
+    trends = [TrendLine.empty('#up', 0, 20, trending=True),
+              TrendLine.empty('#down', 2400, 20)]
+    trends[0].features[:, 0] = range(20)
+    return TrendModel(trends=trends)
+
+
+def post(body):
+    """ Posts body to /predict of a fresh server; returns (status, answer).
+    """
+    async def run():
+        server = PredictionServer(small_model())
+        tcp = await server.start(port=0)
+        port = tcp.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            write_message(writer, 'POST /predict HTTP/1.1',
+                          json.dumps(body).encode('utf-8'), close=True)
+            await writer.drain()
+            start, _, answer = await read_message(reader)
+        finally:
+            writer.close()
+            tcp.close()
+            await tcp.wait_closed()
+            server.batcher_task.cancel()
+        return int(start[1]), json.loads(answer)
+    return asyncio.run(run())
+
+
+def trend_obj():
+    return small_model().trends[0].to_obj()
+
+
+def test_predict():
+    status, answer = post(trend_obj())
+    assert status == 200
+    assert answer['name'] == '#up'
+    assert answer['neighbors'][0]['name'] == '#up'
+
+
+def test_cell_missing_key():
+    obj = trend_obj()
+    del obj['data'][3]['delta']
+    status, answer = post(obj)
+    assert status == 400
+    assert 'error' in answer
+
+
+def test_malformed_cells():
+    for cell in ['count', None, {'count': 'x', 'delta': 0, 'delta_delta': 0,
+                                 'trending': False}]:
+        obj = trend_obj()
+        obj['data'][0] = cell
+        assert post(obj)[0] == 400
@@ -0,0 +1,96 @@
+import io
+import os
+import threading
+import time
+from email.utils import formatdate
+import simplejson as json
+from twittp.model import TrendCell, TrendLine, TrendModel
+from twittp.stream import TrendWatcher, follow_lines, poll_lines
+
+
+def small_model():
+    trends = [TrendLine.empty('#up', 0, 20, trending=True),
+              TrendLine.empty('#down', 2400, 20)]
+    trends[0].features[:, 0] = range(20)
+    return TrendModel(trends=trends)
+
+
+def tweet(text, ts):
+    # Twitter dates look like "Wed Aug 27 13:08:45 +0000 2008"
+    day, date, month, year, clock = formatdate(ts).replace(',', '').split()[:5]
+    created_at = ' '.join([day, month, date, clock, '+0000', year])
+    return json.dumps({'text': text, 'created_at': created_at}) + '\n'
+
+
+class Output(io.StringIO):
+    """ Collects the predictions written by TrendWatcher.watch. """
+
+    def predictions(self):
+        return [json.loads(line) for line in self.getvalue().splitlines()]
+
+
+def watch_until_output(watcher, lines, stop, wait=5.0):
+    """ Runs watcher.watch in a thread until it writes a prediction or wait
+    seconds pass, then stops the lines; returns the predictions.
+    """
+    out = Output()
+    thread = threading.Thread(target=watcher.watch, args=(lines, out),
+                              daemon=True)
+    thread.start()
+    deadline = time.perf_counter() + wait
+    while not out.getvalue() and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    predictions = out.predictions()
+    stop.set()
+    thread.join(wait)
+    return predictions
+
+
+def test_tick():
+    watcher = TrendWatcher(small_model(), TrendCell.weights(),
+                           topics=['#a'], window_size=60)
+    assert watcher.add(600, ['#a']) == []
+    assert watcher.add(610, ['#a', 'b']) == []
+    assert watcher.tick() == []
+    predictions = watcher.tick(watcher.last_arrival + 50)
+    assert [p['topic'] for p in predictions] == ['#a']
+    assert predictions[0]['window_start'] == 600
+    assert watcher.tick(watcher.last_arrival + 50) == []
+    assert watcher.flush() == []
+
+
+def test_follow_stalled(tmp_path):
+    path = os.path.join(str(tmp_path), 'tweets.json')
+    now = int(time.time())
+    with open(path, 'w') as f:
+        for _ in range(3):
+            f.write(tweet('#a b', now))
+    stop = threading.Event()
+
+    def lines():
+        for line in follow_lines(path, poll_interval=0.01, timeout=0.05):
+            if stop.is_set():
+                return
+            yield line
+
+    watcher = TrendWatcher(small_model(), TrendCell.weights(),
+                           window_size=1)
+    predictions = watch_until_output(watcher, lines(), stop)
+    assert [p['topic'] for p in predictions] == ['#a']
+    assert predictions[0]['window_start'] == now
+
+
+def test_stdin_stalled():
+    now = int(time.time())
+    stop = threading.Event()
+
+    def stdin():
+        for _ in range(3):
+            yield tweet('#a b', now)
+        stop.wait()
+
+    watcher = TrendWatcher(small_model(), TrendCell.weights(),
+                           window_size=1)
+    predictions = watch_until_output(watcher, poll_lines(stdin(), 0.05),
+                                     stop)
+    assert [p['topic'] for p in predictions] == ['#a']
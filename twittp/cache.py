@@ -0,0 +1,178 @@
+import hashlib
+import os
+import shutil
+import numpy as np
+import simplejson as json
+from .store import TweetStore
+from .twitter import TrendReader, tweet_records
+
+
+# Bytes of an input hashed at its head, and before the end of what was read
+FINGERPRINT_BYTES = 1 << 16
+
+STATE_FILE = 'state.json'
+FEATURES_FILE = 'features.npy'
+TWEETS_DIRECTORY = 'tweets'
+
+
+def file_digest(path):
+    """ The sha1 hex digest of the whole content of a file. """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint(path, offset):
+    """ A digest standing in for the first offset bytes of a file.
+
+    Only the head of the file and the bytes just before offset are hashed,
+    so checking that an append-only file still starts with what was read
+    before costs the same however long the file has grown. Returns None if
+    the file is now shorter than offset.
+    """
+    if os.path.getsize(path) < offset:
+        return None
+    digest = hashlib.sha1(str(offset).encode('ascii'))
+    with open(path, 'rb') as f:
+        digest.update(f.read(min(offset, FINGERPRINT_BYTES)))
+        f.seek(max(0, offset - FINGERPRINT_BYTES))
+        digest.update(f.read(offset - f.tell()))
+    return digest.hexdigest()
+
+
+class Tail:
+    """ The complete lines of a file from a byte offset on.
+
+    Iterating yields the lines as bytes, one at a time, and offset is moved
+    past each one. A last line without its newline may still be being
+    written, so it is left for next time.
+    """
+
+    def __init__(self, path, offset):
+        self.path = path
+        self.offset = offset
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                self.offset += len(line)
+                yield line
+
+
+class BuildCache:
+    """ Intermediate results of a model build, kept to rebuild cheaply.
+
+    An entry of the cache is a directory named by a digest of the build
+    parameters, the content of the stopwords file and the paths of the
+    tweet and trend files. Because those files are append-only logs, an
+    entry stays valid as they grow: it records how many bytes of each have
+    been consumed, along with a fingerprint of them, and a rebuild only
+    reads what was appended since. If a file no longer starts with what was
+    consumed, the entry is thrown away and the build starts over.
+
+    An entry holds:
+
+    - the Tweets consumed so far, as a TweetStore (tweets/)
+    - the state of the TrendReader over the trends file
+    - the name, start and length of every trend of the last build, and the
+      features they had (features.npy)
+    - the negative trends drawn so far
+    """
+
+    def __init__(self, directory, trend_file, tweet_file, stopwords_file,
+                 params):
+        self.trend_file = trend_file
+        self.tweet_file = tweet_file
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+        digest.update(b'stopwords:')
+        if stopwords_file is not None:
+            digest.update(file_digest(stopwords_file).encode('ascii'))
+        for path in (trend_file, tweet_file):
+            digest.update(b'input:')
+            digest.update(os.path.realpath(path).encode('utf-8'))
+        self.path = os.path.join(directory, digest.hexdigest())
+        self.tweets_path = os.path.join(self.path, TWEETS_DIRECTORY)
+
+    def load(self):
+        """ Returns the state saved in this entry, or None to start afresh.
+
+        The state is a dict of the offsets and fingerprints of the inputs,
+        the TrendReader (as reader), the number of Tweets consumed, the
+        trends of the last build and the negative trends drawn so far, each
+        as [name, start_ts, length]. Features are loaded separately by
+        load_features.
+        """
+        state_file = os.path.join(self.path, STATE_FILE)
+        if not os.path.isfile(state_file):
+            return None
+        with open(state_file) as f:
+            state = json.load(f)
+        for name, path in (('trend', self.trend_file),
+                           ('tweet', self.tweet_file)):
+            if fingerprint(path, state[name + '_offset']) != \
+                    state[name + '_fingerprint']:
+                self.clear()
+                return None
+        # The store is extended before the state is saved, so a build that
+        # was interrupted in between leaves Tweets the state does not cover
+        if len(TweetStore.open(self.tweets_path)) != state['tweets']:
+            self.clear()
+            return None
+        state['reader'] = TrendReader.from_obj(state['reader'])
+        return state
+
+    def load_features(self, state):
+        """ The features of each trend of the last build. """
+        features = np.load(os.path.join(self.path, FEATURES_FILE))
+        offsets = np.cumsum([0] + [length for _, _, length
+                                   in state['trends']])
+        return [features[offsets[i]:offsets[i + 1]]
+                for i in range(len(state['trends']))]
+
+    def save(self, state, features):
+        """ Saves the state and trend features of a finished build.
+
+        The state is written last, so an interrupted save leaves an entry
+        that load does not trust.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        state_file = os.path.join(self.path, STATE_FILE)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        state = dict(state)
+        for name, path in (('trend', self.trend_file),
+                           ('tweet', self.tweet_file)):
+            state[name + '_fingerprint'] = fingerprint(
+                path, state[name + '_offset'])
+        state['reader'] = state['reader'].to_obj()
+        np.save(os.path.join(self.path, FEATURES_FILE),
+                np.concatenate(features + [np.zeros((0, 3), dtype=np.int64)]))
+        with open(state_file, 'w') as f:
+            json.dump(state, f)
+
+    def clear(self):
+        """ Removes this entry from the cache. """
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def read_trends(self, reader, offset):
+        """ Feeds the responses appended to the trends file to reader.
+
+        Returns the new offset into the trends file.
+        """
+        tail = Tail(self.trend_file, offset)
+        reader.feed(line.decode('utf-8') for line in tail)
+        return tail.offset
+
+    def read_tweets(self, offset):
+        """ Adds the Tweets appended to the tweet file to the TweetStore.
+
+        Returns the store and the new offset into the tweet file.
+        """
+        tail = Tail(self.tweet_file, offset)
+        store = TweetStore.extend(tweet_records(tail), self.tweets_path)
+        return store, tail.offset
@@ -0,0 +1,295 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft
+
+
+# Upper bound on the number of elements in any temporary difference array
+CHUNK_ELEMENTS = 1 << 22
+
+
+def alignment_costs(short, long, weights):
+    """ Computes the weighted L1 cost of every alignment of short along long.
+
+    Both arguments are (n, 3) feature arrays as held by TrendLine, with
+    len(short) <= len(long). The result has one entry per offset of short
+    into long, where entry k is the cost of lining short up with
+    long[k:k + len(short)].
+    """
+    n = len(short)
+    m = len(long)
+    offsets = m - n + 1
+    costs = np.zeros(offsets, dtype=np.float64)
+    if n == 0:
+        return costs
+
+    step = max(1, CHUNK_ELEMENTS // n)
+    for f in range(3):
+        column = np.asarray(short[:, f], dtype=np.float64)
+        windows = sliding_window_view(np.asarray(long[:, f],
+                                                 dtype=np.float64), n)
+        for lo in range(0, offsets, step):
+            chunk = windows[lo:lo + step]
+            costs[lo:lo + step] += weights[f] * \
+                np.abs(chunk - column).sum(axis=1)
+    return costs
+
+
+def alignment_distance(a, b, weights):
+    """ The minimum alignment cost between two feature arrays.
+
+    This is the vectorized equivalent of sliding the shorter TrendLine along
+    the longer one and summing TrendCell distances at each offset.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    return float(alignment_costs(a, b, weights).min())
+
+
+def pad_features(lines):
+    """ Stacks the feature arrays of TrendLines into one zero-padded block.
+
+    Returns a (len(lines), longest, 3) float64 block and the true length of
+    each line, which is the form batch_alignment_distance expects. The
+    batch functions only score each line as far as the longest line of
+    similar length (see length_chunks), not to the width of the block.
+    """
+    lengths = np.array([len(line) for line in lines], dtype=np.int64)
+    longest = int(lengths.max()) if len(lengths) else 0
+    block = np.zeros((len(lines), longest, 3), dtype=np.float64)
+    for i, line in enumerate(lines):
+        block[i, :lengths[i]] = line.features
+    return block, lengths
+
+
+def length_chunks(rows, lengths, row_elements, base=0):
+    """ Splits rows of a padded block into chunks of lines of similar length.
+
+    The rows are taken in order of length, and a chunk is closed before its
+    longest line is more than twice as far past base as its shortest, or
+    before its rows times row_elements(longest) would exceed
+    CHUNK_ELEMENTS. Yields each chunk with the length of its longest line,
+    which is as far into the block as the chunk needs to be scored, so no
+    line pays for the padding of a much longer one. With base one less than
+    the length of a query, lines are grouped by the number of offsets the
+    query has along them.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    order = rows[np.argsort(lengths[rows], kind='stable')]
+    ordered = lengths[order]
+    lo = 0
+    while lo < len(order):
+        limit = base + 2 * max(int(ordered[lo]) - base, 1)
+        hi = int(np.searchsorted(ordered, limit, side='right'))
+        step = CHUNK_ELEMENTS // max(1, row_elements(int(ordered[hi - 1])))
+        hi = min(hi, lo + max(1, step))
+        yield order[lo:hi], int(ordered[hi - 1])
+        lo = hi
+
+
+def batch_alignment_distance(query, block, lengths, weights):
+    """ Scores one feature array against every line of a padded block.
+
+    The block and lengths are as returned by pad_features. Lines at least as
+    long as the query are scored by sliding the query along them, and
+    shorter lines are slid along the query, exactly as alignment_distance
+    does for a single pair. Returns one distance per line of the block.
+    """
+    query = np.asarray(query, dtype=np.float64).reshape(-1, 3)
+    return multi_alignment_distance(query[None], block, lengths, weights)[0]
+
+
+def multi_alignment_distance(queries, block, lengths, weights):
+    """ Scores several feature arrays of the same length against every
+    line of a padded block at once.
+
+    queries is a (q, n, 3) array. Each line is scored against all of them
+    in the same pass, so a batch of queries costs about one call rather
+    than q of batch_alignment_distance. Returns a (q, len(lengths)) array.
+    """
+    queries = np.asarray(queries, dtype=np.float64)
+    q, n = queries.shape[:2]
+    distances = np.zeros((q, len(lengths)), dtype=np.float64)
+    if n == 0 or q == 0:
+        return distances
+
+    # Lines the queries slide along, in chunks of similar length
+    longer = np.flatnonzero(lengths >= n)
+    for rows, width in length_chunks(longer, lengths,
+                                     lambda width: q * (width - n + 1) * n,
+                                     n - 1):
+        offsets = width - n + 1
+        costs = np.zeros((q, len(rows), offsets), dtype=np.float64)
+        for f in range(3):
+            windows = sliding_window_view(block[rows, :width, f], n, axis=1)
+            costs += weights[f] * np.abs(
+                windows[None] - queries[:, None, None, :, f]).sum(axis=3)
+        costs[:, np.arange(offsets) > (lengths[rows] - n)[:, None]] = np.inf
+        distances[:, rows] = costs.min(axis=2)
+
+    # Lines that slide along the queries, grouped by their length
+    shorter = np.flatnonzero(lengths < n)
+    for m in np.unique(lengths[shorter]):
+        rows = shorter[lengths[shorter] == m]
+        if m == 0:
+            continue
+        offsets = n - m + 1
+        step = max(1, CHUNK_ELEMENTS // (q * offsets * m))
+        for lo in range(0, len(rows), step):
+            chunk = rows[lo:lo + step]
+            costs = np.zeros((q, len(chunk), offsets), dtype=np.float64)
+            for f in range(3):
+                windows = sliding_window_view(queries[:, :, f], m, axis=1)
+                lines = block[chunk, :m, f]
+                costs += weights[f] * np.abs(
+                    windows[:, None] - lines[None, :, None]).sum(axis=3)
+            distances[:, chunk] = costs.min(axis=2)
+    return distances
+
+
+def _integral(*arrays):
+    """ Indicates whether every value of the arrays is a whole number. """
+    return all(np.array_equal(array, np.rint(array)) for array in arrays)
+
+
+def _squared_costs(short, lengths, long, weights):
+    """ The weighted squared-Euclidean costs of sliding short along long.
+
+    short is (R, n, 3) and long is (R, m, 3) with n <= m, either of which
+    may have R = 1 to be broadcast against the other. Row r of short is
+    zero-padded beyond lengths[r]. Entry [r, k] of the result is the cost
+    of lining short[r, :lengths[r]] up with long[r, k:k + lengths[r]]; the
+    entries for offsets that run past the end of long are meaningless and
+    left for the caller to mask.
+
+    Expanding the square, that cost is sum(short ** 2) plus the sum of
+    long ** 2 over the window, which prefix sums give for every offset,
+    minus twice the cross-correlation of the two, which one FFT product
+    gives for every offset. All offsets then take O(m log m) rather than
+    O(n * m). With whole-number features the costs are rounded back to the
+    exact integers the floating-point FFT approximates.
+    """
+    m = long.shape[1]
+    rows = max(len(short), len(long))
+    size = fft.next_fast_len(max(1, m), real=True)
+    integral = _integral(short, long)
+    ends = np.minimum(np.arange(m) + np.reshape(lengths, (-1, 1)), m)
+    ends = np.broadcast_to(ends, (rows, m))
+    costs = np.zeros((rows, m), dtype=np.float64)
+    for f in range(3):
+        if not weights[f]:
+            continue
+        a = short[:, :, f]
+        b = long[:, :, f]
+        correlation = fft.irfft(fft.rfft(b, size, axis=1) *
+                                np.conj(fft.rfft(a, size, axis=1)),
+                                size, axis=1)[:, :m]
+        prefix = np.zeros((len(b), m + 1), dtype=np.float64)
+        np.cumsum(b * b, axis=1, out=prefix[:, 1:])
+        prefix = np.broadcast_to(prefix, (rows, m + 1))
+        windows = np.take_along_axis(prefix, ends, axis=1) - prefix[:, :m]
+        cost = (a * a).sum(axis=1)[:, None] + windows - 2 * correlation
+        if integral:
+            cost = np.rint(cost)
+        costs += weights[f] * np.maximum(cost, 0)
+    return costs
+
+
+def squared_alignment_costs(short, long, weights):
+    """ Computes the weighted squared-Euclidean cost of every alignment of
+    short along long.
+
+    This is alignment_costs with each cell scored by the weighted sum of
+    the squared differences of its features instead of the absolute ones.
+    The costs of all offsets are found at once by FFT cross-correlation;
+    see _squared_costs.
+    """
+    short = np.asarray(short, dtype=np.float64).reshape(-1, 3)
+    long = np.asarray(long, dtype=np.float64).reshape(-1, 3)
+    n = len(short)
+    offsets = len(long) - n + 1
+    if n == 0:
+        return np.zeros(offsets, dtype=np.float64)
+    return _squared_costs(short[None], [n], long[None], weights)[0, :offsets]
+
+
+def squared_alignment_distance(a, b, weights):
+    """ The minimum squared-Euclidean alignment cost between two feature
+    arrays; the L2 counterpart of alignment_distance.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    return float(squared_alignment_costs(a, b, weights).min())
+
+
+def batch_squared_alignment_distance(query, block, lengths, weights):
+    """ Scores one feature array against every line of a padded block under
+    the squared-Euclidean alignment cost.
+
+    This is the L2 counterpart of batch_alignment_distance, with the same
+    arguments and the same choice of which line slides along which. Lines
+    are scored in chunks of similar length that share the transform of the
+    query.
+    """
+    query = np.asarray(query, dtype=np.float64).reshape(-1, 3)
+    n = len(query)
+    distances = np.zeros(len(lengths), dtype=np.float64)
+    if n == 0:
+        return distances
+
+    # Lines the query slides along, in chunks of similar length
+    longer = np.flatnonzero(lengths >= n)
+    for rows, width in length_chunks(longer, lengths,
+                                     lambda width: 4 * width):
+        costs = _squared_costs(query[None], [n], block[rows, :width],
+                               weights)
+        costs[np.arange(width) > (lengths[rows] - n)[:, None]] = np.inf
+        distances[rows] = costs.min(axis=1)
+
+    # Lines that slide along the query
+    shorter = np.flatnonzero((lengths < n) & (lengths > 0))
+    if len(shorter):
+        valid = np.arange(n) <= (n - lengths[shorter])[:, None]
+        step = max(1, CHUNK_ELEMENTS // (4 * n))
+        for lo in range(0, len(shorter), step):
+            rows = shorter[lo:lo + step]
+            costs = _squared_costs(block[rows, :n], lengths[rows],
+                                   query[None], weights)
+            costs[~valid[lo:lo + step]] = np.inf
+            distances[rows] = costs.min(axis=1)
+    return distances
+
+
+def multi_squared_alignment_distance(queries, block, lengths, weights):
+    """ The L2 counterpart of multi_alignment_distance.
+
+    Each query is scored with batch_squared_alignment_distance, whose FFTs
+    already cover a whole chunk of lines at a time.
+    """
+    distances = np.zeros((len(queries), len(lengths)), dtype=np.float64)
+    for i, query in enumerate(queries):
+        distances[i] = batch_squared_alignment_distance(query, block, lengths,
+                                                        weights)
+    return distances
+
+
+# The alignment distance of a pair, of a query against a padded block and
+# of several queries of one length against a padded block, for each norm
+# cells can be scored with
+DISTANCES = {'l1': alignment_distance, 'l2': squared_alignment_distance}
+BATCH_DISTANCES = {'l1': batch_alignment_distance,
+                   'l2': batch_squared_alignment_distance}
+MULTI_DISTANCES = {'l1': multi_alignment_distance,
+                   'l2': multi_squared_alignment_distance}
+
+
+def batch_distance(norm):
+    """ The batch alignment distance function for a norm, 'l1' or 'l2'. """
+    if norm not in BATCH_DISTANCES:
+        raise ValueError('Unknown norm: %s' % norm)
+    return BATCH_DISTANCES[norm]
+
+
+def multi_distance(norm):
+    """ The multi-query alignment distance function for a norm. """
+    batch_distance(norm)
+    return MULTI_DISTANCES[norm]
@@ -0,0 +1,175 @@
+import math
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from .distance import CHUNK_ELEMENTS
+
+
+def as_features(a):
+    """ Views a flat c, d, dd, c, d, dd, ... array as (n, 3) float64. """
+    return np.asarray(a, dtype=np.float64).reshape(-1, 3)
+
+
+def band_limits(n, m, window=None):
+    """ The first and last column of b each row of a may be matched with.
+
+    Without a window every column is allowed. With one, row i is limited to
+    columns within window cells of the diagonal i * (m - 1) / (n - 1) (a
+    Sakoe-Chiba band stretched to the lengths of the two series). The
+    window is widened if needed so that a warping path always exists.
+    """
+    rows = np.arange(n)
+    if window is None:
+        return np.zeros(n, dtype=np.int64), np.full(n, m - 1, dtype=np.int64)
+    slope = (m - 1) / (n - 1) if n > 1 else 0.0
+    window = max(window, math.ceil(slope / 2))
+    centers = rows * slope
+    lo = np.clip(np.ceil(centers - window), 0, m - 1).astype(np.int64)
+    hi = np.clip(np.floor(centers + window), 0, m - 1).astype(np.int64)
+    lo[0] = 0
+    hi[-1] = m - 1
+    return lo, hi
+
+
+def dtw_distance(a, b, weights, window=None, best_so_far=np.inf):
+    """ The Dynamic-Time Warp distance between two series of TrendCells.
+
+    a and b are feature arrays, either (n, 3) or flat. The cost of matching
+    two cells is the weighted squared difference of their count, delta and
+    delta_delta. See http://en.wikipedia.org/wiki/Dynamic_time_warping
+
+    Only two rows of the cost matrix are kept. Each row is filled in at once
+    using D[j] = C[j] + min(t[k] - C[k] for k <= j), where C is the running
+    sum of costs along the row and t the cost of entering each cell from
+    the previous row. Every warping path crosses every row, so as soon as a
+    whole row costs more than best_so_far, the search is abandoned and inf
+    is returned.
+    """
+    a = as_features(a)
+    b = as_features(b)
+    n = len(a)
+    m = len(b)
+    if n == 0 or m == 0:
+        return 0.0 if n == m else np.inf
+    weights = np.asarray(weights, dtype=np.float64)
+    lo, hi = band_limits(n, m, window)
+
+    previous = np.full(m + 1, np.inf)  # previous[j + 1] holds D[i - 1][j]
+    current = np.full(m + 1, np.inf)
+    previous[0] = 0.0  # Lets (0, 0) be entered "diagonally" from nowhere
+    for i in range(n):
+        start = lo[i]
+        stop = hi[i] + 1
+        costs = ((b[start:stop] - a[i]) ** 2) @ weights
+        entering = costs + np.minimum(previous[start + 1:stop + 1],
+                                      previous[start:stop])
+        running = np.cumsum(costs)
+        current[:] = np.inf
+        current[start + 1:stop + 1] = running + \
+            np.minimum.accumulate(entering - running)
+        if current[start + 1:stop + 1].min() > best_so_far:
+            return np.inf
+        previous, current = current, previous
+    return float(previous[m])
+
+
+def lb_kim(a, b, weights):
+    """ A constant-time lower bound on the DTW distance.
+
+    Every warping path matches the first cells and the last cells of both
+    series with each other.
+    """
+    a = as_features(a)
+    b = as_features(b)
+    weights = np.asarray(weights, dtype=np.float64)
+    bound = ((a[0] - b[0]) ** 2) @ weights
+    if len(a) > 1 or len(b) > 1:
+        bound += ((a[-1] - b[-1]) ** 2) @ weights
+    return float(bound)
+
+
+def envelope(b, n, window=None):
+    """ The lower and upper envelope of b as seen by each row of a length n.
+
+    Row i of the result holds the per-feature minimum and maximum of b over
+    the columns row i may be matched with under band_limits, found with a
+    sliding minimum and maximum over windows as wide as the widest band.
+    Without a window every row sees all of b, so a single row is returned,
+    which broadcasts against a series of any length.
+    """
+    b = as_features(b)
+    if window is None:
+        return b.min(axis=0)[None], b.max(axis=0)[None]
+    lo, hi = band_limits(n, len(b), window)
+    spans = hi - lo
+    width = int(spans.max()) + 1
+    padded = np.concatenate([b, np.zeros((width - 1, 3))])
+    windows = sliding_window_view(padded, width, axis=0)
+    lower = np.empty((n, 3))
+    upper = np.empty((n, 3))
+    step = max(1, CHUNK_ELEMENTS // (3 * width))
+    for start in range(0, n, step):
+        rows = slice(start, start + step)
+        cells = windows[lo[rows]]
+        outside = (np.arange(width) > spans[rows, None])[:, None, :]
+        lower[rows] = np.where(outside, np.inf, cells).min(axis=2)
+        upper[rows] = np.where(outside, -np.inf, cells).max(axis=2)
+    return lower, upper
+
+
+def lb_keogh(a, lower, upper, weights):
+    """ LB_Keogh: how far a strays outside the envelope of the other series.
+
+    Each cell of a is matched with at least one cell within its envelope,
+    which costs at least its squared distance to the envelope.
+    """
+    a = as_features(a)
+    above = np.maximum(a - upper, 0)
+    below = np.maximum(lower - a, 0)
+    return float(((above ** 2 + below ** 2) @ weights).sum())
+
+
+def dtw_nearest(query, candidates, weights, window=None, exclude=None,
+                envelopes=None):
+    """ Finds the candidate nearest to query under DTW.
+
+    candidates is a list of feature arrays, and exclude an optional index
+    to leave out. Candidates are visited in order of LB_Kim, skipped if
+    LB_Keogh already exceeds the best distance so far, and otherwise their
+    DTW computation is abandoned as soon as it exceeds that best distance.
+    Ties are broken in favour of the lower index. Returns (index, distance).
+
+    envelopes is an optional dict to keep the envelopes of candidates in
+    between calls with the same candidates, keyed by candidate index and
+    query length (or None without a window, where the length does not
+    matter). The caller decides how long to keep it.
+    """
+    if envelopes is None:
+        envelopes = {}
+    query = as_features(query)
+    weights = np.asarray(weights, dtype=np.float64)
+    kims = [lb_kim(query, candidate, weights) if len(candidate) and
+            len(query) else 0.0 for candidate in candidates]
+    order = sorted(range(len(candidates)), key=lambda k: (kims[k], k))
+
+    best = None
+    best_distance = np.inf
+    for k in order:
+        if k == exclude:
+            continue
+        if kims[k] > best_distance:
+            break
+        candidate = as_features(candidates[k])
+        if len(query) and len(candidate):
+            key = (k, len(query) if window is not None else None)
+            if key not in envelopes:
+                envelopes[key] = envelope(candidate, len(query), window)
+            lower, upper = envelopes[key]
+            if lb_keogh(query, lower, upper, weights) > best_distance:
+                continue
+        distance = dtw_distance(query, candidate, weights, window,
+                                best_so_far=best_distance)
+        if distance < best_distance or \
+                (distance == best_distance and (best is None or k < best)):
+            best = k
+            best_distance = distance
+    return best, best_distance
@@ -0,0 +1,263 @@
+import os
+import numpy as np
+import simplejson as json
+from scipy.sparse import csr_matrix
+
+
+META_FILE = 'meta.json'
+NAMES_FILE = 'names.json'
+
+# Seconds of trend start times that go in one block of a FeatureStore
+BLOCK_SECONDS = 24 * 3600
+
+# Most rows a FeatureStore buffers for a block before writing them out
+PART_ROWS = 4096
+
+
+def trend_rows(trends, start_ts=None, window_size=120):
+    """ Builds the CSR arrays of a feature matrix with one row per trend.
+
+    Row i holds the count, delta and delta_delta of every window of trend i,
+    starting at column 3 * ((start_ts_i - start_ts) // window_size), or at
+    column 0 if start_ts is None. The arrays are built directly rather than
+    by assigning into a matrix, and zero features are left out. Returns
+    data, indices and indptr.
+    """
+    lengths = np.array([len(trend) for trend in trends], dtype=np.int64)
+    firsts = np.array([0 if start_ts is None else
+                       (trend.start_ts - start_ts) // window_size * 3
+                       for trend in trends], dtype=np.int64)
+    data = np.concatenate([trend.features.ravel() for trend in trends] +
+                          [np.zeros(0, dtype=np.int64)])
+    rows = np.repeat(np.arange(len(trends)), lengths * 3)
+    row_starts = np.repeat(np.cumsum(lengths * 3) - lengths * 3, lengths * 3)
+    indices = np.repeat(firsts, lengths * 3) + \
+        (np.arange(len(data)) - row_starts)
+
+    nonzero = data != 0
+    data = data[nonzero].astype(np.float64)
+    indices = indices[nonzero]
+    indptr = np.zeros(len(trends) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[nonzero], minlength=len(trends)),
+              out=indptr[1:])
+    return data, indices, indptr
+
+
+def row_extents(matrix):
+    """ The first and last window with a nonzero feature in each row of a
+    feature matrix.
+
+    These are found from the indptr and indices arrays of the CSR matrix,
+    without densifying any row. Returns (starts, ends) in windows, with ends
+    exclusive; a row without any nonzero feature has an empty extent.
+    """
+    indptr = np.asarray(matrix.indptr, dtype=np.int64)
+    indices = np.asarray(matrix.indices, dtype=np.int64)
+    starts = np.zeros(len(indptr) - 1, dtype=np.int64)
+    ends = np.zeros(len(indptr) - 1, dtype=np.int64)
+    nonempty = np.diff(indptr) > 0
+    if nonempty.any():
+        # The empty rows between two nonempty ones add nothing to a segment
+        firsts = indptr[:-1][nonempty]
+        starts[nonempty] = np.minimum.reduceat(indices, firsts) // 3
+        ends[nonempty] = np.maximum.reduceat(indices, firsts) // 3 + 1
+    return starts, ends
+
+
+def extent_block(matrix, rows, starts, ends):
+    """ The features of some rows of a feature matrix over their extents.
+
+    starts and ends are as returned by row_extents. The result is a
+    (len(rows), longest, 3) float64 block, zero-padded beyond each row's
+    extent, along with the length of each extent, which is the form
+    twittp.distance expects. Only the stored entries of the rows are read.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    indptr = np.asarray(matrix.indptr, dtype=np.int64)
+    lengths = ends[rows] - starts[rows]
+    block = np.zeros((len(rows), int(lengths.max(initial=0)), 3),
+                     dtype=np.float64)
+    counts = indptr[rows + 1] - indptr[rows]
+    total = int(counts.sum())
+    if total:
+        local = np.repeat(np.arange(len(rows)), counts)
+        elements = np.repeat(indptr[rows] - (np.cumsum(counts) - counts),
+                             counts) + np.arange(total)
+        columns = np.asarray(matrix.indices)[elements]
+        block[local, columns // 3 - starts[rows][local], columns % 3] = \
+            np.asarray(matrix.data)[elements]
+    return block, lengths
+
+
+def save_sparse_matrix(path, matrix, labels, start_ts, window_size):
+    """ Writes a feature matrix and its labels to a directory.
+
+    The data, indices and indptr arrays of the CSR matrix and the labels are
+    each written as .npy files so they can be memory-mapped back in, and the
+    shape and time origin of the columns go in meta.json.
+    """
+    os.makedirs(path, exist_ok=True)
+    matrix = csr_matrix(matrix)
+    np.save(os.path.join(path, 'data.npy'), matrix.data)
+    np.save(os.path.join(path, 'indices.npy'), matrix.indices)
+    np.save(os.path.join(path, 'indptr.npy'), matrix.indptr)
+    np.save(os.path.join(path, 'labels.npy'),
+            np.asarray(labels, dtype=np.int8))
+    meta = {'shape': list(matrix.shape), 'start_ts': start_ts,
+            'window_size': window_size}
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+
+def load_sparse_matrix(path):
+    """ Loads a feature matrix written by save_sparse_matrix.
+
+    The arrays are memory-mapped rather than read, so this is cheap no
+    matter how large the matrix is. Returns (matrix, labels, meta).
+    """
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    data, indices, indptr, labels = [
+        np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        for name in ('data', 'indices', 'indptr', 'labels')]
+    matrix = csr_matrix((data, indices, indptr), shape=tuple(meta['shape']),
+                        copy=False)
+    return matrix, labels, meta
+
+
+class FeatureStore:
+    """ A feature matrix partitioned by time, for histories beyond memory.
+
+    Unlike TrendModel.sparse_matrix, each row starts at column 0 with the
+    first window of its own trend, so the width of the matrix is three
+    columns per window of the longest trend rather than of the whole time
+    span. Trends are put in blocks by start time, block_seconds each, and a
+    block is written out as a part, a directory written by
+    save_sparse_matrix, every part_rows rows. A store is a directory
+    holding:
+
+    - block-<k>/part-<i>/: the parts of block k, which starts at
+      k * block_seconds, each with the name (names.json) and start time
+      (start_ts.npy) of every row alongside its matrix
+    - meta.json: the window size, block size, width and number of rows,
+      and the block and row count of every part, in order
+
+    The parts are memory-mapped when read, so a store can be streamed
+    through (see chunks) however large it is.
+    """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.width = meta['width']
+        self.window_size = meta['window_size']
+        self.block_seconds = meta['block_seconds']
+
+    def __len__(self):
+        return self.meta['rows']
+
+    @staticmethod
+    def write(trends, path, block_seconds=BLOCK_SECONDS, part_rows=PART_ROWS):
+        """ Writes an iterable of TrendLines to a new FeatureStore.
+
+        The trends are consumed one at a time, and at most part_rows of
+        them are held at once: when that many are waiting, the block with
+        the most is written out. They can thus be generated as they are
+        populated (see TrendLine.populate_by_block), or read from a
+        memory-mapped model. All the trends must have the same window size.
+        Returns the opened store.
+        """
+        os.makedirs(path, exist_ok=True)
+        pending = {}
+        parts = []
+        counts = {}
+        widths = [0]
+        window_size = None
+
+        def flush(block):
+            rows = pending.pop(block)
+            part_path = os.path.join('block-%d' % block,
+                                     'part-%d' % counts.get(block, 0))
+            counts[block] = counts.get(block, 0) + 1
+            data, indices, indptr = trend_rows(rows)
+            widths.append(int(max(len(trend) for trend in rows)) * 3)
+            matrix = csr_matrix((data, indices, indptr),
+                                shape=(len(rows), widths[-1]))
+            save_sparse_matrix(os.path.join(path, part_path), matrix,
+                               [trend.trending() for trend in rows],
+                               block * block_seconds, rows[0].window_size)
+            np.save(os.path.join(path, part_path, 'start_ts.npy'),
+                    np.array([trend.start_ts for trend in rows],
+                             dtype=np.int64))
+            with open(os.path.join(path, part_path, NAMES_FILE), 'w') as f:
+                json.dump([trend.name for trend in rows], f,
+                          ensure_ascii=False)
+            parts.append({'block': block, 'path': part_path,
+                          'rows': len(rows)})
+
+        waiting = 0
+        for trend in trends:
+            if window_size is None:
+                window_size = trend.window_size
+            elif trend.window_size != window_size:
+                raise ValueError('Trends of a FeatureStore must share a '
+                                 'window size')
+            pending.setdefault(trend.start_ts // block_seconds,
+                               []).append(trend)
+            waiting += 1
+            if waiting >= part_rows:
+                largest = max(pending, key=lambda block: len(pending[block]))
+                waiting -= len(pending[largest])
+                flush(largest)
+        for block in sorted(pending):
+            flush(block)
+
+        parts.sort(key=lambda part: part['block'])
+        meta = {'window_size': 120 if window_size is None else window_size,
+                'block_seconds': block_seconds, 'width': max(widths),
+                'rows': sum(part['rows'] for part in parts), 'parts': parts}
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump(meta, f)
+        return FeatureStore(path, meta)
+
+    @staticmethod
+    def open(path):
+        """ Opens a FeatureStore written by write. """
+        with open(os.path.join(path, META_FILE)) as f:
+            return FeatureStore(path, json.load(f))
+
+    def blocks(self):
+        """ The start times of the blocks that have rows, in order. """
+        return sorted(set(part['block'] * self.block_seconds
+                          for part in self.meta['parts']))
+
+    def chunks(self, start_ts=None, end_ts=None, trends=False):
+        """ Yields an (X_chunk, y_chunk) pair for each part of the store.
+
+        X_chunk is a CSR matrix with one row per trend and self.width
+        columns, memory-mapped from disk, and y_chunk holds the labels of
+        its rows (1 for trends that trend on Twitter, 0 for the others).
+        Parts come in order of their blocks. Passing start_ts and end_ts
+        keeps to the blocks that start in [start_ts, end_ts). With trends,
+        the names and start times of the rows come along too, as
+        (X_chunk, y_chunk, names, starts).
+        """
+        for part in self.meta['parts']:
+            block_start = part['block'] * self.block_seconds
+            if start_ts is not None and block_start < start_ts:
+                continue
+            if end_ts is not None and block_start >= end_ts:
+                continue
+            part_path = os.path.join(self.path, part['path'])
+            matrix, labels, _ = load_sparse_matrix(part_path)
+            matrix = csr_matrix((matrix.data, matrix.indices, matrix.indptr),
+                                shape=(matrix.shape[0], self.width),
+                                copy=False)
+            if not trends:
+                yield matrix, labels
+                continue
+            with open(os.path.join(part_path, NAMES_FILE)) as f:
+                names = json.load(f)
+            starts = np.load(os.path.join(part_path, 'start_ts.npy'),
+                             mmap_mode='r')
+            yield matrix, labels, names, starts
@@ -0,0 +1,343 @@
+import numpy as np
+from .distance import multi_distance
+
+
+# Number of candidates first considered at once while searching; batches
+# double from there up to MAXIMUM_BATCH
+CANDIDATE_BATCH = 64
+MAXIMUM_BATCH = 4096
+# Numbers of pieces lines are cut into for successively tighter sum bounds
+SEGMENTS = (1, 8)
+
+
+def segment_cuts(length, segments):
+    """ Where to cut a line of length cells into at most segments pieces. """
+    return np.unique(np.linspace(0, length, min(length, segments) + 1)
+                     .astype(np.int64))
+
+
+def _segment_min(values, starts, empty=np.inf):
+    """ The minimum of each segment of values beginning at starts.
+
+    Segments run up to the next start; an empty segment gets empty.
+    """
+    result = np.full(len(starts), empty, dtype=np.float64)
+    sizes = np.diff(np.append(starts, len(values)))
+    nonempty = sizes > 0
+    if nonempty.any():
+        result[nonempty] = np.minimum.reduceat(values, starts[nonempty])
+    return result
+
+
+class TrendIndex:
+    """ A nearest-neighbor index over the TrendLines of a model.
+
+    The alignment distance is not a metric (the triangle inequality fails
+    between lines of different lengths), so rather than a metric tree the
+    index prunes with cheap lower bounds on the distance between a query
+    and each indexed line, built from per-line summaries:
+
+    - the envelope bound: every cell of the shorter of the two lines costs
+      at least its distance from the [min, max] box of the features of the
+      longer line, which takes O(log n) per line to sum up
+    - the sum bound: at any alignment, each piece of the shorter line costs
+      at least the difference between its feature sums and those of the
+      stretch of the longer line it is lined up with, which prefix sums give
+      for every alignment
+
+    Lines are scored exactly only when their bounds could beat the k-th
+    best distance found so far, so the result is exactly what a brute-force
+    scan would give. The index keeps the lines as one flat feature array
+    with offsets, as in the binary model format, and its per-line minima,
+    maxima and prefix sums are saved with the model.
+    """
+
+    def __init__(self, features, offsets, labels, mins=None, maxs=None,
+                 prefix=None):
+        self.features = features
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.labels = np.asarray(labels, dtype=bool)
+        self.lengths = np.diff(self.offsets)
+        self.cells = np.asarray(features, dtype=np.float64)
+        # Line i has its prefix sums at prefix[offsets[i] + i:][:length + 1]
+        self.prefix_starts = self.offsets[:-1] + np.arange(len(self.lengths))
+        if mins is None or maxs is None or prefix is None:
+            mins, maxs, prefix = self.summaries()
+        self.mins = np.asarray(mins)
+        self.maxs = np.asarray(maxs)
+        self.prefix = np.asarray(prefix)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def summaries(self):
+        """ Computes the per-line minima, maxima and prefix sums. """
+        features = self.cells
+        starts = self.offsets[:-1]
+        nonempty = self.lengths > 0
+        mins = np.zeros((len(self), 3))
+        maxs = np.zeros((len(self), 3))
+        if nonempty.any():
+            mins[nonempty] = np.minimum.reduceat(features,
+                                                 starts[nonempty], axis=0)
+            maxs[nonempty] = np.maximum.reduceat(features,
+                                                 starts[nonempty], axis=0)
+
+        # Each line's prefix sums start with a row of zeros
+        prefix = np.zeros((len(features) + len(self), 3))
+        rows = np.arange(len(features)) + \
+            np.repeat(np.arange(len(self)), self.lengths) + 1
+        cumulative = np.concatenate((np.zeros((1, 3)),
+                                     np.cumsum(features, axis=0)))
+        prefix[rows] = cumulative[1:] - \
+            np.repeat(cumulative[starts], self.lengths, axis=0)
+        return mins, maxs, prefix
+
+    def arrays(self):
+        """ The arrays to save with a model to restore this index. """
+        return {'index_mins': self.mins, 'index_maxs': self.maxs,
+                'index_prefix': self.prefix}
+
+    @staticmethod
+    def from_trends(trends):
+        """ Builds an index over a list of TrendLines. """
+        lengths = [len(trend) for trend in trends]
+        offsets = np.zeros(len(trends) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        features = np.concatenate([trend.features for trend in trends] +
+                                  [np.zeros((0, 3), dtype=np.int64)])
+        labels = [trend.trending() for trend in trends]
+        return TrendIndex(features, offsets, labels)
+
+    @staticmethod
+    def from_arrays(arrays):
+        """ Builds or restores the index of a model from its file arrays. """
+        offsets = arrays['offsets']
+        labels = np.zeros(len(offsets) - 1, dtype=bool)
+        starts = offsets[:-1]
+        nonempty = np.diff(offsets) > 0
+        if nonempty.any():
+            labels[nonempty] = np.logical_or.reduceat(
+                arrays['trend_mask'], starts[nonempty])
+        return TrendIndex(arrays['features'], offsets, labels,
+                          arrays.get('index_mins'), arrays.get('index_maxs'),
+                          arrays.get('index_prefix'))
+
+    def envelope_bounds(self, query, weights):
+        """ The envelope lower bound on the distance from query to each line.
+        """
+        n = len(query)
+        lengths = self.lengths
+        bounds = np.zeros(len(self))
+        if n == 0:
+            return bounds
+
+        # Lines the query slides along: the query's cells outside each line's
+        # box, summed in O(log n) per line from the sorted query
+        longer = lengths >= n
+        for f in range(3):
+            values = np.sort(query[:, f])
+            prefix = np.concatenate(([0], np.cumsum(values)))
+            maxs = self.maxs[longer, f]
+            mins = self.mins[longer, f]
+            above = np.searchsorted(values, maxs, side='right')
+            below = np.searchsorted(values, mins, side='left')
+            outside = prefix[n] - prefix[above] - (n - above) * maxs + \
+                below * mins - prefix[below]
+            bounds[longer] += weights[f] * outside
+
+        # Lines that slide along the query: each of their cells is at least
+        # as far from the query's box as their own box is
+        shorter = lengths < n
+        gaps = np.maximum(self.mins[shorter] - query.max(axis=0), 0) + \
+            np.maximum(query.min(axis=0) - self.maxs[shorter], 0)
+        bounds[shorter] = lengths[shorter] * (gaps @ weights)
+        return bounds
+
+    def sum_bounds(self, query, weights, rows, segments=1):
+        """ The sum lower bound on the distance from query to some lines.
+
+        The shorter of the two lines is cut into up to segments pieces, and
+        at each alignment the sum of each piece is compared with the sum of
+        the stretch of the longer line it is lined up with.
+        """
+        n = len(query)
+        lengths = self.lengths
+        bounds = np.zeros(len(rows))
+        if n == 0:
+            return bounds
+        query_prefix = np.concatenate((np.zeros((1, 3)),
+                                       np.cumsum(query, axis=0)))
+
+        # Every window of length n of the lines the query slides along
+        longer = np.flatnonzero(lengths[rows] >= n)
+        if len(longer):
+            cuts = segment_cuts(n, segments)
+            pieces = query_prefix[cuts[1:]] - query_prefix[cuts[:-1]]
+            windows = lengths[rows[longer]] - n + 1
+            starts = np.zeros(len(longer), dtype=np.int64)
+            np.cumsum(windows[:-1], out=starts[1:])
+            first = np.repeat(self.prefix_starts[rows[longer]] - starts,
+                              windows) + np.arange(windows.sum())
+            costs = np.zeros(len(first))
+            for p in range(len(pieces)):
+                sums = self.prefix[first + cuts[p + 1]] - \
+                    self.prefix[first + cuts[p]]
+                costs += np.abs(sums - pieces[p]) @ weights
+            bounds[longer] = _segment_min(costs, starts)
+
+        # Every window of the query as long as a shorter line
+        shorter = np.flatnonzero((lengths[rows] < n) & (lengths[rows] > 0))
+        if len(shorter):
+            shorter_lengths = lengths[rows[shorter]]
+            line_starts = self.prefix_starts[rows[shorter]]
+            for m in np.unique(shorter_lengths):
+                group = shorter_lengths == m
+                cuts = segment_cuts(m, segments)
+                costs = np.zeros((group.sum(), n - m + 1))
+                for p in range(len(cuts) - 1):
+                    pieces = self.prefix[line_starts[group] + cuts[p + 1]] - \
+                        self.prefix[line_starts[group] + cuts[p]]
+                    sums = query_prefix[cuts[p + 1]:][:n - m + 1] - \
+                        query_prefix[cuts[p]:][:n - m + 1]
+                    costs += np.abs(pieces[:, None] - sums[None]) @ weights
+                bounds[shorter[group]] = costs.min(axis=1)
+        return bounds
+
+    def lower_bounds(self, query, weights):
+        """ A lower bound on the distance from query to every line. """
+        query = np.asarray(query, dtype=np.float64).reshape(-1, 3)
+        weights = np.asarray(weights, dtype=np.float64)
+        bounds = self.envelope_bounds(query, weights)
+        for segments in SEGMENTS:
+            bounds = np.maximum(bounds, self.sum_bounds(
+                query, weights, np.arange(len(self)), segments))
+        return bounds
+
+    def block(self, rows):
+        """ The zero-padded feature block of some lines, for scoring. """
+        lengths = self.lengths[rows]
+        width = np.arange(int(lengths.max(initial=0)))
+        inside = width[None] < lengths[:, None]
+        cells = np.where(inside, self.offsets[rows, None] + width[None], 0)
+        block = self.cells[cells] if len(self.cells) else \
+            np.zeros(cells.shape + (3,))
+        block[~inside] = 0
+        return block, lengths
+
+    def kneighbors(self, query, weights, k=1, exclude=None, norm='l1'):
+        """ The k lines nearest to query, as (indices, distances).
+
+        Lines are visited in order of their envelope bound, in batches. Once
+        k lines have been scored, a batch is first cut down to the lines
+        whose sum bounds, from coarse to fine, could still beat the k-th
+        best, and only those are scored exactly.
+
+        Ties are broken in favour of the lower index, as a brute-force scan
+        keeping the first strict minimum would. exclude is an optional index
+        to leave out, e.g. the query's own line.
+
+        The bounds hold for the default 'l1' norm only. Under 'l2' (see
+        twittp.distance) every line is scored, still in batches.
+        """
+        query = np.asarray(query, dtype=np.float64).reshape(1, -1, 3)
+        return self._search(query, weights, k, exclude, norm)[0]
+
+    def kneighbors_batch(self, queries, weights, k=1, norm='l1'):
+        """ kneighbors for each of a list of queries, searched together.
+
+        Queries of the same length are searched as a group: lines are
+        visited in order of their least envelope bound for any query of the
+        group, each query prunes a batch with its own bounds as kneighbors
+        does, and the lines any of them still needs are scored against the
+        whole group in one pass (see twittp.distance.multi_alignment_distance).
+        The result for each query is exactly what kneighbors gives.
+        """
+        queries = [np.asarray(query, dtype=np.float64).reshape(-1, 3)
+                   for query in queries]
+        groups = {}
+        for i, query in enumerate(queries):
+            groups.setdefault(len(query), []).append(i)
+        results = [None] * len(queries)
+        for members in groups.values():
+            group = np.stack([queries[i] for i in members])
+            for i, result in zip(members, self._search(group, weights, k,
+                                                       None, norm)):
+                results[i] = result
+        return results
+
+    def _search(self, queries, weights, k, exclude, norm):
+        """ The search of kneighbors for a (q, n, 3) group of queries. """
+        distance = multi_distance(norm)
+        weights = np.asarray(weights, dtype=np.float64)
+        q = len(queries)
+        if norm == 'l1':
+            bounds = np.array([self.envelope_bounds(query, weights)
+                               for query in queries]).reshape(q, len(self))
+        else:
+            bounds = np.zeros((q, len(self)))
+        least = bounds.min(axis=0, initial=np.inf)
+        order = np.argsort(least, kind='stable')
+        if exclude is not None:
+            order = order[order != exclude]
+        k = min(k, len(order))
+
+        best_indices = [np.zeros(0, dtype=np.int64)] * q
+        best_distances = [np.zeros(0)] * q
+        lo = 0
+        batch = CANDIDATE_BATCH
+        while lo < len(order) and k > 0:
+            full = all(len(indices) == k for indices in best_indices)
+            if full:
+                kth = np.array([distances[-1]
+                                for distances in best_distances])
+                if least[order[lo]] > kth.max():
+                    break
+            rows = order[lo:lo + batch]
+            lo += batch
+            batch = min(2 * batch, MAXIMUM_BATCH)
+            if full and norm == 'l1':
+                needed = np.zeros(len(rows), dtype=bool)
+                for j, query in enumerate(queries):
+                    kept = np.flatnonzero(bounds[j, rows] <= kth[j])
+                    for segments in SEGMENTS:
+                        tighter = self.sum_bounds(query, weights, rows[kept],
+                                                  segments)
+                        kept = kept[tighter <= kth[j]]
+                    needed[kept] = True
+                rows = rows[needed]
+            if not len(rows):
+                continue
+
+            block, lengths = self.block(rows)
+            distances = distance(queries, block, lengths, weights)
+            for j in range(q):
+                indices = np.concatenate((best_indices[j], rows))
+                scores = np.concatenate((best_distances[j], distances[j]))
+                keep = np.lexsort((indices, scores))[:k]
+                best_indices[j] = indices[keep]
+                best_distances[j] = scores[keep]
+        return list(zip(best_indices, best_distances))
+
+    def predict(self, query, weights, k=1, exclude=None, norm='l1'):
+        """ Predicts whether query will trend by a vote of its k neighbors.
+
+        Ties in the vote go to the nearest neighbor. Returns the prediction
+        along with the indices and distances of the neighbors.
+        """
+        indices, distances = self.kneighbors(query, weights, k, exclude,
+                                             norm)
+        return self.vote(indices), indices, distances
+
+    def predict_batch(self, queries, weights, k=1, norm='l1'):
+        """ predict for each of a list of queries; see kneighbors_batch.
+        """
+        return [(self.vote(indices), indices, distances) for indices, distances
+                in self.kneighbors_batch(queries, weights, k, norm)]
+
+    def vote(self, indices):
+        """ Whether most of the given lines trend, the first on a tie. """
+        votes = self.labels[indices]
+        trending = votes.sum() * 2 > len(votes) or \
+            (votes.sum() * 2 == len(votes) and len(votes) and bool(votes[0]))
+        return bool(trending)
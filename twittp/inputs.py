@@ -0,0 +1,124 @@
+import bz2
+import gzip
+import lzma
+import queue
+import threading
+
+
+# Bytes read (and, for compressed files, decompressed) at a time
+BLOCK_SIZE = 1 << 20
+
+# Decompressed blocks a background thread may read ahead of the parser
+READAHEAD = 4
+
+# The leading bytes of each compression format that can be read
+MAGIC = ((b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'))
+
+OPENERS = {'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+
+
+def compression(path):
+    """ The compression format of a file, by its magic bytes, or None. """
+    with open(path, 'rb') as f:
+        head = f.read(max(len(magic) for magic, _ in MAGIC))
+    for magic, name in MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def open_input(path):
+    """ Opens a file for reading in binary, decompressing it if need be. """
+    name = compression(path)
+    if name is None:
+        return open(path, 'rb')
+    return OPENERS[name](path, 'rb')
+
+
+class Readahead:
+    """ Reads blocks of a file object in a background thread.
+
+    The blocks are handed over through a queue of at most depth blocks, so
+    the reader stays a bounded distance ahead of the consumer. The zlib,
+    bz2 and lzma decompressors release the GIL, so decompressing in the
+    thread overlaps with parsing in the consumer. An error in the thread is
+    raised in the consumer once it reaches that point of the file.
+    """
+
+    def __init__(self, f, block_size=BLOCK_SIZE, depth=READAHEAD):
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run,
+                                       args=(f, block_size), daemon=True)
+        self.thread.start()
+
+    def _run(self, f, block_size):
+        try:
+            while not self.stopped.is_set():
+                block = f.read(block_size)
+                self._put(block)
+                if not block:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        # Time out now and then to notice being closed by the consumer
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        while True:
+            block = self.queue.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                return
+            yield block
+
+    def close(self):
+        """ Stops the thread, e.g. when the consumer stops early. """
+        self.stopped.set()
+        self.thread.join()
+
+
+def read_blocks(path, block_size=BLOCK_SIZE, readahead=READAHEAD):
+    """ Yields the (decompressed) content of a file in blocks of bytes.
+
+    Compressed files are decompressed by a Readahead thread; plain files
+    are read directly, since there is nothing to overlap.
+    """
+    name = compression(path)
+    if name is None:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                yield block
+        return
+    with OPENERS[name](path, 'rb') as f:
+        reader = Readahead(f, block_size, readahead)
+        try:
+            for block in reader:
+                yield block
+        finally:
+            reader.close()
+
+
+def read_lines(path, block_size=BLOCK_SIZE, readahead=READAHEAD):
+    """ Yields the lines of a file as bytes, without their newlines.
+
+    This is the input layer for every file of Tweets, trends or stopwords:
+    the file is read in large blocks (see read_blocks), which are split
+    into lines, whether or not it is compressed. A last line without a
+    newline is yielded as well.
+    """
+    pending = b''
+    for block in read_blocks(path, block_size, readahead):
+        lines = (pending + block).split(b'\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
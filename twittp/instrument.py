@@ -0,0 +1,131 @@
+from contextlib import contextmanager
+import sys
+import time
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def peak_rss_kb():
+    """ The peak resident set size of this process and its children in KB.
+
+    Returns None where the resource module is not available.
+    """
+    if resource is None:
+        return None
+    scale = 1024 if sys.platform == 'darwin' else 1  # macOS reports bytes
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale
+    return max(own, children)
+
+
+class NullInstrument:
+    """ An instrument that records nothing.
+
+    This is what the pipeline uses unless asked to profile. Its methods do
+    nothing and track() hands back the iterable it is given, so leaving
+    instrumentation in the code costs nothing when it is disabled.
+    """
+    enabled = False
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def count(self, name, n=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def track(self, stage, iterable, total=None):
+        return iterable
+
+    def progress(self, stage, done, total=None, started=None, force=False):
+        pass
+
+
+NULL_INSTRUMENT = NullInstrument()
+
+
+class Instrument(NullInstrument):
+    """ Records how long each stage of a run takes and counts its work.
+
+    Stages are timed with the stage() context manager, and the peak RSS is
+    sampled as each one ends. Counters are added to with count() and
+    arbitrary figures recorded with set(). If a progress callback is given,
+    it is called as callback(stage, done, total, rate) at most every
+    progress_interval seconds from long-running loops.
+    """
+    enabled = True
+
+    def __init__(self, progress=None, progress_interval=1.0):
+        self.callback = progress
+        self.progress_interval = progress_interval
+        self.stages = {}
+        self.counters = {}
+        self.values = {}
+        self.started = time.perf_counter()
+        self.last_progress = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            stage = self.stages.setdefault(name, {'seconds': 0.0,
+                                                  'calls': 0})
+            stage['seconds'] += elapsed
+            stage['calls'] += 1
+            stage['peak_rss_kb'] = peak_rss_kb()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def track(self, stage, iterable, total=None):
+        """ Yields from iterable, reporting progress as items go by. """
+        started = time.perf_counter()
+        done = 0
+        for item in iterable:
+            yield item
+            done += 1
+            if self.callback is not None and done % 1024 == 0:
+                self.progress(stage, done, total, started)
+        if self.callback is not None:
+            self.progress(stage, done, total, started, force=True)
+
+    def progress(self, stage, done, total=None, started=None, force=False):
+        """ Calls the progress callback unless it was called too recently.
+        """
+        if self.callback is None:
+            return
+        now = time.perf_counter()
+        if not force and \
+                now - self.last_progress.get(stage, 0) < self.progress_interval:
+            return
+        self.last_progress[stage] = now
+        elapsed = now - (self.started if started is None else started)
+        rate = done / elapsed if elapsed > 0 else 0.0
+        self.callback(stage, done, total, rate)
+
+    def report(self):
+        """ A JSON-friendly summary of everything recorded. """
+        return {'seconds': time.perf_counter() - self.started,
+                'peak_rss_kb': peak_rss_kb(),
+                'stages': self.stages, 'counters': self.counters,
+                'values': self.values}
+
+
+def print_progress(stage, done, total, rate):
+    """ A progress callback writing one line per update to stderr. """
+    if total:
+        print('%s: %d/%d (%.0f/s)' % (stage, done, total, rate),
+              file=sys.stderr)
+    else:
+        print('%s: %d (%.0f/s)' % (stage, done, rate), file=sys.stderr)
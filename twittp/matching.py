@@ -0,0 +1,71 @@
+from bisect import bisect_left, bisect_right
+from .vocab import tokenize
+
+
+class TrendMatcher:
+    """ Finds the TrendLines a tweet counts towards.
+
+    A tweet counts towards a trend if it was posted while the trend is
+    active (start_ts <= ts < end) and one of the words of the trend's name
+    appears in the tweet. Rather than checking every trend for every tweet,
+    the matcher keeps an inverted index from each name word to the trends
+    containing it. The trends under each word are sorted by start time
+    along with the longest duration among them, so for a given timestamp
+    only the trends that started within that duration have to be looked at.
+    """
+
+    def __init__(self, trends, names=None):
+        """ Builds the index for a list of TrendLines.
+
+        By default, the words of a trend are tokenize(name), matching
+        TrendLine.match_text. names can be given instead as a list with the
+        tokens of each trend, e.g. to match on token ids rather than strings.
+        """
+        self.trends = trends
+        if names is None:
+            names = [tokenize(trend.name) for trend in trends]
+
+        postings = {}
+        for i, tokens in enumerate(names):
+            for token in set(tokens):
+                postings.setdefault(token, []).append(i)
+
+        self.index = {}
+        for token, indices in postings.items():
+            indices.sort(key=lambda i: trends[i].start_ts)
+            starts = [trends[i].start_ts for i in indices]
+            ends = [trends[i].start_ts + trends[i].window_size *
+                    len(trends[i]) for i in indices]
+            longest = max(end - start for start, end in zip(starts, ends))
+            self.index[token] = (starts, ends, indices, longest)
+
+    def match(self, ts, words):
+        """ Returns the set of indices of trends matched by a tweet. """
+        matched = set()
+        for word in set(words):
+            entry = self.index.get(word)
+            if entry is None:
+                continue
+            starts, ends, indices, longest = entry
+            lo = bisect_left(starts, ts - longest)
+            hi = bisect_right(starts, ts)
+            for k in range(lo, hi):
+                if ts < ends[k]:
+                    matched.add(indices[k])
+        return matched
+
+    def new_counts(self):
+        """ Returns a zeroed list of per-window counts for every trend. """
+        return [[0] * len(trend) for trend in self.trends]
+
+    def count(self, counts, ts, words):
+        """ Adds one tweet to counts, as returned by new_counts. """
+        trends = self.trends
+        for i in self.match(ts, words):
+            trend = trends[i]
+            counts[i][(ts - trend.start_ts) // trend.window_size] += 1
+
+    def apply_counts(self, counts):
+        """ Adds counts into the count column of the matched trends. """
+        for trend, trend_counts in zip(self.trends, counts):
+            trend.counts[:] += trend_counts
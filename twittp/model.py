@@ -1,54 +1,51 @@
-from datetime import datetime, timedelta, timezone
 import math
+import numbers
 import numpy as np
+import os
 import random
 import simplejson as json
 from scipy.sparse import csr_matrix
-from .twitter import BagOfWords, Stopwords, TwitterTrend
+import tempfile
+from . import dtw
+from .cache import BuildCache
+from .distance import (CHUNK_ELEMENTS, DISTANCES, batch_distance,
+                       batch_squared_alignment_distance)
+from .features import (BLOCK_SECONDS, PART_ROWS, FeatureStore, extent_block,
+                       load_sparse_matrix, row_extents, save_sparse_matrix,
+                       trend_rows)
+from .index import TrendIndex
+from .inputs import compression
+from .instrument import NULL_INSTRUMENT
+from .matching import TrendMatcher
+from .modelfile import (LazyTrendList, is_model_file, read_arrays,
+                        trend_arrays, write_arrays)
+from .pairwise import nearest_neighbors, pairwise_distances
+from .pyramid import (COARSE_FACTOR, CANDIDATES, coarse_features,
+                      coarse_to_fine_distance, coarse_to_fine_neighbors,
+                      prefix_sums, window_sums)
+from .shards import ShardedTweets
+from .store import TweetStore
+from .tuning import DEFAULT_GRID, AlignmentCosts
+from .twitter import (BagOfWords, Stopwords, TrendReader, TwitterTrend,
+                      read_tweets)
+from .vocab import Vocabulary, tokenize
 
 
 TREND_PREEMT = 0  # Number of windows to preempt trends by
 MINIMUM_TREND_SIZE = 15  # Shortest positive trend to allow
+CELL_KEYS = ('count', 'delta', 'delta_delta', 'trending')  # Of TrendCell
 
 
-def dtw_distance(a, b):
+def dtw_distance(a, b, window=None):
     """ Function to compute the Dynamic-Time Warp Distance between arrays.
 
-    This takes two numpy arrays and computes the DTW distance according to
-    http://en.wikipedia.org/wiki/Dynamic_time_warping
+    This takes two numpy arrays of features (c_t1, d_t1, dd_t1, ..., either
+    flat or as (n, 3)) and computes the DTW distance according to
+    http://en.wikipedia.org/wiki/Dynamic_time_warping using the TrendCell
+    weights. window optionally limits the warping to a Sakoe-Chiba band; see
+    twittp.dtw.
     """
-    n = a.size // 3
-    m = b.size // 3  # Each point in time takes three columns
-
-    dtw = np.zeros((n, m), dtype=np.object)
-    dtw[0][0] = 0
-
-    for i in range(n):
-        if i == 0:
-            continue
-        j = 0
-        cost = TrendCell.count_weight * math.fabs(a[3 * i] - b[3 * j])
-        cost += TrendCell.delta_weight * math.fabs(a[3 * i + 1] - b[3 * j + 1])
-        cost += TrendCell.delta_delta_weight * math.fabs(a[3 * i + 2] - b[3 * j + 2])
-        dtw[i][j] = cost + dtw[i - 1][j]
-
-    for j in range(n):
-        if j == 0:
-            continue
-        i = 0
-        cost = TrendCell.count_weight * math.fabs(a[3 * i] - b[3 * j])
-        cost += TrendCell.delta_weight * math.fabs(a[3 * i + 1] - b[3 * j + 1])
-        cost += TrendCell.delta_delta_weight * math.fabs(a[3 * i + 2] - b[3 * j + 2])
-        dtw[i][j] = cost + dtw[i][j - 1]
-
-    for i in range(n):
-        for j in range(m):
-            cost = TrendCell.count_weight * ((a[3 * i] - b[3 * j]) ** 2)
-            cost += TrendCell.delta_weight * ((a[3 * i + 1] - b[3 * j + 1]) ** 2)
-            cost += TrendCell.delta_delta_weight * ((a[3 * i + 2] - b[3 * j + 2]) ** 2)
-
-            dtw[i][j] = cost + min(dtw[i - 1][j], dtw[i][j - 1], dtw[i - 1][j - 1])
-    return dtw[n - 1][m - 1]
+    return dtw.dtw_distance(a, b, TrendCell.weights(), window=window)
 
 
 def array_trend_distance(a, b):
@@ -57,81 +54,144 @@ def array_trend_distance(a, b):
     This takes two numpy arrays of features like c_t1, d_t1, dd_t1, ..., c_tn,
     d_tn, dd_tn, which should be very sparse, and finds the alignment that
     minimizes euclidean distance and returns the distance of that alignment.
+    Each array is cut down to the windows from its first to its last nonzero
+    feature, and the shorter of these is slid along the longer one a window
+    at a time. The features are not weighted. If either array is all zeros,
+    the distance is 0. See batch_array_trend_distance.
     """
-    if len(a) > len(b):
-        return array_trend_distance(b, a)
-
-    # Since a and b are likely sparse, let's just get the non-zeroes
-    start_a = None
-    end_a = 0
-    start_b = None
-    end_b = 0
-    for x in range(len(a)):
-        if a[x] != 0:
-            end_a = x
-            if start_a is None:
-                start_a = x
-        if b[x] != 0:
-            end_b = x
-            if start_b is None:
-                start_b = x
-    len_a = end_a - start_a + 1
-    len_b = end_b - start_b + 1
-
-    if start_a is None or start_b is None:
-        return 0
-
-    min_distance = None
-
-    for offset in range(len_b - len_a + 1):
-        total = 0
-        for i in range(len(a)):
-            total += math.sqrt(a[start_a + i] - b[start_b + offset + i])
+    b = csr_matrix(np.asarray(b, dtype=np.float64).reshape(1, -1))
+    return float(batch_array_trend_distance(a, b)[0])
+
 
-        if min_distance is None:
-            min_distance = total
-        elif min_distance > total:
-            min_distance = total
+def batch_array_trend_distance(query, matrix):
+    """ The array_trend_distance from a query row to every row of a matrix.
 
-    return min_distance
+    The matrix is a CSR feature matrix such as TrendModel.sparse_matrix
+    returns, and query a row in the same layout, either dense or sparse.
+    The extent of each row is found from the indptr and indices arrays, and
+    the rows are scored in chunks that are only densified over their
+    extents. All the alignments of a chunk are scored at once, by FFT; see
+    twittp.distance.batch_squared_alignment_distance.
+    """
+    if not hasattr(query, 'tocsr'):
+        query = np.asarray(query, dtype=np.float64).reshape(1, -1)
+    query = csr_matrix(query)
+    query_start, query_end = row_extents(query)
+    query_block, _ = extent_block(query, [0], query_start, query_end)
+    query_block = query_block[0]
+
+    matrix = csr_matrix(matrix)
+    starts, ends = row_extents(matrix)
+    lengths = ends - starts
+    weights = np.ones(3)
+    distances = np.zeros(matrix.shape[0], dtype=np.float64)
+    longest = max(1, int(lengths.max(initial=0)))
+    step = max(1, CHUNK_ELEMENTS // (3 * longest))
+    for lo in range(0, matrix.shape[0], step):
+        rows = np.arange(lo, min(lo + step, matrix.shape[0]))
+        block, block_lengths = extent_block(matrix, rows, starts, ends)
+        distances[rows] = batch_squared_alignment_distance(
+            query_block, block, block_lengths, weights)
+    return np.sqrt(distances)
 
 
 class TrendModel:
     """ Represents all of the Trends that compose a "model" in twittp. """
 
-    def __init__(self, trends=None):
+    def __init__(self, trends=None, norm='l1'):
         """ Constructor for TrendModel.
 
         A TrendModel can be loosely reasoned about as a list of different
         TrendLines, some positive, some negative. The constructor reflects
-        this.
+        this. norm selects how aligned cells are compared by the distances
+        of the model: 'l1' for the weighted sum of absolute differences, or
+        'l2' for the weighted sum of squared differences, which is computed
+        by FFT and is much faster on long lines; see twittp.distance.
         """
+        batch_distance(norm)
         self.trends = [] if trends is None else trends
+        self.norm = norm
+        self.trend_index = None
 
-    def leave_one_out(self):
+    def distance_matrix(self, workers=None, cache_dir=None):
+        """ The matrix of distances between every pair of trends.
+
+        See twittp.pairwise.pairwise_distances for workers and cache_dir.
+        """
+        return pairwise_distances(self.trends, TrendCell.weights(),
+                                  workers=workers, cache_dir=cache_dir,
+                                  norm=self.norm)
+
+    def leave_one_out(self, workers=None, cache_dir=None, metric='alignment',
+                      window=None, instrument=None, factor=COARSE_FACTOR,
+                      candidates=CANDIDATES):
         """ Computes the leave-one-out accuracy of the model.
 
-        In the future, this may tune TopicCell weights until this is optimum.
-        For now, it just computes it.
+        This uses the current TrendCell weights; see tune_weights to search
+        for better ones. With the default 'alignment' metric, each trend is
+        matched with its nearest other trend using the distance matrix of the
+        model, so workers and cache_dir are passed on to distance_matrix.
+        With the 'dtw' metric, the match is found by a nearest-neighbor search
+        under DTW (optionally banded by window) that prunes candidates with
+        lower bounds. The 'coarse' metric searches coarse to fine: the
+        distance matrix of the trends coarsened by factor is computed first,
+        and only the candidates nearest trends under it are compared at full
+        resolution (see twittp.pyramid); it is only available for models
+        with the 'l1' norm. Pass an Instrument to time the stages and report
+        progress.
         """
+        if instrument is None:
+            instrument = NULL_INSTRUMENT
+        order = range(len(self.trends))
+
+        if metric == 'alignment':
+            with instrument.stage('distance_matrix'):
+                distances = self.distance_matrix(workers=workers,
+                                                 cache_dir=cache_dir)
+
+            def nearest(i):
+                return nearest_neighbors(distances, i)[0]
+        elif metric == 'dtw':
+            features = [trend.features for trend in self.trends]
+            weights = TrendCell.weights()
+            # Envelopes depend on the query length, so the queries are taken
+            # by length and only the envelopes of one length are kept
+            order = sorted(order, key=lambda i: len(features[i]))
+            envelopes = {}
+
+            def nearest(i):
+                length = len(features[i]) if window is not None else None
+                if envelopes and next(iter(envelopes))[1] != length:
+                    envelopes.clear()
+                return dtw.dtw_nearest(features[i], features, weights,
+                                       window=window, exclude=i,
+                                       envelopes=envelopes)[0]
+        elif metric == 'coarse':
+            if self.norm != 'l1':
+                raise ValueError('The coarse metric needs the l1 norm')
+            with instrument.stage('coarse_neighbors'):
+                trends = list(self.trends)
+                coarse = [trend.coarsen(factor) for trend in trends]
+                coarse_neighbors = coarse_to_fine_neighbors(
+                    trends, coarse, TrendCell.weights(), candidates,
+                    workers=workers, cache_dir=cache_dir)
+
+            def nearest(i):
+                return coarse_neighbors[i]
+        else:
+            raise ValueError('Unknown metric: %s' % metric)
+
         total = 0
         matches = 0
 
-        for trend_a in self.trends:
-            match = None
-            min_distance = None
-
-            for trend_b in self.trends:
-                if trend_a == trend_b:
-                    continue
-                dist = trend_a.distance(trend_b)
-                if match is None:
-                    match = trend_b
-                    min_distance = dist
-                else:
-                    if dist < min_distance:
-                        match = trend_b
-                        min_distance = dist
+        with instrument.stage('nearest_neighbors'):
+            neighbors = [None] * len(self.trends)
+            for i in instrument.track('nearest_neighbors', order,
+                                      len(self.trends)):
+                neighbors[i] = nearest(i)
+
+        for i, trend_a in enumerate(self.trends):
+            match = self.trends[neighbors[i]]
 
             a_trend = trend_a.trending()
             match_trend = match.trending()
@@ -141,35 +201,248 @@ class TrendModel:
 
         return matches / total
 
+    def tune_weights(self, search='coordinate', grid=None, instrument=None):
+        """ Searches for the TrendCell weights with the best leave-one-out
+        accuracy under the alignment metric.
+
+        The per-feature alignment costs of every pair of trends are computed
+        once (see twittp.tuning.AlignmentCosts), after which each weight
+        vector tried costs a dot product and a minimum per pair. search is
+        'coordinate' for coordinate descent from the current weights or
+        'grid' for a grid search over grid (or DEFAULT_GRID). Returns
+        (accuracy, weights); the TrendCell weights are left as they are.
+        Only models with the 'l1' norm can be tuned.
+        """
+        if instrument is None:
+            instrument = NULL_INSTRUMENT
+        if self.norm != 'l1':
+            raise ValueError('Weights can only be tuned under the l1 norm')
+        with instrument.stage('alignment_costs'):
+            costs = AlignmentCosts.from_trends(list(self.trends), instrument)
+        with instrument.stage('search'):
+            if search == 'coordinate':
+                return costs.coordinate_descent(TrendCell.weights(),
+                                                instrument=instrument)
+            elif search == 'grid':
+                return costs.grid_search(
+                    DEFAULT_GRID if grid is None else grid, instrument)
+            raise ValueError('Unknown search: %s' % search)
+
+    def index(self):
+        """ The nearest-neighbor index over the trends of the model.
+
+        It is built the first time it is needed, and saved along with binary
+        models so that loading one does not rebuild it. Call build_index()
+        after changing the trends of a model.
+        """
+        if self.trend_index is None:
+            self.build_index()
+        return self.trend_index
+
+    def build_index(self):
+        """ (Re)builds the nearest-neighbor index of the model. """
+        if isinstance(self.trends, LazyTrendList):
+            self.trend_index = TrendIndex.from_arrays(self.trends.arrays)
+        else:
+            self.trend_index = TrendIndex.from_trends(self.trends)
+        return self.trend_index
+
+    def kneighbors(self, trend, k=1):
+        """ Finds the k trends of the model nearest to a trend.
+
+        trend is a TrendLine or an array of its features. Returns the indices
+        of the neighbors in self.trends and their distances, nearest first.
+        The search is exact, but uses the index to avoid comparing the trend
+        with most of the model.
+        """
+        features = getattr(trend, 'features', trend)
+        return self.index().kneighbors(features, TrendCell.weights(), k,
+                                       norm=self.norm)
+
+    def predict(self, trend, k=1):
+        """ Predicts whether a trend will trend on Twitter.
+
+        This is a vote of its k nearest trends in the model (see kneighbors),
+        with a tie going to the nearest. Returns (trending, indices,
+        distances).
+        """
+        features = getattr(trend, 'features', trend)
+        return self.index().predict(features, TrendCell.weights(), k,
+                                    norm=self.norm)
+
+    def predict_batch(self, trends, k=1):
+        """ predict for each of a list of trends, searched together.
+
+        Trends of the same length share one pass over the index; see
+        TrendIndex.kneighbors_batch. The results are the same as calling
+        predict on each.
+        """
+        features = [getattr(trend, 'features', trend) for trend in trends]
+        return self.index().predict_batch(features, TrendCell.weights(), k,
+                                          norm=self.norm)
+
     def serialize(self):
         """ Return a string encoding of the model. """
         return json.dumps(self, cls=TwitTPEncoder, ensure_ascii=False)
 
-    def sparse_matrix(self):
+    def to_obj(self):
+        """ Returns a JSON-friendly dict of this TrendModel. """
+        return {'trends': list(self.trends), 'norm': self.norm}
+
+    def save(self, path, format='binary'):
+        """ Writes the model to path, by default in the binary format.
+
+        The binary format stores the cells of every trend in flat arrays
+        (see twittp.modelfile), along with the nearest-neighbor index, and
+        loads by memory-mapping. The 'json' format is the serialize()
+        encoding, for interchange.
+        """
+        if format == 'binary':
+            arrays = trend_arrays(self.trends)
+            arrays.update(self.index().arrays())
+            write_arrays(path, arrays, meta={'norm': self.norm})
+        elif format == 'json':
+            with open(path, 'w') as f:
+                f.write(self.serialize())
+        else:
+            raise ValueError('Unknown model format: %s' % format)
+
+    @staticmethod
+    def load(path):
+        """ Loads a model written by save in either format.
+
+        Binary models are memory-mapped and their TrendLines are only built
+        as they are accessed.
+        """
+        if is_model_file(path):
+            arrays, meta = read_arrays(path)
+            model = TrendModel(trends=LazyTrendList(arrays,
+                                                    TrendLine.from_arrays),
+                               norm=meta.get('norm', 'l1'))
+            if 'index_prefix' in arrays:
+                model.trend_index = TrendIndex.from_arrays(arrays)
+            return model
+        with open(path) as f:
+            return TrendModel.from_obj(json.load(f))
+
+    def time_span(self):
+        """ The first and last timestamp covered by any trend of the model. """
         start_t = min([trend.start_ts for trend in self.trends])
-        end_t = max([trend.start_ts + trend.window_size * len(trend.data) for trend in self.trends])
-        width = ((end_t - start_t) // self.trends[0].window_size) * 3
-        y = []
-        m = csr_matrix((len(self.trends), width))
-        for i, trend in enumerate(self.trends):
-            if trend.trending():
-                y.append(1)
-            else:
-                y.append(0)
-            offset = ((trend.start_ts - start_t) // trend.window_size) * 3
-            for j, datum in enumerate(trend.data):
-                m[i, offset + j * 3:offset + (j + 1) * 3] = datum.count, datum.delta, datum.delta_delta
+        end_t = max([trend.start_ts + trend.window_size * len(trend)
+                     for trend in self.trends])
+        return start_t, end_t
+
+    def sparse_matrix(self):
+        """ Returns the trends as a sparse feature matrix and their labels.
+
+        Each row is a trend, with three columns (count, delta, delta_delta)
+        per window of the time span of the whole model. The label is 1 for
+        trends that trend on Twitter and 0 for the others.
+        """
+        start_t, end_t = self.time_span()
+        window_size = self.trends[0].window_size
+        width = ((end_t - start_t) // window_size) * 3
+        y = [1 if trend.trending() else 0 for trend in self.trends]
+        data, indices, indptr = trend_rows(self.trends, start_t, window_size)
+        m = csr_matrix((data, indices, indptr),
+                       shape=(len(self.trends), width))
         return m, y
 
+    def save_sparse_matrix(self, path):
+        """ Writes sparse_matrix() to a directory for load_sparse_matrix. """
+        m, y = self.sparse_matrix()
+        save_sparse_matrix(path, m, y, self.time_span()[0],
+                           self.trends[0].window_size)
+
+    def save_feature_store(self, path, block_seconds=BLOCK_SECONDS,
+                           part_rows=PART_ROWS):
+        """ Writes the trends to a time-partitioned FeatureStore.
+
+        Each row is measured from the start of its own trend rather than of
+        the whole model, and the trends are written out a part at a time,
+        so a memory-mapped binary model never has to be loaded whole.
+        """
+        return FeatureStore.write(self.trends, path, block_seconds, part_rows)
+
+    @staticmethod
+    def feature_store_from_files(trend_file, tweet_file, path,
+                                 stopwords_file=None,
+                                 trend_preempt=TREND_PREEMT,
+                                 block_seconds=BLOCK_SECONDS,
+                                 part_rows=PART_ROWS, instrument=None):
+        """ Builds the trends of model_from_files straight into a
+        FeatureStore at path, without holding the model.
+
+        The positive and negative trends are drawn as in model_from_files,
+        but as TrendSpans, and are then created, populated and written out
+        one block of start times at a time; see TrendLine.populate_by_block.
+        With the same random seed, the rows are those of the model
+        model_from_files builds from a TweetStore. The tweet_file may be a
+        TweetStore directory; a JSON file is first ingested into a scratch
+        store. Returns the opened FeatureStore.
+        """
+        if instrument is None:
+            instrument = NULL_INSTRUMENT
+        with instrument.stage('trends'):
+            twitter_trends = TwitterTrend.from_file(trend_file)
+            positive_spans = [
+                TrendSpan.from_twitter_trend(trend, trend_preempt)
+                for trend in twitter_trends
+                if trend.longest_interval()[1] >= MINIMUM_TREND_SIZE]
+            instrument.count('positive_trends', len(positive_spans))
+
+        with instrument.stage('stopwords'):
+            stopwords = Stopwords() if stopwords_file is None else \
+                Stopwords.from_csv(stopwords_file)
+
+        scratch = None
+        try:
+            if TweetStore.is_store(tweet_file):
+                store = TweetStore.open(tweet_file)
+            else:
+                with instrument.stage('parse_tweets'):
+                    scratch = tempfile.TemporaryDirectory(
+                        prefix='twittp-store-')
+                    store = TweetStore.from_file(tweet_file, scratch.name)
+            with instrument.stage('bag_of_words'):
+                bag_of_words = BagOfWords.from_store(store,
+                                                     stopwords=stopwords)
+
+            with instrument.stage('negative_sampling'):
+                negative_spans = TrendLine.negative_spans(positive_spans,
+                                                          bag_of_words)
+                instrument.count('negative_trends', len(negative_spans))
+
+            with instrument.stage('populate'):
+                return FeatureStore.write(
+                    TrendLine.populate_by_block(
+                        positive_spans + negative_spans, store,
+                        block_seconds),
+                    path, block_seconds, part_rows)
+        finally:
+            if scratch is not None:
+                scratch.cleanup()
+
+    @staticmethod
+    def load_sparse_matrix(path):
+        """ Memory-maps a matrix saved by save_sparse_matrix.
+
+        Returns (matrix, labels, meta), where meta holds the start_ts and
+        window_size the columns are measured from.
+        """
+        return load_sparse_matrix(path)
+
     @staticmethod
     def from_obj(obj):
         if obj.get('trends') is None:
             return None
         trends = [TrendLine.from_obj(trend) for trend in obj['trends']]
-        return TrendModel(trends=trends)
+        return TrendModel(trends=trends, norm=obj.get('norm', 'l1'))
 
     @staticmethod
-    def model_from_files(trend_file, tweet_file, stopwords_file):
+    def model_from_files(trend_file, tweet_file, stopwords_file=None,
+                         trend_preempt=TREND_PREEMT, workers=1,
+                         instrument=None, cache_dir=None):
         """ Constructs a TrendModel from tweets and trends.
 
         This high-level method uses a number of other static methods to build
@@ -177,35 +450,211 @@ class TrendModel:
         the trends from the trends file, creating "positive" trends from that,
         building a bag-of-words model of the tweets, creating "negative" trends
         from the positive trends and bag-of-words, then populating all of these
-        trends with data from the tweets.
+        trends with data from the tweets. The tweet_file may either be a JSON
+        file of tweets or a TweetStore directory made by the ingest command.
+        The JSON files may be compressed; see twittp.inputs. With more than
+        one worker, an uncompressed JSON file is split into shards that are
+        parsed and counted by a pool of processes; see ShardedTweets. Pass an
+        Instrument to time each stage and count the work done.
+
+        With a cache_dir, the build is kept in a BuildCache there and later
+        builds from the same (grown) uncompressed JSON files only read what
+        was appended; see model_from_cache.
         """
+        if instrument is None:
+            instrument = NULL_INSTRUMENT
+        # Shards and the build cache work on byte offsets into the file,
+        # which a compressed file cannot be split or resumed at
+        plain = not TweetStore.is_store(tweet_file) and \
+            compression(tweet_file) is None
+        if cache_dir is not None and plain and compression(trend_file) is None:
+            stopwords = Stopwords() if stopwords_file is None else \
+                Stopwords.from_csv(stopwords_file)
+            params = {'window_size': 120, 'trend_preempt': trend_preempt,
+                      'minimum_trend_size': MINIMUM_TREND_SIZE}
+            cache = BuildCache(cache_dir, trend_file, tweet_file,
+                               stopwords_file, params)
+            return TrendModel.model_from_cache(cache, stopwords,
+                                               trend_preempt, instrument)
+
         # Load the positive trends from the file
-        twitter_trends = TwitterTrend.from_file(trend_file)
-
-        positive_trends = [TrendLine.from_twitter_trend(trend) for trend in
-                           twitter_trends]
-
-        # Remove any short trends
-        positive_trends = [trend for trend in positive_trends if
-                           len(trend.data) >= MINIMUM_TREND_SIZE]
-
-        # Prepend each trend with the TREND_PREEMPT value of TrendCells
-        for trend in positive_trends:
-            preempt_cells = [TrendCell(False) for _ in range(TREND_PREEMT)]
-            preempt_cells.extend(trend.data)
-            trend.data = preempt_cells
-            trend.start_ts = trend.start_ts - (trend.window_size * TREND_PREEMT)
-
-        # Create negative trends using a bag of words model
-        stopwords = Stopwords.from_csv(stopwords_file)
-        bag_of_words = BagOfWords.from_file(tweet_file, stopwords=stopwords)
-        negative_trends = TrendLine.construct_negative_trends(positive_trends,
-                                                              bag_of_words)
-
-        # Merge the trends and populate them using tweet data
-        all_trends = positive_trends
-        all_trends.extend(negative_trends)
-        TrendLine.populate_from_file(all_trends, tweet_file)
+        with instrument.stage('trends'):
+            twitter_trends = TwitterTrend.from_file(trend_file)
+            instrument.count('bytes_read', os.path.getsize(trend_file))
+            instrument.count('twitter_trends', len(twitter_trends))
+
+            positive_trends = [TrendLine.from_twitter_trend(trend) for trend
+                               in twitter_trends]
+
+            # Remove any short trends
+            positive_trends = [trend for trend in positive_trends if
+                               len(trend) >= MINIMUM_TREND_SIZE]
+
+            # Prepend each trend with the TREND_PREEMPT value of TrendCells
+            for trend in positive_trends:
+                trend.preempt(trend_preempt)
+            instrument.count('positive_trends', len(positive_trends))
+
+        with instrument.stage('stopwords'):
+            stopwords = Stopwords() if stopwords_file is None else \
+                Stopwords.from_csv(stopwords_file)
+
+        store = None
+        shards = None
+        try:
+            if TweetStore.is_store(tweet_file):
+                with instrument.stage('bag_of_words'):
+                    store = TweetStore.open(tweet_file)
+                    bag_of_words = BagOfWords.from_store(store,
+                                                         stopwords=stopwords)
+                instrument.count('bytes_read', store.timestamps.nbytes +
+                                 store.tokens.nbytes + store.offsets.nbytes)
+                instrument.count('tweets_parsed', len(store))
+            elif workers > 1 and plain:
+                # Each worker parses its shard of the file into a scratch
+                # TweetStore which the population stage then reads
+                with instrument.stage('bag_of_words'):
+                    shards = ShardedTweets(tweet_file, workers)
+                    bag_of_words = shards.bag_of_words(stopwords=stopwords)
+                instrument.count('bytes_read', os.path.getsize(tweet_file))
+            else:
+                # Parse the tweets once; both the bag of words and the
+                # population of the trends work from these records of
+                # interned word ids
+                vocab = Vocabulary()
+                with instrument.stage('parse_tweets'):
+                    records = list(instrument.track(
+                        'parse_tweets', read_tweets(tweet_file, vocab)))
+                instrument.count('bytes_read', os.path.getsize(tweet_file))
+                instrument.count('tweets_parsed', len(records))
+                instrument.count('tokens', len(vocab))
+                with instrument.stage('bag_of_words'):
+                    bag_of_words = BagOfWords.from_records(records,
+                                                           stopwords=stopwords,
+                                                           vocab=vocab)
+            instrument.count('vocabulary', len(bag_of_words))
+
+            # Create negative trends using the bag of words model
+            with instrument.stage('negative_sampling'):
+                negative_trends = TrendLine.construct_negative_trends(
+                    positive_trends, bag_of_words)
+                instrument.count('negative_trends', len(negative_trends))
+
+            # Merge the trends and populate them using tweet data
+            all_trends = positive_trends
+            all_trends.extend(negative_trends)
+            with instrument.stage('populate'):
+                if store is not None:
+                    TrendLine.populate_from_store(all_trends, store)
+                elif shards is not None:
+                    TrendLine.populate_from_counts(
+                        all_trends, shards.trend_counts(all_trends))
+                else:
+                    TrendLine.populate_from_records(
+                        all_trends, instrument.track('populate', records,
+                                                     len(records)), vocab)
+        finally:
+            # The pool and scratch store must go even if a stage fails
+            if shards is not None:
+                shards.close()
+
+        if instrument.enabled:
+            matches = [int(trend.counts.sum()) for trend in all_trends]
+            instrument.count('matches', sum(matches))
+            instrument.set('matches_per_trend',
+                           {'min': min(matches, default=0),
+                            'mean': sum(matches) / max(1, len(matches)),
+                            'max': max(matches, default=0)})
+        return TrendModel(trends=all_trends)
+
+    @staticmethod
+    def model_from_cache(cache, stopwords, trend_preempt=TREND_PREEMT,
+                         instrument=None):
+        """ Builds a TrendModel incrementally through a BuildCache.
+
+        Only the trend snapshots and Tweets appended since the last build
+        are parsed; the Tweets are added to the TweetStore of the cache. The
+        negative trends drawn before are kept (minus any that have since
+        become positive trends), and more are only drawn to keep one per
+        positive trend. A trend the last build had with the same name, start
+        and length starts from its old features, and only the new Tweets are
+        counted into it, while any other trend is counted over the whole
+        store. Deltas are only recomputed for trends whose counts changed.
+        """
+        if instrument is None:
+            instrument = NULL_INSTRUMENT
+        state = cache.load()
+        if state is None:
+            state = {'trend_offset': 0, 'tweet_offset': 0, 'tweets': 0,
+                     'reader': TrendReader(), 'trends': [], 'negatives': []}
+            old_features = []
+        else:
+            old_features = cache.load_features(state)
+        instrument.set('cached_tweets', state['tweets'])
+
+        with instrument.stage('trends'):
+            state['trend_offset'] = cache.read_trends(state['reader'],
+                                                      state['trend_offset'])
+            twitter_trends = state['reader'].twitter_trends()
+            positive_trends = [TrendLine.from_twitter_trend(trend)
+                               for trend in twitter_trends]
+            positive_trends = [trend for trend in positive_trends
+                               if len(trend) >= MINIMUM_TREND_SIZE]
+            for trend in positive_trends:
+                trend.preempt(trend_preempt)
+            instrument.count('positive_trends', len(positive_trends))
+
+        with instrument.stage('parse_tweets'):
+            first = state['tweets']
+            store, state['tweet_offset'] = cache.read_tweets(
+                state['tweet_offset'])
+            instrument.count('tweets_parsed', len(store) - first)
+
+        with instrument.stage('bag_of_words'):
+            bag_of_words = BagOfWords.from_store(store, stopwords=stopwords)
+        instrument.count('vocabulary', len(bag_of_words))
+
+        with instrument.stage('negative_sampling'):
+            positive_names = set(trend.name for trend in positive_trends)
+            negative_trends = [
+                TrendLine.empty(name, start_ts, length)
+                for name, start_ts, length in state['negatives']
+                if name not in positive_names]
+            if len(negative_trends) < len(positive_trends):
+                negative_trends.extend(TrendLine.construct_negative_trends(
+                    positive_trends, bag_of_words,
+                    len(positive_trends) - len(negative_trends),
+                    taken=negative_trends))
+            instrument.count('negative_trends', len(negative_trends))
+
+        all_trends = positive_trends + negative_trends
+        with instrument.stage('populate'):
+            cached = {tuple(key): features for key, features
+                      in zip(state['trends'], old_features)}
+            kept = []
+            fresh = []
+            for trend in all_trends:
+                features = cached.get((trend.name, trend.start_ts,
+                                       len(trend)))
+                if features is None:
+                    fresh.append(trend)
+                else:
+                    trend.features[:] = features
+                    kept.append(trend)
+            TrendLine.populate_from_counts(fresh, store.trend_counts(fresh))
+            for trend, counts in zip(kept, store.trend_counts(kept, first)):
+                if any(counts):
+                    trend.counts[:] += counts
+                    trend.compute_deltas()
+                    instrument.count('updated_trends')
+            instrument.count('recounted_trends', len(fresh))
+
+        state['tweets'] = len(store)
+        state['trends'] = [[trend.name, trend.start_ts, len(trend)]
+                           for trend in all_trends]
+        state['negatives'] = [[trend.name, trend.start_ts, len(trend)]
+                              for trend in negative_trends]
+        cache.save(state, [trend.features for trend in all_trends])
         return TrendModel(trends=all_trends)
 
 
@@ -214,9 +663,11 @@ class TrendLine:
 
     A "trend line" is considered some list of data over consecutive time
     quanta. By default, we assume each window is two minutes, but this can be
-    overridden. Also, for now that data is a list of TrendCell, but we could
-    generalize more (and I probably will when experimenting with other
-    properties to use for trend detection).
+    overridden. The data is stored column-wise: features is an (n, 3) int64
+    array holding the count, delta and delta_delta of every window, and
+    trend_mask is a boolean array saying whether each window was trending.
+    The data attribute still presents these as a list of TrendCell views for
+    code that wants to work a cell at a time.
     """
 
     def __init__(self, name, start_ts, data=None, window_size=120):
@@ -234,41 +685,134 @@ class TrendLine:
         self.data = [] if data is None else data
         self.window_size = window_size
 
+    def __len__(self):
+        return len(self.trend_mask)
+
+    @property
+    def data(self):
+        """ A list-like view of the TrendCells of this TrendLine. """
+        return TrendData(self)
+
+    @data.setter
+    def data(self, cells):
+        self.features = np.array([(cell.count, cell.delta, cell.delta_delta)
+                                  for cell in cells],
+                                 dtype=np.int64).reshape(-1, 3)
+        self.trend_mask = np.array([bool(cell.trending) for cell in cells],
+                                   dtype=bool)
+
+    @property
+    def counts(self):
+        return self.features[:, 0]
+
+    @property
+    def deltas(self):
+        return self.features[:, 1]
+
+    @property
+    def delta_deltas(self):
+        return self.features[:, 2]
+
     def match_text(self, text):
         """ Determines whether a piece of text matches the trend. """
-        for word in self.name.split():
+        for word in tokenize(self.name):
             if word in text:
                 return True
         return False
 
-    def distance(self, other):
+    def distance(self, other, factor=None, norm='l1'):
         """ Returns the distance between this TrendLine and another.
 
         This is measured by finding the alignment of the shorter TrendLine
         against that longer one than minimizes the sum of the distances between
-        corresponding data members.
-        """
-        # Distance is symmetric, so just define it for self < other
-        if len(self.data) > len(other.data):
-            return other.distance(self)
-
-        min_distance = None
-        for offset in range(len(other.data) - len(self.data) + 1):
-            total = 0
-            for i in range(len(self.data)):
-                total += self.data[i].distance(other.data[offset + i])
-            if min_distance is None:
-                min_distance = total
-            elif min_distance > total:
-                min_distance = total
-        return min_distance
+        corresponding data members. All offsets are scored at once over the
+        feature arrays; see twittp.distance. With a factor, the alignment is
+        searched for coarse to fine instead, at factor times the window size
+        first; see twittp.pyramid.coarse_to_fine_distance. With norm='l2',
+        cells are compared by their squared differences instead, and all
+        offsets are scored at once by FFT cross-correlation.
+        """
+        if norm not in DISTANCES:
+            raise ValueError('Unknown norm: %s' % norm)
+        if factor is not None:
+            if norm != 'l1':
+                raise ValueError('Coarse to fine needs the l1 norm')
+            return coarse_to_fine_distance(self.features, other.features,
+                                           TrendCell.weights(), factor)
+        return DISTANCES[norm](self.features, other.features,
+                               TrendCell.weights())
+
+    def prefix_sums(self):
+        """ The running sums of the counts and trending windows of the line.
+
+        Entry i covers windows [0, i), so the count of tweets or of trending
+        windows over any run of windows takes O(1); see twittp.pyramid.
+        """
+        return prefix_sums(self.counts), prefix_sums(self.trend_mask)
+
+    def coarsen(self, factor):
+        """ Returns this TrendLine re-aggregated to factor times its windows.
+
+        Counts are summed over every factor windows, the last coarse window
+        possibly covering fewer, and deltas are recomputed from the coarse
+        counts. A coarse window is trending if any window in it is.
+        """
+        counts, trending = self.prefix_sums()
+        return TrendLine.from_arrays(self.name, self.start_ts,
+                                     coarse_features(counts, factor),
+                                     window_sums(trending, factor) > 0,
+                                     self.window_size * factor)
 
     def trending(self):
         """ Indicates if this TrendLine ever trends on Twitter. """
-        for datum in self.data:
-            if datum.trending:
-                return True
-        return False
+        return bool(self.trend_mask.any())
+
+    def preempt(self, windows):
+        """ Prepends windows non-trending cells to the front of the line. """
+        if windows <= 0:
+            return
+        self.features = np.concatenate(
+            (np.zeros((windows, 3), dtype=np.int64), self.features))
+        self.trend_mask = np.concatenate(
+            (np.zeros(windows, dtype=bool), self.trend_mask))
+        self.start_ts -= self.window_size * windows
+
+    def compute_deltas(self):
+        """ Fills in delta and delta_delta from the counts of the line.
+
+        The first window has no delta or delta_delta, and the second has no
+        delta_delta, so those are left as zero.
+        """
+        counts = self.counts
+        self.deltas[0:1] = 0
+        self.deltas[1:] = np.diff(counts)
+        self.delta_deltas[0:2] = 0
+        self.delta_deltas[2:] = np.diff(self.deltas[1:])
+
+    def to_obj(self):
+        """ Returns a JSON-friendly dict of this TrendLine. """
+        return {'name': self.name, 'start_ts': self.start_ts,
+                'data': [cell.to_obj() for cell in self.data],
+                'window_size': self.window_size}
+
+    @staticmethod
+    def from_arrays(name, start_ts, features, trend_mask, window_size=120):
+        """ Builds a TrendLine directly from its feature and trending columns.
+
+        No copy is made, so the TrendLine can be a view onto a larger array.
+        """
+        trend = TrendLine(name, start_ts, window_size=window_size)
+        trend.features = features
+        trend.trend_mask = trend_mask
+        return trend
+
+    @staticmethod
+    def empty(name, start_ts, length, trending=False, window_size=120):
+        """ Creates a TrendLine of length zeroed windows. """
+        return TrendLine.from_arrays(name, start_ts,
+                                     np.zeros((length, 3), dtype=np.int64),
+                                     np.full(length, trending, dtype=bool),
+                                     window_size)
 
     @staticmethod
     def from_obj(obj):
@@ -278,124 +822,240 @@ class TrendLine:
         name = obj['name']
         window_size = obj['window_size']
         start_ts = obj['start_ts']
-        data = [TrendCell.from_obj(cell) for cell in obj['data']]
-        return TrendLine(name, start_ts, data, window_size)
+        cells = obj['data']
+        # Every cell must be a dict of the four integer (or bool) values
+        if not isinstance(cells, list) or not all(
+                isinstance(cell, dict) and
+                all(isinstance(cell.get(key), numbers.Integral)
+                    for key in CELL_KEYS) for cell in cells):
+            return None
+        try:
+            features = np.array([(cell['count'], cell['delta'],
+                                  cell['delta_delta']) for cell in cells],
+                                dtype=np.int64).reshape(-1, 3)
+        except OverflowError:
+            return None
+        trend_mask = np.array([cell['trending'] for cell in cells],
+                              dtype=bool)
+        return TrendLine.from_arrays(name, start_ts, features, trend_mask,
+                                     window_size)
 
     @staticmethod
-    def random_trend(name, start, end, lengths):
+    def random_trend(name, start, end, lengths, window_size=120):
         """ Creates an empty TrendLine of length sampled from lengths. """
+        return TrendLine.random_span(name, start, end, lengths,
+                                     window_size).trend_line()
+
+    @staticmethod
+    def random_span(name, start, end, lengths, window_size=120):
+        """ Draws the TrendSpan of an empty TrendLine, as random_trend does.
+        """
         length = lengths[random.randrange(0, len(lengths))]
-        start_trend = random.randint(start // 120, (end // 120) - length)
-        data = [TrendCell(trending=False) for _ in range(length)]
-        return TrendLine(name, start_ts=start_trend*120, data=data)
+        start_trend = random.randint(start // window_size,
+                                     (end // window_size) - length)
+        return TrendSpan(name, start_trend * window_size, length,
+                         window_size=window_size)
 
     @staticmethod
-    def construct_negative_trends(trends, bag_of_words):
+    def construct_negative_trends(trends, bag_of_words, n=None, taken=()):
         """ Construct negative trends like the provided positive trends.
 
         The negative trends have names generated from the TrendBagOfWords model
         provided. The start, end, and lengths of the negative trends are based
         on those of the provided positive trends. This ensures that the trends
-        produced by this method are like the positive trends provided.
+        produced by this method are like the positive trends provided. By
+        default, there is one negative trend per positive trend; pass n for
+        another number, and taken for other trends whose names are not to be
+        reused.
+        """
+        return [span.trend_line() for span in TrendLine.negative_spans(
+            trends, bag_of_words, n, taken)]
+
+    @staticmethod
+    def negative_spans(trends, bag_of_words, n=None, taken=()):
+        """ Draws the negative trends of construct_negative_trends as
+        TrendSpans, without creating them.
+
+        The positive trends may be TrendSpans as well.
         """
         start = min([trend.start_ts for trend in trends])
-        end = max([trend.window_size * (len(trend.data)) + trend.start_ts
+        end = max([trend.window_size * len(trend) + trend.start_ts
                    for trend in trends])
-        lengths = [len(trend.data) for trend in trends]
-        names = bag_of_words.random_trend_names(trends, len(trends))
+        lengths = [len(trend) for trend in trends]
+        names = bag_of_words.random_trend_names(
+            list(trends) + list(taken), len(trends) if n is None else n)
 
-        return [TrendLine.random_trend(name, start, end, lengths) for name in
-                names]
+        window_size = trends[0].window_size
+        return [TrendLine.random_span(name, start, end, lengths, window_size)
+                for name in names]
 
     @staticmethod
     def populate_from_file(trends, tweet_file):
         """ Fills data of a list of TrendLines from JSON file of tweet objects.
 
+        The file has one tweet per line; see populate_from_records.
+        """
+        TrendLine.populate_from_records(trends, read_tweets(tweet_file))
+
+    @staticmethod
+    def populate_from_records(trends, records, vocab=None):
+        """ Fills data of a list of TrendLines from (timestamp, words) records.
+
         This works in two passes -- first the counts are filled in by reading
-        each tweet from the JSON file (one tweet per line), and incrementing
+        each tweet record (as yielded by read_tweets), and incrementing
         the count if there is a match between the text and the trend and the
-        Tweet falls in the range of the trend.
+        Tweet falls in the range of the trend. Matching goes through a
+        TrendMatcher, so each tweet only looks at trends that share a word
+        with it and are active at its time. If the records were read with a
+        Vocabulary, pass it as vocab; trend names are then resolved to ids
+        and matched against the ids of each tweet.
 
         The second pass consists of going through each trend that was passed to
         the method and filling in the delta and delta_delta of the data from
         the counts that were just loaded in.
         """
-        with open(tweet_file) as f:
-            # Memoize the ending timestamps for our trends to speed things up
-            end_ts = {}
-            for trend in trends:
-                end_ts[trend.name] = trend.start_ts + trend.window_size * \
-                    (len(trend.data))
-
-            for line in f:
-                tweet = json.loads(line)
-                words = tweet['text'].split()
-                dt = datetime.strptime(tweet['created_at'],
-                                       "%a %b %d %H:%M:%S %z %Y")
-                ts = (dt - datetime(1970, 1, 1, tzinfo=timezone(timedelta(0))))\
-                    // timedelta(seconds=1)
-                for trend in trends:
-                    if trend.start_ts <= ts < end_ts[trend.name] and \
-                            trend.match_text(words):
-                        offset = (ts - trend.start_ts) // trend.window_size
-                        trend.data[offset].count += 1
+        names = None
+        if vocab is not None:
+            names = [vocab.lookup(tokenize(trend.name)) for trend in trends]
+        matcher = TrendMatcher(trends, names=names)
+        counts = matcher.new_counts()
+        for ts, words in records:
+            matcher.count(counts, ts, words)
+        matcher.apply_counts(counts)
 
         # Second pass
         for trend in trends:
-            first = True
-            second = False
-            for index in range(len(trend.data)):
-                datum = trend.data[index]
-                if first:
-                    datum.delta = 0
-                    datum.delta_delta = 0
-                    first = False
-                    second = True
-                elif second:
-                    datum.delta = datum.count - trend.data[index - 1].count
-                    datum.delta_delta = 0
-                    second = False
-                else:
-                    datum.delta = datum.count - trend.data[index - 1].count
-                    datum.delta_delta = datum.delta - trend.data[index - 1].delta
+            trend.compute_deltas()
+
+    @staticmethod
+    def populate_from_store(trends, store):
+        """ Fills data of a list of TrendLines from a TweetStore.
+
+        This does the same as populate_from_records, but matching works on
+        word ids; see TweetStore.trend_counts.
+        """
+        TrendLine.populate_from_counts(trends, store.trend_counts(trends))
+
+    @staticmethod
+    def populate_from_counts(trends, counts):
+        """ Fills data of a list of TrendLines from per-window match counts.
+
+        The counts are added to those of each trend, then the delta and
+        delta_delta are filled in from the result.
+        """
+        for trend, trend_counts in zip(trends, counts):
+            trend.counts[:] += trend_counts
+            trend.compute_deltas()
+
+    @staticmethod
+    def populate_by_block(spans, store, block_seconds=BLOCK_SECONDS):
+        """ Creates and populates TrendLines a block of start times at a time.
+
+        The TrendSpans are put in blocks of block_seconds by start time, as
+        in a FeatureStore. Block by block, in time order, their TrendLines
+        are created, filled in from the Tweets of the TweetStore that fall
+        in the block's time span (see TweetStore.time_range), and yielded.
+        Only one block of trends is held at a time, so the result can be
+        written straight to a FeatureStore.
+        """
+        blocks = {}
+        for span in spans:
+            blocks.setdefault(span.start_ts // block_seconds, []).append(span)
+        for block in sorted(blocks):
+            trends = [span.trend_line() for span in blocks.pop(block)]
+            first, last = store.time_range(
+                min(trend.start_ts for trend in trends),
+                max(trend.start_ts + trend.window_size * len(trend)
+                    for trend in trends))
+            TrendLine.populate_from_counts(
+                trends, store.trend_counts(trends, first, last))
+            for trend in trends:
+                yield trend
 
     @staticmethod
     def from_twitter_trend(twitter_trend, window_size=120):
         """ Converts a TwitterTrend into a TrendLine.
 
         The TrendLine represents the longest consecutive time windows where this
-        trend is "trending" according to Twitter.
+        trend is "trending" according to Twitter, which is read straight off
+        the run-length intervals of the TwitterTrend.
         """
-        longest_consecutive = 0
-        start_longest = None
+        start_longest, longest_consecutive = twitter_trend.longest_interval()
 
-        start_consecutive = None
-        current_consecutive = 0
-        last_timestamp = None
+        return TrendLine.empty(twitter_trend.name, start_longest,
+                               longest_consecutive, trending=True,
+                               window_size=window_size)
 
-        for ts in twitter_trend.timestamps:
-            if start_consecutive is None:
-                start_consecutive = ts
-                current_consecutive = 1
-            elif ts == last_timestamp + window_size:
-                current_consecutive += 1
-            else:
-                if start_longest is None:
-                    start_longest = start_consecutive
-                    longest_consecutive = current_consecutive
-                elif longest_consecutive < current_consecutive:
-                    start_longest = start_consecutive
-                    longest_consecutive = current_consecutive
-                else:
-                    start_consecutive = None
-                    current_consecutive = 0
 
-            last_timestamp = ts
+class TrendSpan:
+    """ The name and windows of a TrendLine that has not been created yet.
 
-        data = [TrendCell(True) for _ in range(longest_consecutive)]
+    A span takes a few numbers where the TrendLine takes arrays as long as
+    its windows, so the trends of a large model can be planned out (e.g.
+    drawing negative trends like the positive ones) before any of them are
+    created. A positive span covers preempt non-trending windows and then
+    trending ones, like a TrendLine from from_twitter_trend after preempt.
+    """
 
-        return TrendLine(twitter_trend.name, start_longest, data=data,
-                         window_size=window_size)
+    def __init__(self, name, start_ts, length, trending=False,
+                 window_size=120, preempt=0):
+        self.name = name
+        self.start_ts = start_ts
+        self.length = length
+        self.trending = trending
+        self.window_size = window_size
+        self.preempt = preempt
+
+    def __len__(self):
+        return self.length
+
+    def trend_line(self):
+        """ Creates the empty TrendLine of this span. """
+        trend = TrendLine.empty(
+            self.name, self.start_ts + self.window_size * self.preempt,
+            self.length - self.preempt, self.trending, self.window_size)
+        trend.preempt(self.preempt)
+        return trend
+
+    @staticmethod
+    def from_twitter_trend(twitter_trend, preempt=0, window_size=120):
+        """ The span of TrendLine.from_twitter_trend followed by preempt. """
+        start, length = twitter_trend.longest_interval()
+        preempt = max(preempt, 0)
+        return TrendSpan(twitter_trend.name, start - window_size * preempt,
+                         length + preempt, trending=True,
+                         window_size=window_size, preempt=preempt)
+
+
+class TrendData:
+    """ A list-like view over the cells of a TrendLine.
+
+    Indexing gives TrendCell views, so something like data[i].count += 1
+    writes straight through to the arrays of the TrendLine.
+    """
+
+    def __init__(self, trend):
+        self.trend = trend
+
+    def __len__(self):
+        return len(self.trend)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('TrendLine index out of range')
+        return TrendCell.view(self.trend.features, self.trend.trend_mask,
+                              index)
+
+    def __setitem__(self, index, cell):
+        self[index].assign(cell)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
 
 class TrendCell:
@@ -403,8 +1063,12 @@ class TrendCell:
 
     In particular, this is one where the only variables of concern are the
     number of matching Tweets at this time, the change since the last time, and
-    the change in the change since the last time.
+    the change in the change since the last time. A TrendCell is a view onto
+    one row of the arrays backing a TrendLine; one created on its own gets a
+    single-row array of its own.
     """
+    __slots__ = ('_features', '_trend_mask', '_index')
+
     count_weight = 1.0
     delta_weight = 1.0
     delta_delta_weight = 1.0
@@ -416,10 +1080,64 @@ class TrendCell:
         is whether the TrendLine is trending at this time or not. By "trending",
         we mean whatever Twitter uses to determine if a topic is trending.
         """
-        self.trending = trending
-        self.count = count
-        self.delta = delta
-        self.delta_delta = delta_delta
+        self._features = np.array([[count, delta, delta_delta]],
+                                  dtype=np.int64)
+        self._trend_mask = np.array([trending], dtype=bool)
+        self._index = 0
+
+    @staticmethod
+    def weights():
+        """ The current count, delta and delta_delta weights as an array. """
+        return np.array([TrendCell.count_weight, TrendCell.delta_weight,
+                         TrendCell.delta_delta_weight])
+
+    @staticmethod
+    def view(features, trend_mask, index):
+        """ Returns a TrendCell backed by row index of the given arrays. """
+        cell = TrendCell.__new__(TrendCell)
+        cell._features = features
+        cell._trend_mask = trend_mask
+        cell._index = index
+        return cell
+
+    @property
+    def trending(self):
+        return bool(self._trend_mask[self._index])
+
+    @trending.setter
+    def trending(self, value):
+        self._trend_mask[self._index] = value
+
+    @property
+    def count(self):
+        return int(self._features[self._index, 0])
+
+    @count.setter
+    def count(self, value):
+        self._features[self._index, 0] = value
+
+    @property
+    def delta(self):
+        return int(self._features[self._index, 1])
+
+    @delta.setter
+    def delta(self, value):
+        self._features[self._index, 1] = value
+
+    @property
+    def delta_delta(self):
+        return int(self._features[self._index, 2])
+
+    @delta_delta.setter
+    def delta_delta(self, value):
+        self._features[self._index, 2] = value
+
+    def assign(self, other):
+        """ Copies the values of another TrendCell into this one. """
+        self.trending = other.trending
+        self.count = other.count
+        self.delta = other.delta
+        self.delta_delta = other.delta_delta
 
     def distance(self, other):
         """ Find the distance between two TrendCells.
@@ -436,6 +1154,11 @@ class TrendCell:
                (TrendCell.delta_weight * delta_distance) + \
                (TrendCell.delta_delta_weight * dd_distance)
 
+    def to_obj(self):
+        """ Returns a JSON-friendly dict of this TrendCell. """
+        return {'trending': self.trending, 'count': self.count,
+                'delta': self.delta, 'delta_delta': self.delta_delta}
+
     @staticmethod
     def from_obj(obj):
         if obj.get('trending') is None or obj.get('count') is None or \
@@ -451,5 +1174,5 @@ class TwitTPEncoder(json.JSONEncoder):
         """ This overridden default() handles TwitTP objects properly. """
         if isinstance(o, TrendModel) or isinstance(o, TrendLine) or \
                 isinstance(o, TrendCell):
-            return o.__dict__
+            return o.to_obj()
         return super(TwitTPEncoder, self).default(o)
@@ -0,0 +1,148 @@
+import numpy as np
+import simplejson as json
+
+
+MAGIC = b'TWITTPM1'
+ALIGNMENT = 64
+
+
+def is_model_file(path):
+    """ Indicates whether path is in the binary model format. """
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_arrays(path, arrays, meta=None):
+    """ Writes a dict of named arrays to a single flat file.
+
+    The file starts with MAGIC, then the length of a JSON header as a
+    little-endian uint64, then the header itself, which gives the dtype,
+    shape and byte offset of every array along with the meta dict. The raw
+    array data follows, each array aligned to ALIGNMENT bytes so it can be
+    memory-mapped in place.
+    """
+    arrays = {name: np.ascontiguousarray(array)
+              for name, array in arrays.items()}
+    entries = {}
+    offset = 0
+    for name, array in arrays.items():
+        entries[name] = {'dtype': array.dtype.str, 'shape': array.shape,
+                         'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({'arrays': entries,
+                         'meta': {} if meta is None else meta}).encode('utf-8')
+    start = len(MAGIC) + 8 + len(header)
+    start = -(-start // ALIGNMENT) * ALIGNMENT
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(start + entries[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(start + offset)
+
+
+def read_arrays(path):
+    """ Memory-maps the arrays of a file written by write_arrays.
+
+    The arrays are mapped copy-on-write, so they can be modified in memory
+    without touching the file. Returns (arrays, meta).
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a twittp model file' % path)
+        length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(length).decode('utf-8'))
+    start = len(MAGIC) + 8 + length
+    start = -(-start // ALIGNMENT) * ALIGNMENT
+
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        shape = tuple(entry['shape'])
+        if np.prod(shape, dtype=np.int64) == 0:
+            arrays[name] = np.zeros(shape, dtype=entry['dtype'])
+        else:
+            arrays[name] = np.memmap(path, dtype=entry['dtype'], mode='c',
+                                     offset=start + entry['offset'],
+                                     shape=shape)
+    return arrays, header['meta']
+
+
+def trend_arrays(trends):
+    """ Packs a list of TrendLines into the arrays of the model format.
+
+    The cells of all trends are concatenated into one features and one
+    trend_mask array, with offsets[i]:offsets[i + 1] giving the cells of
+    trend i. Names are stored as concatenated UTF-8 bytes with their own
+    offsets.
+    """
+    lengths = np.array([len(trend) for trend in trends], dtype=np.int64)
+    offsets = np.zeros(len(trends) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    names = [trend.name.encode('utf-8') for trend in trends]
+    name_offsets = np.zeros(len(trends) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in names], out=name_offsets[1:])
+    return {
+        'features': np.concatenate([trend.features for trend in trends] +
+                                   [np.zeros((0, 3), dtype=np.int64)]),
+        'trend_mask': np.concatenate([trend.trend_mask for trend in trends] +
+                                     [np.zeros(0, dtype=bool)]),
+        'offsets': offsets,
+        'start_ts': np.array([trend.start_ts for trend in trends],
+                             dtype=np.int64),
+        'window_size': np.array([trend.window_size for trend in trends],
+                                dtype=np.int64),
+        'names': np.frombuffer(b''.join(names), dtype=np.uint8),
+        'name_offsets': name_offsets,
+    }
+
+
+class LazyTrendList:
+    """ A read-mostly list of TrendLines backed by model file arrays.
+
+    A TrendLine is only built the first time it is accessed, and then as
+    views onto the memory-mapped arrays, so opening a model costs nothing
+    no matter how many trends it has. make_trend is called as
+    make_trend(name, start_ts, features, trend_mask, window_size), which
+    is the signature of TrendLine.from_arrays.
+    """
+
+    def __init__(self, arrays, make_trend):
+        self.arrays = arrays
+        self.make_trend = make_trend
+        self.offsets = arrays['offsets']
+        self.name_offsets = arrays['name_offsets']
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('trend index out of range')
+        trend = self.cache.get(index)
+        if trend is None:
+            trend = self.cache[index] = self.materialize(index)
+        return trend
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def materialize(self, index):
+        arrays = self.arrays
+        start = int(self.offsets[index])
+        stop = int(self.offsets[index + 1])
+        name = arrays['names'][int(self.name_offsets[index]):
+                               int(self.name_offsets[index + 1])]
+        return self.make_trend(bytes(name).decode('utf-8'),
+                               int(arrays['start_ts'][index]),
+                               arrays['features'][start:stop],
+                               arrays['trend_mask'][start:stop],
+                               int(arrays['window_size'][index]))
@@ -0,0 +1,214 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+from multiprocessing import shared_memory
+import os
+import numpy as np
+from .distance import batch_distance
+
+
+# Models smaller than this are never worth starting a process pool for
+MINIMUM_PARALLEL_TRENDS = 64
+
+# Per-process state set up by _init_worker
+_worker = {}
+
+
+def model_digest(trends, weights, norm='l1'):
+    """ A hex digest identifying the distances a list of TrendLines yields.
+
+    Only the things that feed into the distance are hashed: the weights,
+    the norm, and the feature arrays of every line in order.
+    """
+    digest = hashlib.sha1()
+    if norm != 'l1':
+        digest.update(norm.encode('ascii'))
+    digest.update(np.asarray(weights, dtype=np.float64).tobytes())
+    digest.update(np.int64(len(trends)).tobytes())
+    for trend in trends:
+        features = np.ascontiguousarray(trend.features, dtype=np.int64)
+        digest.update(np.int64(len(features)).tobytes())
+        digest.update(features.tobytes())
+    return digest.hexdigest()
+
+
+def split_rows(n, tiles):
+    """ Splits rows 0..n of an upper triangle into tiles of similar work.
+
+    Row i of the upper triangle has n - i - 1 entries, so the early rows
+    get smaller tiles than the late ones. Returns a list of (start, stop).
+    """
+    total = n * (n - 1) // 2
+    if total == 0:
+        return [(0, n)] if n else []
+    target = max(1, total // max(1, tiles))
+    bounds = []
+    start = 0
+    work = 0
+    for i in range(n):
+        work += n - i - 1
+        if work >= target:
+            bounds.append((start, i + 1))
+            start = i + 1
+            work = 0
+    if start < n:
+        bounds.append((start, n))
+    return bounds
+
+
+def flat_features(trends):
+    """ Concatenates the feature arrays of TrendLines into one array.
+
+    Returns a (total, 3) float64 array and the offsets of each line into
+    it, so line i is features[offsets[i]:offsets[i + 1]]. Unlike
+    pad_features, nothing is stored for padding.
+    """
+    offsets = np.zeros(len(trends) + 1, dtype=np.int64)
+    np.cumsum([len(trend) for trend in trends], out=offsets[1:])
+    features = np.zeros((int(offsets[-1]), 3), dtype=np.float64)
+    for i, trend in enumerate(trends):
+        features[offsets[i]:offsets[i + 1]] = trend.features
+    return features, offsets
+
+
+def _fill_rows(out, features, offsets, weights, start, stop, norm='l1'):
+    """ Computes rows start..stop of the upper triangle into out.
+
+    The rows are positions in the order of increasing length: order is
+    the argsort of the lengths, and row i is the line order[i]. The lines
+    after start are padded in groups of similar length, each only to its
+    own longest line, and every row is scored against the part of each
+    group that comes after it.
+    """
+    distance = batch_distance(norm)
+    lengths = np.diff(offsets)
+    order = np.argsort(lengths, kind='stable')
+    ordered = lengths[order]
+    n = len(order)
+
+    groups = []
+    lo = start + 1
+    while lo < n:
+        hi = int(np.searchsorted(ordered, 2 * max(int(ordered[lo]), 1),
+                                 side='right'))
+        block = np.zeros((hi - lo, int(ordered[hi - 1]), 3),
+                         dtype=np.float64)
+        for j, line in enumerate(order[lo:hi]):
+            block[j, :lengths[line]] = \
+                features[offsets[line]:offsets[line + 1]]
+        groups.append((lo, hi, block))
+        lo = hi
+
+    for i in range(start, stop):
+        line = order[i]
+        query = features[offsets[line]:offsets[line + 1]]
+        for lo, hi, block in groups:
+            if hi <= i + 1:
+                continue
+            first = max(lo, i + 1)
+            row = distance(query, block[first - lo:], ordered[first:hi],
+                           weights)
+            out[line, order[first:hi]] = row
+            out[order[first:hi], line] = row
+
+
+def _share(array):
+    """ Copies an array into a new shared-memory segment. """
+    shm = shared_memory.SharedMemory(create=True,
+                                     size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm
+
+
+def _init_worker(weights, norm, out_name, n, features_name, total,
+                 offsets_name):
+    shms = [shared_memory.SharedMemory(name=name)
+            for name in (out_name, features_name, offsets_name)]
+    _worker['shms'] = shms
+    _worker['out'] = np.ndarray((n, n), dtype=np.float64, buffer=shms[0].buf)
+    _worker['features'] = np.ndarray((total, 3), dtype=np.float64,
+                                     buffer=shms[1].buf)
+    _worker['offsets'] = np.ndarray(n + 1, dtype=np.int64,
+                                    buffer=shms[2].buf)
+    _worker['weights'] = weights
+    _worker['norm'] = norm
+
+
+def _work(bounds):
+    _fill_rows(_worker['out'], _worker['features'], _worker['offsets'],
+               _worker['weights'], *bounds, norm=_worker['norm'])
+
+
+def pairwise_distances(trends, weights, workers=None, cache_dir=None,
+                       norm='l1'):
+    """ Computes the symmetric matrix of distances between TrendLines.
+
+    Only the upper triangle is computed, split into tiles that are handed
+    to a pool of worker processes writing into a shared-memory matrix. The
+    feature arrays are shared with the workers the same way, concatenated
+    without padding (see flat_features), and the rows are taken in order
+    of length so each tile pads its lines in groups of similar length.
+    With workers=None, every CPU is used; workers=1 computes in-process.
+    If cache_dir is given, the matrix is stored there keyed by
+    model_digest and later calls with the same model load it memory-mapped
+    instead of recomputing. norm is 'l1' for the weighted L1 alignment
+    distance or 'l2' for its squared-Euclidean counterpart; see
+    twittp.distance.
+    """
+    batch_distance(norm)
+    n = len(trends)
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir,
+                            'distances-%s.npy' % model_digest(trends, weights,
+                                                              norm))
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r')
+
+    features, offsets = flat_features(trends)
+    weights = np.asarray(weights, dtype=np.float64)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1 or n < MINIMUM_PARALLEL_TRENDS:
+        distances = np.zeros((n, n), dtype=np.float64)
+        _fill_rows(distances, features, offsets, weights, 0, n, norm)
+    else:
+        shms = [shared_memory.SharedMemory(create=True,
+                                           size=max(1, n * n * 8))]
+        try:
+            shms.append(_share(features))
+            shms.append(_share(offsets))
+            out = np.ndarray((n, n), dtype=np.float64, buffer=shms[0].buf)
+            out[:] = 0
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=_init_worker,
+                                     initargs=(weights, norm, shms[0].name,
+                                               n, shms[1].name,
+                                               len(features),
+                                               shms[2].name)) as pool:
+                list(pool.map(_work, split_rows(n, workers * 4)))
+            distances = out.copy()
+            del out
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = path + '.%d.tmp.npy' % os.getpid()
+        np.save(temp_path, distances)
+        os.replace(temp_path, path)
+    return distances
+
+
+def nearest_neighbors(distances, i, k=1):
+    """ Indices of the k rows nearest to row i, excluding i itself.
+
+    Ties are broken in favour of the lower index, so with k=1 this picks the
+    same match as a scan keeping the first strict minimum.
+    """
+    row = np.array(distances[i], dtype=np.float64)
+    row[i] = np.inf
+    order = np.argsort(row, kind='stable')
+    return order[:min(k, len(row) - 1)]
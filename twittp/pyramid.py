@@ -0,0 +1,128 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from .distance import (alignment_costs, alignment_distance,
+                       batch_alignment_distance, pad_features)
+from .pairwise import pairwise_distances
+
+
+# Number of windows merged into one by default: 5 x 120 s = 10 minutes
+COARSE_FACTOR = 5
+
+# Number of coarse candidates (offsets, or trends) refined at full resolution
+CANDIDATES = 4
+
+
+def prefix_sums(values):
+    """ The running sums of values along the first axis, starting at zero.
+
+    Entry i is the sum of values[:i], so the sum of any run of cells
+    values[i:j] is prefix[j] - prefix[i].
+    """
+    values = np.asarray(values)
+    prefix = np.zeros((len(values) + 1,) + values.shape[1:],
+                      dtype=np.int64 if values.dtype.kind in 'biu'
+                      else values.dtype)
+    np.cumsum(values, axis=0, out=prefix[1:])
+    return prefix
+
+
+def window_sums(prefix, factor):
+    """ Sums every factor cells from the prefix sums of a line.
+
+    The result has one entry per coarse window, the last of which may be
+    partial, and each takes O(1) to compute.
+    """
+    length = len(prefix) - 1
+    starts = np.arange(0, length, factor)
+    ends = np.minimum(starts + factor, length)
+    return prefix[ends] - prefix[starts]
+
+
+def coarse_features(prefix, factor):
+    """ The (count, delta, delta_delta) features of a line at factor times
+    its window size, from the prefix sums of its counts.
+
+    The counts of every factor windows are summed, and the deltas are then
+    worked out from the coarse counts as TrendLine.compute_deltas does.
+    """
+    coarse = window_sums(prefix, factor)
+    features = np.zeros((len(coarse), 3), dtype=np.int64)
+    features[:, 0] = coarse
+    features[1:, 1] = np.diff(coarse)
+    features[2:, 2] = np.diff(features[1:, 1])
+    return features
+
+
+def alignment_offsets(short, long, offsets, weights):
+    """ The weighted L1 costs of lining short up with long at some offsets.
+    """
+    n = len(short)
+    costs = np.zeros(len(offsets), dtype=np.float64)
+    for f in range(3):
+        windows = sliding_window_view(np.asarray(long[:, f],
+                                                 dtype=np.float64), n)
+        costs += weights[f] * np.abs(windows[offsets] - short[:, f]).sum(
+            axis=1)
+    return costs
+
+
+def coarse_to_fine_distance(a, b, weights, factor=COARSE_FACTOR,
+                            candidates=CANDIDATES):
+    """ An approximation of alignment_distance found coarse to fine.
+
+    The shorter line is slid along the longer one with both coarsened by
+    factor, and only the fine offsets around the candidates best coarse
+    offsets are then scored at full resolution. This scores about
+    1 / factor ** 2 of the cells that alignment_distance does, and finds
+    the same distance whenever the best alignment lies near one of the
+    candidate coarse offsets, as it does for lines with a clear peak. The
+    result is never less than the exact distance.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    n = len(a)
+    m = len(b)
+    if n == 0 or (m - n + 1) <= (2 * candidates + 1) * factor:
+        return alignment_distance(a, b, weights)
+
+    coarse = alignment_costs(coarse_features(prefix_sums(a[:, 0]), factor),
+                             coarse_features(prefix_sums(b[:, 0]), factor),
+                             weights)
+    best = np.argsort(coarse, kind='stable')[:candidates]
+    offsets = np.unique(np.concatenate(
+        [np.arange(max(0, (k - 1) * factor),
+                   min(m - n, (k + 1) * factor) + 1) for k in best]))
+    return float(alignment_offsets(np.asarray(a, dtype=np.float64), b,
+                                   offsets, weights).min())
+
+
+def coarse_to_fine_neighbors(trends, coarse_trends, weights,
+                             candidates=CANDIDATES, workers=None,
+                             cache_dir=None):
+    """ Finds the nearest other trend of every trend, coarse to fine.
+
+    coarse_trends are the trends coarsened by some factor (see
+    TrendLine.coarsen). Their distance matrix is computed first, which is
+    about factor ** 2 times cheaper than the full one, then for each trend
+    only its candidates nearest coarse neighbors are compared at full
+    resolution. Returns the index of the nearest one for each trend, the
+    first one on a tie.
+    """
+    coarse = np.array(pairwise_distances(coarse_trends, weights,
+                                         workers=workers,
+                                         cache_dir=cache_dir))
+    np.fill_diagonal(coarse, np.inf)
+    block, lengths = pad_features(trends)
+    neighbors = []
+    for i in range(len(trends)):
+        nearest = np.argsort(coarse[i], kind='stable')[:candidates]
+        nearest = nearest[nearest != i]
+        if not len(nearest):
+            neighbors.append(i)
+            continue
+        nearest.sort()
+        distances = batch_alignment_distance(block[i, :lengths[i]],
+                                             block[nearest],
+                                             lengths[nearest], weights)
+        neighbors.append(int(nearest[np.argmin(distances)]))
+    return neighbors
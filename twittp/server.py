@@ -0,0 +1,284 @@
+import asyncio
+from collections import deque
+import time
+import simplejson as json
+from .model import TrendCell, TrendLine
+from .stream import percentile
+
+
+# Most requests scored together in one batch
+MAX_BATCH = 64
+
+# Seconds a batch waits for more requests once its first one is in
+MAX_DELAY = 0.002
+
+# Number of recent request latencies the percentiles are taken over
+LATENCY_HISTORY = 10000
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class BadRequest(ValueError):
+    """ Raised for a request body that is not a TrendLine. """
+
+
+async def read_message(reader):
+    """ Reads an HTTP request or response from a stream.
+
+    Returns the start line split into its parts, the headers (with
+    lowercased names) and the body, or None at the end of the stream.
+    """
+    start = await reader.readline()
+    if not start:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return start.decode('latin-1').strip().split(None, 2), headers, body
+
+
+def write_message(writer, start, body, close=False):
+    """ Writes an HTTP message with a JSON body to a stream. """
+    head = '%s\r\nContent-Type: application/json\r\n' \
+           'Content-Length: %d\r\n' % (start, len(body))
+    if close:
+        head += 'Connection: close\r\n'
+    writer.write(head.encode('latin-1') + b'\r\n' + body)
+
+
+class PredictionServer:
+    """ Serves the predictions of a TrendModel over HTTP.
+
+    The model is loaded, and its nearest-neighbor index built, once. A POST
+    to /predict with a TrendLine in the TrendLine.from_obj form (or a list
+    of them) answers with the prediction of TrendModel.predict for each:
+    whether it will trend, and its nearest trends in the model. A GET of
+    /stats answers with report().
+
+    Requests are not scored as they arrive. They are queued, and a single
+    batcher task takes whatever is waiting (up to max_batch, waiting at
+    most max_delay seconds for more once one is in) and scores it in one
+    nearest-neighbor pass, TrendModel.predict_batch, in a worker thread.
+    The event loop keeps reading the next batch meanwhile.
+    """
+
+    def __init__(self, model, k=1, max_batch=MAX_BATCH, max_delay=MAX_DELAY,
+                 history=LATENCY_HISTORY):
+        self.model = model
+        self.model.index()
+        self.k = k
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = None
+        self.batcher_task = None
+
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.latencies = deque(maxlen=history)
+        self.started = time.perf_counter()
+
+    def score(self, trends):
+        """ Predicts each of a list of TrendLines, as JSON-friendly dicts. """
+        results = []
+        predictions = self.model.predict_batch(trends, self.k)
+        for trend, (trending, indices, distances) in zip(trends, predictions):
+            neighbors = [{'name': self.model.trends[int(i)].name,
+                          'trending': self.model.trends[int(i)].trending(),
+                          'distance': float(distance)}
+                         for i, distance in zip(indices, distances)]
+            results.append({'name': trend.name, 'trending': trending,
+                            'neighbors': neighbors})
+        return results
+
+    async def batcher(self):
+        """ Scores queued requests in batches, forever. """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batches += 1
+            trends = [trend for trend, _ in batch]
+            try:
+                results = await loop.run_in_executor(None, self.score,
+                                                     trends)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+
+    async def submit(self, trend):
+        """ Queues a TrendLine for scoring and waits for its prediction. """
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((trend, future))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        result = await future
+        self.latencies.append(time.perf_counter() - started)
+        return result
+
+    async def predict(self, body):
+        """ Answers a /predict request body. """
+        try:
+            obj = json.loads(body)
+        except ValueError:
+            raise BadRequest('The body is not JSON')
+        objs = obj if isinstance(obj, list) else [obj]
+        trends = [TrendLine.from_obj(o) if isinstance(o, dict) else None
+                  for o in objs]
+        if any(trend is None for trend in trends):
+            raise BadRequest('Expected a TrendLine with name, start_ts, '
+                             'window_size and data cells of integer count, '
+                             'delta, delta_delta and trending')
+        self.requests += len(trends)
+        results = await asyncio.gather(*[self.submit(trend)
+                                         for trend in trends])
+        return results if isinstance(obj, list) else results[0]
+
+    async def route(self, method, target, body):
+        """ Returns the status and JSON-friendly answer to a request. """
+        if target == '/predict':
+            if method != 'POST':
+                return 405, {'error': 'Use POST'}
+            try:
+                return 200, await self.predict(body)
+            except BadRequest as e:
+                return 400, {'error': str(e)}
+        if target == '/stats':
+            if method != 'GET':
+                return 405, {'error': 'Use GET'}
+            return 200, self.report()
+        return 404, {'error': 'Unknown path: %s' % target}
+
+    async def handle(self, reader, writer):
+        """ Answers the requests of one connection, keeping it alive. """
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                start, headers, body = message
+                if len(start) != 3:
+                    status, answer = 400, {'error': 'Bad request line'}
+                    close = True
+                else:
+                    method, target, version = start
+                    close = version != 'HTTP/1.1' or \
+                        headers.get('connection', '').lower() == 'close'
+                    try:
+                        status, answer = await self.route(method, target,
+                                                          body)
+                    except Exception as e:
+                        status, answer = 500, {'error': str(e)}
+                if status != 200:
+                    self.errors += 1
+                write_message(writer, 'HTTP/1.1 %d %s' %
+                              (status, REASONS[status]),
+                              json.dumps(answer).encode('utf-8'), close)
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8080, path=None):
+        """ Starts serving on a TCP port, or on a Unix socket at path.
+
+        Returns the asyncio server; the batcher runs until it is closed.
+        """
+        self.queue = asyncio.Queue()
+        self.batcher_task = asyncio.ensure_future(self.batcher())
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path)
+        return await asyncio.start_server(self.handle, host, port)
+
+    def report(self):
+        """ Throughput, latency and queueing figures so far.
+
+        Latency is measured from when a request was queued until its
+        prediction was ready, over the last LATENCY_HISTORY requests.
+        """
+        elapsed = time.perf_counter() - self.started
+        latencies = list(self.latencies)
+        return {'requests': self.requests, 'errors': self.errors,
+                'batches': self.batches,
+                'mean_batch': self.requests / self.batches
+                if self.batches else 0.0,
+                'queue_depth': self.queue.qsize() if self.queue else 0,
+                'max_queue_depth': self.max_queue_depth,
+                'seconds': elapsed,
+                'requests_per_second': self.requests / elapsed
+                if elapsed else 0.0,
+                'latency_p50': percentile(latencies, 50),
+                'latency_p99': percentile(latencies, 99),
+                'latency_max': max(latencies, default=0.0),
+                'weights': TrendCell.weights().tolist()}
+
+
+async def replay(bodies, host='127.0.0.1', port=8080, path=None,
+                 concurrency=16):
+    """ Sends each request body to /predict of a server, as a load test.
+
+    The bodies are shared among concurrency connections, each sending its
+    next request as soon as its last one is answered. Returns the number
+    of requests and errors, the throughput and the latencies seen by the
+    client.
+    """
+    bodies = iter(bodies)
+    latencies = []
+    errors = [0]
+
+    async def client():
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for body in bodies:
+                started = time.perf_counter()
+                write_message(writer, 'POST /predict HTTP/1.1', body)
+                await writer.drain()
+                message = await read_message(reader)
+                if message is None:
+                    raise ConnectionError('The server closed the connection')
+                latencies.append(time.perf_counter() - started)
+                if message[0][1] != '200':
+                    errors[0] += 1
+        finally:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {'requests': len(latencies), 'errors': errors[0],
+            'concurrency': concurrency, 'seconds': elapsed,
+            'requests_per_second': len(latencies) / elapsed
+            if elapsed else 0.0,
+            'latency_p50': percentile(latencies, 50),
+            'latency_p99': percentile(latencies, 99),
+            'latency_max': max(latencies, default=0.0)}
@@ -0,0 +1,117 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import tempfile
+import numpy as np
+from .store import TweetStore
+from .twitter import BagOfWords, tweet_records
+
+
+def line_ranges(path, shards):
+    """ Splits a file into at most shards byte ranges on line boundaries.
+
+    Returns a list of (start, end) offsets that together cover the file,
+    each starting at the beginning of a line.
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for k in range(1, shards):
+            target = size * k // shards
+            if target <= bounds[-1]:
+                continue
+            # Reading from one byte early finishes the line containing
+            # target, or just the newline if target starts a line
+            f.seek(target - 1)
+            f.readline()
+            position = f.tell()
+            if bounds[-1] < position < size:
+                bounds.append(position)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def range_lines(path, start, end):
+    """ Yields the lines of a file that start in a byte range. """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+
+def read_tweet_range(path, start, end):
+    """ Yields (timestamp, words) records for the lines in a byte range. """
+    return tweet_records(range_lines(path, start, end))
+
+
+def _ingest_shard(path, start, end, shard_path, stopwords):
+    store = TweetStore.write(read_tweet_range(path, start, end), shard_path)
+    return BagOfWords.from_store(store, stopwords=stopwords)
+
+
+def _count_shard(shard_path, trends):
+    return TweetStore.open(shard_path).trend_counts(trends)
+
+
+class ShardedTweets:
+    """ A file of Tweets split into shards processed by a pool of workers.
+
+    The file is cut into byte ranges on line boundaries and each worker
+    parses its range once into a TweetStore in a scratch directory, so the
+    second stage of a build (counting trend matches) works from the stores
+    rather than JSON. Each stage returns partial results per shard which are
+    merged in shard order, so the result is identical to processing the
+    file serially. The file must not be compressed, as it is split by byte
+    offsets. Use it as a context manager to clean up the scratch directory.
+    """
+
+    def __init__(self, tweet_file, workers):
+        self.tweet_file = tweet_file
+        self.workers = workers
+        self.ranges = line_ranges(tweet_file, workers)
+        self.scratch = tempfile.TemporaryDirectory(prefix='twittp-shards-')
+        self.shard_paths = [os.path.join(self.scratch.name, str(i))
+                            for i in range(len(self.ranges))]
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.pool.shutdown()
+        self.scratch.cleanup()
+
+    def bag_of_words(self, stopwords=set()):
+        """ Parses every shard and returns the merged BagOfWords.
+
+        Counters are merged in shard order, so words are inserted in the
+        same order of first appearance as BagOfWords.from_file gives.
+        """
+        futures = [self.pool.submit(_ingest_shard, self.tweet_file, start,
+                                    end, shard_path, stopwords)
+                   for (start, end), shard_path in zip(self.ranges,
+                                                       self.shard_paths)]
+        bag_of_words = BagOfWords()
+        for future in futures:
+            bag_of_words.update(future.result())
+        return bag_of_words
+
+    def trend_counts(self, trends):
+        """ Returns the summed per-window counts of each trend over shards.
+
+        bag_of_words must have been called first, as it writes the shards.
+        """
+        futures = [self.pool.submit(_count_shard, shard_path, trends)
+                   for shard_path in self.shard_paths]
+        totals = [np.zeros(len(trend), dtype=np.int64) for trend in trends]
+        for future in futures:
+            for total, counts in zip(totals, future.result()):
+                total += counts
+        return totals
@@ -0,0 +1,261 @@
+from array import array
+import os
+import numpy as np
+import simplejson as json
+from .matching import TrendMatcher
+from .twitter import read_tweets
+from .vocab import Vocabulary, tokenize
+
+
+def append_rows(path, rows, start):
+    """ Writes rows into a one-dimensional .npy file from index start on.
+
+    The file is written in place: the rows go over whatever follows index
+    start, and the shape in the header is rewritten to end after them,
+    which np.save leaves room for. Returns False without writing anything
+    if the file cannot be appended to that way, e.g. if its dtype differs.
+    """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            prefix = f.tell() + 2
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            prefix = f.tell() + 4
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        else:
+            return False
+        data = f.tell()
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype),
+                       'fortran_order': False,
+                       'shape': (start + len(rows),)}).encode('latin-1')
+        room = data - prefix - 1
+        if len(shape) != 1 or fortran or dtype != rows.dtype or \
+                start > shape[0] or len(header) > room:
+            return False
+        f.seek(data + start * dtype.itemsize)
+        f.write(rows.tobytes())
+        f.truncate()
+        f.seek(prefix)
+        f.write(header + b' ' * (room - len(header)) + b'\n')
+    return True
+
+
+class TweetStore:
+    """ A preprocessed, column-oriented copy of a file of Tweets.
+
+    Parsing the raw JSON from the Twitter API is the most expensive part of
+    building a model, so a TweetStore keeps only what twittp uses, laid out
+    so that it can be memory-mapped straight back in. A store is a directory
+    holding:
+
+    - timestamps.npy: the int64 UTC timestamp of every Tweet
+    - tokens.npy: the int32 ids of the words of every Tweet, concatenated
+    - offsets.npy: int64 offsets into tokens; Tweet i has the words
+      tokens[offsets[i]:offsets[i + 1]]
+    - vocab.json: the word for each id, in order of first appearance
+
+    Words are exactly as twittp.vocab.tokenize gives them from the text of
+    the Tweet, so case is kept and matching trends works the same as on the
+    raw file. The vocab attribute is the Vocabulary of the store.
+    """
+    VOCAB_FILE = 'vocab.json'
+
+    def __init__(self, timestamps, tokens, offsets, vocab):
+        self.timestamps = timestamps
+        self.tokens = tokens
+        self.offsets = offsets
+        self.vocab = vocab
+        self.ordered = None
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def records(self):
+        """ Yields (timestamp, words) records like read_tweets does. """
+        decode = self.vocab.decode
+        offsets = self.offsets.tolist()
+        for i, ts in enumerate(self.timestamps.tolist()):
+            yield ts, decode(self.tokens[offsets[i]:offsets[i + 1]].tolist())
+
+    def word_counts(self):
+        """ The number of occurrences of each word id in the store. """
+        return np.bincount(self.tokens, minlength=len(self.vocab))
+
+    def token_ids(self, words):
+        """ Maps words to ids, leaving out words the store has never seen. """
+        return self.vocab.lookup(words)
+
+    def token_hits(self, token_ids, first=0, last=None):
+        """ Finds the occurrences of a set of word ids.
+
+        Returns two parallel arrays: the index of the Tweet for each
+        occurrence and the word id that occurred, ordered by Tweet. This is
+        done over the whole token column at once (or over Tweets first to
+        last), so only the Tweets that contain one of the words need to be
+        looked at individually.
+        """
+        wanted = np.zeros(len(self.vocab), dtype=bool)
+        wanted[list(token_ids)] = True
+        start = int(self.offsets[first])
+        stop = int(self.offsets[len(self) if last is None else last])
+        positions = np.flatnonzero(wanted[self.tokens[start:stop]]) + start
+        tweets = np.searchsorted(self.offsets, positions, side='right') - 1
+        return tweets, self.tokens[positions]
+
+    def trend_counts(self, trends, first=0, last=None):
+        """ Counts the Tweets matching each of a list of TrendLines.
+
+        Matching works on word ids. The occurrences of the words in the trend
+        names are found over the whole store at once, and only the Tweets
+        containing one of them are then matched one by one. Returns per-window
+        counts for each trend as TrendMatcher.new_counts does. Pass first
+        and last to only count the Tweets from index first up to last.
+        """
+        names = [self.token_ids(tokenize(trend.name)) for trend in trends]
+        matcher = TrendMatcher(trends, names=names)
+        counts = matcher.new_counts()
+
+        tweets, tokens = self.token_hits(set().union(*names), first, last)
+        if len(tweets):
+            bounds = np.flatnonzero(np.diff(tweets)) + 1
+            starts = [0] + bounds.tolist()
+            ends = bounds.tolist() + [len(tweets)]
+            tweets = tweets.tolist()
+            tokens = tokens.tolist()
+            timestamps = self.timestamps
+            for start, end in zip(starts, ends):
+                matcher.count(counts, int(timestamps[tweets[start]]),
+                              tokens[start:end])
+        return counts
+
+    def time_range(self, start_ts, end_ts):
+        """ The first and last index of the Tweets that could be posted in
+        [start_ts, end_ts).
+
+        If the Tweets are in time order, this is found by binary search;
+        otherwise it is the whole store. Whether they are is only checked
+        once.
+        """
+        timestamps = self.timestamps
+        if self.ordered is None:
+            self.ordered = bool(np.all(timestamps[1:] >= timestamps[:-1]))
+        if not self.ordered:
+            return 0, len(self)
+        return (int(np.searchsorted(timestamps, start_ts)),
+                int(np.searchsorted(timestamps, end_ts)))
+
+    @staticmethod
+    def is_store(path):
+        """ Indicates whether path is a TweetStore directory. """
+        return os.path.isfile(os.path.join(path, TweetStore.VOCAB_FILE))
+
+    @staticmethod
+    def open(path):
+        """ Opens a TweetStore, memory-mapping its arrays. """
+        with open(os.path.join(path, TweetStore.VOCAB_FILE)) as f:
+            vocab = Vocabulary(json.load(f))
+        timestamps, tokens, offsets = [
+            np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+            for name in ('timestamps', 'tokens', 'offsets')]
+        # Only the Tweets in timestamps are complete; see extend
+        offsets = offsets[:len(timestamps) + 1]
+        tokens = tokens[:int(offsets[-1])]
+        return TweetStore(timestamps, tokens, offsets, vocab=vocab)
+
+    @staticmethod
+    def encode(records, vocab, base=0):
+        """ Encodes (timestamp, words) records into the columns of a store.
+
+        Words are interned into vocab, and offsets start from base, the
+        number of tokens that come before these records. Returns the
+        timestamps, tokens and offsets arrays, where offsets has one entry
+        per record marking its end.
+        """
+        timestamps = array('q')
+        tokens = array('I')
+        offsets = array('q')
+        for ts, words in records:
+            timestamps.append(ts)
+            tokens.extend(vocab.encode(words))
+            offsets.append(base + len(tokens))
+        return (np.array(timestamps, dtype=np.int64),
+                np.frombuffer(tokens, dtype=np.uint32).astype(np.int32),
+                np.array(offsets, dtype=np.int64))
+
+    @staticmethod
+    def save(path, timestamps, tokens, offsets, vocab):
+        """ Writes the arrays and Vocabulary of a store to path. """
+        os.makedirs(path, exist_ok=True)
+        vocab_file = os.path.join(path, TweetStore.VOCAB_FILE)
+        if os.path.exists(vocab_file):
+            os.remove(vocab_file)
+        for name, column in (('timestamps', timestamps), ('tokens', tokens),
+                             ('offsets', offsets)):
+            scratch = os.path.join(path, name + '.tmp.npy')
+            np.save(scratch, column)
+            os.replace(scratch, os.path.join(path, name + '.npy'))
+        # The vocabulary is written last, so a store is only recognized by
+        # is_store once all of its arrays are in place
+        TweetStore.save_vocab(path, vocab)
+
+    @staticmethod
+    def save_vocab(path, vocab):
+        """ Writes the Vocabulary of a store, replacing any old one whole.
+        """
+        scratch = os.path.join(path, TweetStore.VOCAB_FILE + '.tmp')
+        with open(scratch, 'w') as f:
+            json.dump(vocab.words, f, ensure_ascii=False)
+        os.replace(scratch, os.path.join(path, TweetStore.VOCAB_FILE))
+
+    @staticmethod
+    def write(records, path):
+        """ Writes (timestamp, words) records out as a TweetStore at path. """
+        vocab = Vocabulary()
+        timestamps, tokens, offsets = TweetStore.encode(records, vocab)
+        TweetStore.save(path, timestamps, tokens,
+                        np.concatenate(([0], offsets)), vocab)
+        return TweetStore.open(path)
+
+    @staticmethod
+    def extend(records, path):
+        """ Appends (timestamp, words) records to the TweetStore at path.
+
+        New words are interned after the existing ones, so the ids already
+        in the store stay the same. The store is created if there is none
+        at path yet. Returns the reopened store.
+
+        The new rows are written onto the ends of the arrays in place (see
+        append_rows), so this costs as much as the records, not the store.
+        The timestamps go last: until they are in, the new Tweets are not
+        part of the store (see open), so an interrupted append leaves the
+        store as it was.
+        """
+        if not TweetStore.is_store(path):
+            return TweetStore.write(records, path)
+        store = TweetStore.open(path)
+        count = len(store)
+        base = int(store.offsets[-1])
+        words = len(store.vocab)
+        timestamps, tokens, offsets = TweetStore.encode(records, store.vocab,
+                                                        base)
+        columns = (('tokens', tokens, base), ('offsets', offsets, count + 1),
+                   ('timestamps', timestamps, count))
+        for name, rows, start in columns:
+            if name == 'timestamps' and len(store.vocab) > words:
+                TweetStore.save_vocab(path, store.vocab)
+            if not append_rows(os.path.join(path, name + '.npy'), rows,
+                               start):
+                # Rewrite the store if its files cannot be appended to
+                TweetStore.save(path,
+                                np.concatenate((store.timestamps, timestamps)),
+                                np.concatenate((store.tokens, tokens)),
+                                np.concatenate((store.offsets, offsets)),
+                                store.vocab)
+                break
+        return TweetStore.open(path)
+
+    @staticmethod
+    def from_file(tweet_file, path):
+        """ Converts a JSON file of Tweets into a TweetStore at path. """
+        return TweetStore.write(read_tweets(tweet_file), path)
@@ -0,0 +1,334 @@
+from collections import OrderedDict, deque
+from queue import Empty, Queue
+import sys
+import threading
+import time
+import numpy as np
+import simplejson as json
+from .twitter import tweet_timestamp
+from .vocab import tokenize
+
+
+# Seconds without a tweet after which a live stream is checked for windows
+# that have ended; see TrendWatcher.tick
+TICK_SECONDS = 1.0
+
+
+def follow_lines(path, poll_interval=0.5, timeout=None):
+    """ Yields the lines of a file as they are appended to it, like tail -f.
+
+    Lines are only yielded once their newline has been written, and this
+    never returns, so stop it with KeyboardInterrupt. With a timeout, None
+    is yielded whenever that many seconds pass without a new line.
+    """
+    with open(path) as f:
+        partial = ''
+        waited = 0.0
+        while True:
+            line = f.readline()
+            if not line:
+                time.sleep(poll_interval)
+                waited += poll_interval
+                if timeout is not None and waited >= timeout:
+                    waited = 0.0
+                    yield None
+                continue
+            partial += line
+            if partial.endswith('\n'):
+                waited = 0.0
+                yield partial
+                partial = ''
+
+
+def poll_lines(lines, timeout, buffer=1024):
+    """ Yields the lines of an iterable, such as stdin, and None whenever
+    timeout seconds pass without one.
+
+    The lines are read by a thread into a queue of at most buffer lines, so
+    a read that blocks does not hold up the caller. An error raised while
+    reading is raised here once the lines before it have been yielded.
+    """
+    queue = Queue(maxsize=buffer)
+    done = object()
+    errors = []
+
+    def read():
+        try:
+            for line in lines:
+                queue.put(line)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            queue.put(done)
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        try:
+            line = queue.get(timeout=timeout)
+        except Empty:
+            yield None
+            continue
+        if line is done:
+            break
+        yield line
+    if errors:
+        raise errors[0]
+
+
+def percentile(values, q):
+    """ The q-th percentile of a list of values, or 0 if it is empty. """
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+class TopicLine:
+    """ The rolling count, delta and delta_delta windows of one topic.
+
+    Closed windows are kept in a deque of at most history cells, and the
+    current window is just a count, so a matching tweet costs O(1). The
+    delta and delta_delta of a window are worked out when it closes, the
+    same way TrendLine.compute_deltas would over the whole line. window is
+    the number of the current window, counted as in TrendWatcher.windows.
+    """
+
+    def __init__(self, history, window=0):
+        self.cells = deque(maxlen=history)
+        self.closed = 0
+        self.count = 0
+        self.window = window
+
+    def close(self):
+        """ Closes the current window, appending its cell. """
+        if self.closed == 0:
+            delta = 0
+            delta_delta = 0
+        else:
+            last_count, last_delta, _ = self.cells[-1]
+            delta = self.count - last_count
+            delta_delta = 0 if self.closed == 1 else delta - last_delta
+        self.cells.append((self.count, delta, delta_delta))
+        self.closed += 1
+        self.count = 0
+        self.window += 1
+
+    def catch_up(self, window):
+        """ Closes the windows the line missed while idle, up to window.
+
+        After two empty windows every further cell is all zeros, so no more
+        than history + 2 of them are closed however long the line was idle.
+        """
+        missed = window - self.window
+        for _ in range(min(missed, self.cells.maxlen + 2)):
+            self.close()
+        self.window = window
+
+    def features(self):
+        return np.array(self.cells, dtype=np.float64).reshape(-1, 3)
+
+
+class TrendWatcher:
+    """ Scores candidate topics against a TrendModel as tweets stream in.
+
+    Tweets are fed in with add(). A tweet counts towards a candidate topic
+    if one of the words of the topic is in the tweet, as with
+    TrendLine.match_text. When a tweet arrives past the end of the current
+    window, the window is closed and every topic that had a match in it is
+    scored: its recent windows are looked up in the nearest-neighbor index
+    of the model and it is predicted to trend if its nearest trend did.
+    Topics without a match are left alone, and the empty windows they
+    missed are closed the next time they have one, so closing a window
+    costs O(active topics). So that a stream which stalls still gets the
+    predictions of its last window, tick() closes the windows whose end
+    has passed by the wall clock; a tweet arriving late for a window that
+    was closed this way counts towards the current one.
+
+    Candidates are the given topics, or, if there are none, every hashtag
+    seen in the stream. A hashtag that has not been seen for more than
+    history windows is dropped, and starts afresh if it comes back.
+    """
+
+    def __init__(self, model, weights, topics=None, window_size=120,
+                 history=None):
+        self.trends = model.trends
+        self.index = model.index()
+        self.norm = model.norm
+        self.weights = weights
+        self.window_size = window_size
+        self.history = history if history is not None else \
+            max(1, int(self.index.lengths.max(initial=1)))
+
+        self.discover = not topics
+        self.topics = {}
+        self.words = {}
+        # Discovered topics by the last window they had a match in, oldest
+        # first
+        self.last_active = OrderedDict()
+        self.windows = 0
+        for topic in topics or []:
+            self.track(topic)
+
+        self.window_start = None
+        self.active = set()
+        # The timestamp of the latest tweet, and when it arrived by
+        # time.perf_counter
+        self.last_ts = None
+        self.last_arrival = None
+        self.tweets = 0
+        self.predictions = 0
+        self.latencies = []
+        self.started = time.perf_counter()
+
+    def track(self, topic):
+        """ Starts tracking a candidate topic. """
+        if topic in self.topics:
+            return
+        self.topics[topic] = TopicLine(self.history, self.windows)
+        for word in tokenize(topic):
+            self.words.setdefault(word, []).append(topic)
+
+    def forget(self, topic):
+        """ Stops tracking a candidate topic. """
+        del self.topics[topic]
+        for word in tokenize(topic):
+            topics = self.words[word]
+            topics.remove(topic)
+            if not topics:
+                del self.words[word]
+
+    def add(self, ts, words):
+        """ Adds one tweet, returning the predictions of any closed windows.
+        """
+        arrived = time.perf_counter()
+        predictions = []
+        if self.window_start is None:
+            self.window_start = ts - ts % self.window_size
+        while ts >= self.window_start + self.window_size:
+            predictions.extend(self.close_window())
+            self.latencies.append(time.perf_counter() - arrived)
+        if self.last_ts is None or ts >= self.last_ts:
+            self.last_ts = ts
+            self.last_arrival = arrived
+
+        self.tweets += 1
+        matched = set()
+        for word in set(words):
+            if self.discover and word.startswith('#') and len(word) > 1:
+                self.track(word)
+            for topic in self.words.get(word, ()):
+                matched.add(topic)
+        for topic in matched:
+            line = self.topics[topic]
+            line.catch_up(self.windows)
+            line.count += 1
+            if self.discover:
+                self.last_active[topic] = self.windows
+                self.last_active.move_to_end(topic)
+        self.active.update(matched)
+        return predictions
+
+    def close_window(self):
+        """ Closes the current window and scores the active topics. """
+        for topic in self.active:
+            self.topics[topic].close()
+        predictions = [self.score(topic) for topic in sorted(self.active)]
+        for prediction in predictions:
+            prediction['window_start'] = self.window_start
+        self.active = set()
+        self.window_start += self.window_size
+        self.windows += 1
+        self.predictions += len(predictions)
+
+        # Drop the discovered topics that have been idle too long
+        while self.last_active:
+            topic, window = next(iter(self.last_active.items()))
+            if self.windows - window <= self.history:
+                break
+            del self.last_active[topic]
+            self.forget(topic)
+        return predictions
+
+    def tick(self, now=None):
+        """ Closes the windows that have ended while no tweet arrived,
+        returning their predictions.
+
+        The clock of the stream is taken to run on from the latest tweet at
+        the pace of time.perf_counter (or now, a reading of it), so a window
+        ends window_size seconds after its start by the stream clock even if
+        no later tweet comes to close it.
+        """
+        if self.window_start is None:
+            return []
+        if now is None:
+            now = time.perf_counter()
+        predictions = []
+        while True:
+            due = self.last_arrival + \
+                (self.window_start + self.window_size - self.last_ts)
+            if now < due:
+                break
+            predictions.extend(self.close_window())
+            self.latencies.append(max(0.0, time.perf_counter() - due))
+        return predictions
+
+    def flush(self):
+        """ Closes the current window if any tweet is in it, returning its
+        predictions; for the end of the input.
+        """
+        if self.window_start is None or not self.active:
+            return []
+        return self.close_window()
+
+    def score(self, topic):
+        """ Predicts whether a topic will trend from its recent windows. """
+        trending, indices, distances = self.index.predict(
+            self.topics[topic].features(), self.weights, norm=self.norm)
+        return {'topic': topic, 'trending': trending,
+                'match': self.trends[int(indices[0])].name,
+                'distance': float(distances[0])}
+
+    def report(self):
+        """ Throughput and latency figures for the stream so far.
+
+        Latency is measured from the arrival of the tweet that closed a
+        window, or for a window closed by tick() from when it ended, until
+        that window's predictions were ready.
+        """
+        elapsed = time.perf_counter() - self.started
+        return {'tweets': self.tweets, 'windows': self.windows,
+                'topics': len(self.topics), 'predictions': self.predictions,
+                'seconds': elapsed,
+                'tweets_per_second': self.tweets / elapsed if elapsed else 0,
+                'latency_p50': percentile(self.latencies, 50),
+                'latency_p99': percentile(self.latencies, 99),
+                'latency_max': max(self.latencies, default=0.0)}
+
+    def watch(self, lines, out=sys.stdout):
+        """ Feeds lines of tweet JSON through the watcher.
+
+        Predictions are written to out as JSON, one per line, as soon as
+        their window closes, and those of the last window once the lines
+        run out. Lines that are not tweets (e.g. delete notices from the
+        streaming API) are skipped. A None in place of a line, as given by
+        follow_lines and poll_lines with a timeout, means the stream has
+        been quiet for a while, and the windows that have ended since are
+        closed; see tick.
+        """
+        for line in lines:
+            if line is None:
+                self.write(self.tick(), out)
+                continue
+            try:
+                tweet = json.loads(line)
+                ts = tweet_timestamp(tweet['created_at'])
+                words = tokenize(tweet['text'])
+            except (ValueError, KeyError):
+                continue
+            self.write(self.add(ts, words), out)
+        self.write(self.flush(), out)
+
+    @staticmethod
+    def write(predictions, out):
+        """ Writes predictions to out as JSON, one per line. """
+        for prediction in predictions:
+            out.write(json.dumps(prediction, ensure_ascii=False) + '\n')
+        if predictions:
+            out.flush()
@@ -0,0 +1,229 @@
+import itertools
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from .distance import CHUNK_ELEMENTS, length_chunks, pad_features
+from .instrument import NULL_INSTRUMENT
+
+
+# Weight vectors whose best offsets are kept as champions when pruning: an
+# offset at least as costly as a champion in every feature can never be the
+# best one under any weights
+CHAMPION_WEIGHTS = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1],
+                             [1, 1, 0], [1, 0, 1], [0, 1, 1],
+                             [1, 1, 1]], dtype=np.float64).T
+
+# The values tried for each weight by a grid search
+DEFAULT_GRID = (0.0, 0.25, 0.5, 1.0, 2.0, 4.0)
+
+# The factors tried on each weight by a step of coordinate descent
+DEFAULT_FACTORS = (0.0, 0.25, 0.5, 2.0, 4.0)
+
+
+def feature_costs(query, block, lengths):
+    """ The per-feature L1 cost of every alignment of query with each line,
+    in chunks of lines.
+
+    block and lengths are as returned by pad_features. Yields (rows,
+    costs) pairs, where rows are indices into lengths and costs has shape
+    (len(rows), offsets, 3), offsets being the most alignments of any pair
+    in the chunk; alignments a pair does not have are inf. Lines are
+    chunked as in twittp.distance.length_chunks, so each chunk is about
+    CHUNK_ELEMENTS and the costs of all lines are never held at once. As
+    in batch_alignment_distance, the shorter of the two lines is slid
+    along the longer one. If either line is empty, there is one alignment,
+    of cost zero.
+    """
+    query = np.asarray(query, dtype=np.float64)
+    n = len(query)
+    empty = np.flatnonzero((lengths == 0) | (n == 0))
+    if len(empty):
+        yield empty, np.zeros((len(empty), 1, 3), dtype=np.float64)
+    if n == 0:
+        return
+
+    # Lines the query slides along
+    longer = np.flatnonzero(lengths >= n)
+    for rows, width in length_chunks(longer, lengths,
+                                     lambda width: 3 * (width - n + 1) * n,
+                                     n - 1):
+        count = width - n + 1
+        costs = np.zeros((len(rows), count, 3), dtype=np.float64)
+        for f in range(3):
+            windows = sliding_window_view(block[rows, :width, f], n, axis=1)
+            costs[:, :, f] = np.abs(windows - query[:, f]).sum(axis=2)
+        costs[np.arange(count) > (lengths[rows] - n)[:, None]] = np.inf
+        yield rows, costs
+
+    # Lines that slide along the query, grouped by their length
+    shorter = np.flatnonzero((lengths < n) & (lengths > 0))
+    for m in np.unique(lengths[shorter]):
+        count = n - m + 1
+        group = shorter[lengths[shorter] == m]
+        step = max(1, CHUNK_ELEMENTS // (3 * count * m))
+        for lo in range(0, len(group), step):
+            rows = group[lo:lo + step]
+            costs = np.zeros((len(rows), count, 3), dtype=np.float64)
+            for f in range(3):
+                windows = sliding_window_view(query[:, f], m)
+                lines = block[rows, :m, f]
+                costs[:, :, f] = np.abs(windows[None, :, :] -
+                                        lines[:, None, :]).sum(axis=2)
+            yield rows, costs
+
+
+def prune_offsets(costs):
+    """ Marks the alignments of each pair that could ever be its best.
+
+    costs is a chunk of costs as yielded by feature_costs. An alignment is
+    dropped if one of the champions of its pair, the best alignments under
+    the weights of CHAMPION_WEIGHTS, costs no more in every feature (and
+    is either cheaper in one or comes first). Returns a boolean mask of the
+    kept alignments.
+    """
+    finite = np.isfinite(costs[:, :, 0])
+    totals = np.where(finite[:, :, None], costs, 0) @ CHAMPION_WEIGHTS
+    totals[~finite] = np.inf
+    champions = totals.argmin(axis=1)
+    rows = np.arange(len(costs))[:, None]
+    champion_costs = costs[rows, champions]
+
+    keep = finite.copy()
+    offsets = np.arange(costs.shape[1])
+    for c in range(champions.shape[1]):
+        best = champion_costs[:, c][:, None, :]
+        covered = (best <= costs).all(axis=2)
+        better = (best < costs).any(axis=2) | \
+            (champions[:, c][:, None] < offsets)
+        keep &= ~(covered & better)
+    return keep
+
+
+class AlignmentCosts:
+    """ The per-feature alignment costs of every pair of trends in a model.
+
+    For each pair of trends, this keeps the L1 cost of each feature (count,
+    delta and delta_delta) at every alignment that could be the best one
+    under some weights, as float32. The alignment distance under any
+    weights is then a dot product and a minimum over alignments, so trying
+    a weight vector costs a pass over these arrays instead of recomputing
+    every sliding distance. Pairs are in the order of the upper triangle of
+    the distance matrix, row by row, and pair_offsets[p]:pair_offsets[p + 1]
+    gives the rows of costs that belong to pair p.
+    """
+
+    def __init__(self, costs, pair_offsets, labels):
+        self.costs = costs
+        self.pair_offsets = pair_offsets
+        self.labels = np.asarray(labels, dtype=bool)
+        self.rows, self.columns = np.triu_indices(len(self.labels), k=1)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @staticmethod
+    def from_trends(trends, instrument=None):
+        """ Computes the alignment costs of every pair of a list of trends.
+        """
+        if instrument is None:
+            instrument = NULL_INSTRUMENT
+        block, lengths = pad_features(trends)
+        chunks = []
+        counts = []
+        for i in instrument.track('alignment_costs', range(len(trends)),
+                                  len(trends)):
+            row_chunks = []
+            row_counts = np.zeros(len(trends) - i - 1, dtype=np.int64)
+            order = []
+            for rows, costs in feature_costs(block[i, :lengths[i]],
+                                             block[i + 1:], lengths[i + 1:]):
+                keep = prune_offsets(costs)
+                row_chunks.append(costs[keep].astype(np.float32))
+                row_counts[rows] = keep.sum(axis=1)
+                order.append(np.repeat(rows, row_counts[rows]))
+            if row_chunks:
+                # Put the kept alignments in the order of the other trends
+                order = np.argsort(np.concatenate(order), kind='stable')
+                chunks.append(np.concatenate(row_chunks)[order])
+            counts.append(row_counts)
+        counts = np.concatenate(counts + [np.zeros(0, dtype=np.int64)])
+        pair_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=pair_offsets[1:])
+        costs = np.concatenate(chunks + [np.zeros((0, 3), dtype=np.float32)])
+        instrument.set('alignment_costs_bytes', costs.nbytes)
+        return AlignmentCosts(costs, pair_offsets,
+                              [trend.trending() for trend in trends])
+
+    def distances(self, weights):
+        """ The distance matrix of the trends under the given weights. """
+        weights = np.asarray(weights, dtype=np.float64)
+        distances = np.zeros((len(self), len(self)), dtype=np.float64)
+        if len(self.rows):
+            pair_distances = np.minimum.reduceat(self.costs @ weights,
+                                                 self.pair_offsets[:-1])
+            distances[self.rows, self.columns] = pair_distances
+            distances[self.columns, self.rows] = pair_distances
+        return distances
+
+    def accuracy(self, weights):
+        """ The leave-one-out accuracy of the model under the given weights.
+
+        As in TrendModel.leave_one_out, each trend is matched with its
+        nearest other trend, the first one on a tie.
+        """
+        if len(self) < 2:
+            return 0.0
+        distances = self.distances(weights)
+        np.fill_diagonal(distances, np.inf)
+        nearest = distances.argmin(axis=1)
+        return float((self.labels[nearest] == self.labels).mean())
+
+    def grid_search(self, grid=DEFAULT_GRID, instrument=None):
+        """ Tries every combination of grid values as the three weights.
+
+        Returns (accuracy, weights) for the best combination, the first one
+        tried on a tie. Combinations of all zeros are skipped.
+        """
+        if instrument is None:
+            instrument = NULL_INSTRUMENT
+        candidates = [weights for weights in itertools.product(grid, repeat=3)
+                      if any(weights)]
+        best = None
+        for weights in instrument.track('grid_search', candidates,
+                                        len(candidates)):
+            accuracy = self.accuracy(weights)
+            if best is None or accuracy > best[0]:
+                best = (accuracy, [float(weight) for weight in weights])
+        return best
+
+    def coordinate_descent(self, weights=(1.0, 1.0, 1.0),
+                           factors=DEFAULT_FACTORS, rounds=10,
+                           instrument=None):
+        """ Improves the weights one at a time, starting from weights.
+
+        In each round every weight is multiplied by each of the factors in
+        turn (a zero weight is set to each factor instead), keeping any
+        change that improves the accuracy, until a round makes no
+        improvement or rounds run out. Returns (accuracy, weights).
+        """
+        if instrument is None:
+            instrument = NULL_INSTRUMENT
+        weights = [float(weight) for weight in weights]
+        accuracy = self.accuracy(weights)
+        for _ in range(rounds):
+            improved = False
+            for f in range(3):
+                for factor in factors:
+                    candidate = list(weights)
+                    candidate[f] = weights[f] * factor if weights[f] else \
+                        factor
+                    if not any(candidate) or candidate == weights:
+                        continue
+                    instrument.count('weights_tried')
+                    score = self.accuracy(candidate)
+                    if score > accuracy:
+                        accuracy = score
+                        weights = candidate
+                        improved = True
+            if not improved:
+                break
+        return accuracy, weights
@@ -1,10 +1,65 @@
-from bisect import bisect
+from array import array
 import calendar
 from collections import Counter
 import datetime as dt
+from functools import lru_cache
+import numpy as np
 import random
-import re
 import simplejson as json
+from .inputs import read_lines
+from .vocab import WORD_RE, tokenize
+
+
+MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+          'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
+
+@lru_cache(maxsize=4096)
+def _day_timestamp(year, month, day):
+    return calendar.timegm((int(year), MONTHS[month], int(day), 0, 0, 0))
+
+
+def tweet_timestamp(created_at):
+    """ Converts the created_at field of a Tweet to a UTC timestamp.
+
+    The Twitter API formats these like "Wed Aug 27 13:08:45 +0000 2008".
+    This gives the same result as parsing with datetime.strptime, but the
+    date part is only converted once per day seen rather than per Tweet.
+    """
+    _, month, day, clock, offset, year = created_at.split()
+    hours, minutes, seconds = clock.split(':')
+    ts = _day_timestamp(year, month, day) + int(hours) * 3600 + \
+        int(minutes) * 60 + int(seconds)
+    offset_seconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+    if offset[0] == '-':
+        return ts + offset_seconds
+    return ts - offset_seconds
+
+
+def read_tweets(json_file, vocab=None):
+    """ Yields a compact (timestamp, words) record for each Tweet in a file.
+
+    The file has one Tweet per line encoded in JSON as the Twitter API does.
+    This is the one place Tweets are decoded, so a build can parse a file
+    once and hand the records to both BagOfWords and TrendLine population.
+    Given a Vocabulary, the words are interned and each record holds an
+    array('I') of their ids instead of a list of strings. The file may be
+    compressed; see twittp.inputs.
+    """
+    return tweet_records(read_lines(json_file), vocab)
+
+
+def tweet_records(lines, vocab=None):
+    """ Yields a (timestamp, words) record for each line of Tweet JSON.
+
+    This does the decoding for read_tweets, and for readers of other
+    sources of lines, such as a byte range or the tail of a file.
+    """
+    for line in lines:
+        tweet = json.loads(line)
+        words = tokenize(tweet['text'])
+        yield (tweet_timestamp(tweet['created_at']),
+               words if vocab is None else vocab.encode(words))
 
 
 class TwitterTrend:
@@ -17,70 +72,154 @@ class TwitterTrend:
     this to model the output from the Twitter API's trending endpoint.
     """
 
-    def __init__(self, name, timestamps=None, window_size=120):
+    def __init__(self, name, timestamps=None, window_size=120,
+                 intervals=None):
         """ Constructor for TwitterTrend with or without timestamps.
 
         If no timestamps are provided, it is assumed that they will be filled
-        in at a later time and timestamps is initialized to an empty list. Name
-        should be the name of the trend as in the JSON file retrieved from the
-        Twitter API. The window_size should almost never be changed, but it is
-        the number of seconds between trend windows, aka, it represents how
-        granular our trends are.
+        in at a later time with add_windows, and the trend starts with none.
+        Name should be the name of the trend as in the JSON file retrieved
+        from the Twitter API. The window_size should almost never be changed,
+        but it is the number of seconds between trend windows, aka, it
+        represents how granular our trends are.
+
+        The windows are stored run-length encoded in intervals, a list of
+        [start, length] pairs: length consecutive windows starting at the
+        timestamp start. These can be given directly instead of timestamps.
         """
         self.name = name
-        self.timestamps = [] if timestamps is None else timestamps
         self.window_size = window_size
+        self.intervals = [] if intervals is None else intervals
+        if timestamps is not None:
+            self.timestamps = timestamps
+
+    @property
+    def timestamps(self):
+        """ The timestamp of every window the trend was trending in.
+
+        This is worked out from intervals, so it is a tuple: add windows
+        with add_windows, or assign a new list of timestamps.
+        """
+        return tuple(start + i * self.window_size
+                     for start, length in self.intervals
+                     for i in range(length))
+
+    @timestamps.setter
+    def timestamps(self, timestamps):
+        self.intervals = []
+        for ts in timestamps:
+            self.add_windows(ts, 1)
+
+    def add_windows(self, start, count):
+        """ Marks count windows from start as trending.
+
+        Windows are expected in time order. If they carry on directly from
+        the last interval, that interval is extended instead of starting a
+        new one.
+        """
+        if self.intervals:
+            last = self.intervals[-1]
+            if last[0] + last[1] * self.window_size == start:
+                last[1] += count
+                return
+        self.intervals.append([start, count])
+
+    def longest_interval(self):
+        """ The (start, length) of the longest run of trending windows.
+
+        The earliest run wins a tie. Returns (None, 0) if there are none.
+        """
+        longest = (None, 0)
+        for start, length in self.intervals:
+            if length > longest[1]:
+                longest = (start, length)
+        return longest
 
     @staticmethod
     def from_file(json_file):
-        """ Read a trends from a file using the from_twitter_json method. """
-        lines = []
-        with open(json_file) as f:
-            for line in f:
-                lines.append(line)
-        return TwitterTrend.from_json_strings(lines)
+        """ Read a trends from a file using the from_twitter_json method.
+
+        The file is streamed through one line at a time, and may be
+        compressed; see twittp.inputs.read_lines.
+        """
+        return TwitterTrend.from_json_strings(read_lines(json_file))
 
     @staticmethod
     def from_json_strings(json_strings):
-        """ Constructs a list of TwitterTrends from a list of json strings.
+        """ Constructs a list of TwitterTrends from json strings.
 
-        This json_strings argument is expected to be a list of JSON strings,
-        each of which is the return value from the Twitter API's trends
-        endpoint at a particular time.
+        This json_strings argument is expected to be an iterable of JSON
+        strings, each of which is the return value from the Twitter API's
+        trends endpoint at a particular time. They are consumed one at a
+        time by a TrendReader.
         """
-        trends_timestamps = {}
-        last_ts = 0
+        reader = TrendReader()
+        reader.feed(json_strings)
+        return reader.twitter_trends()
+
+
+class TrendReader:
+    """ Builds TwitterTrends from trends endpoint responses as they come.
+
+    Every topic of a response is marked as trending for each window since
+    the previous response. The reader keeps the trends seen so far and the
+    end of the last window, so responses can be fed in over several calls,
+    e.g. as they are appended to a file, and its state can be saved with
+    to_obj and restored with from_obj.
+    """
+
+    def __init__(self, window_size=120):
+        self.window_size = window_size
+        self.trends = {}
+        self.last_ts = 0
+
+    def feed(self, json_strings):
+        """ Reads the responses in an iterable of JSON strings. """
+        window_size = self.window_size
+        trends = self.trends
         for json_s in json_strings:
             json_obj = json.loads(json_s)
             if json_obj.get('as_of') is None:
                 continue
             jdt = dt.datetime.strptime(json_obj['as_of'], '%Y-%m-%dT%H:%M:%SZ')
-
-            # Reduce jdt to the nearest 2-minute window, rounded down
-            minutes = jdt.minute
-            minutes = minutes - (minutes % 2)  # If odd, reduce to even
-            jdt.replace(minute=minutes, second=0, microsecond=0)
-
             ts = calendar.timegm(jdt.utctimetuple())
 
-            if last_ts == 0:
-                last_ts = ts - (ts % 120)
+            if self.last_ts == 0:
+                self.last_ts = ts - (ts % window_size)
 
-            while ts > last_ts:
+            if ts > self.last_ts:
+                windows = -(-(ts - self.last_ts) // window_size)
+                names = set()
                 for topic in json_obj['trends']:
-                    if trends_timestamps.get(topic['name']) is None:
-                        trends_timestamps[topic['name']] = []
-                        trends_timestamps[topic['name']].append(last_ts)
-                    else:
-                        trends_timestamps[topic['name']].append(last_ts)
-                last_ts += 120
+                    name = topic['name']
+                    if name in names:
+                        continue
+                    names.add(name)
+                    trend = trends.get(name)
+                    if trend is None:
+                        trend = trends[name] = TwitterTrend(
+                            name, window_size=window_size)
+                    trend.add_windows(self.last_ts, windows)
+                self.last_ts += windows * window_size
 
-        trends = []
-        for trend, timestamps in trends_timestamps.items():
-            twitter_trend = TwitterTrend(trend, timestamps=timestamps)
-            trends.append(twitter_trend)
+    def twitter_trends(self):
+        """ The TwitterTrends read so far, in order of first appearance. """
+        return list(self.trends.values())
 
-        return trends
+    def to_obj(self):
+        """ Returns a JSON-friendly dict of the state of the reader. """
+        return {'window_size': self.window_size, 'last_ts': self.last_ts,
+                'trends': [[trend.name, trend.intervals]
+                           for trend in self.trends.values()]}
+
+    @staticmethod
+    def from_obj(obj):
+        reader = TrendReader(obj['window_size'])
+        reader.last_ts = obj['last_ts']
+        for name, intervals in obj['trends']:
+            reader.trends[name] = TwitterTrend(
+                name, window_size=reader.window_size, intervals=intervals)
+        return reader
 
 
 class BagOfWords(Counter):
@@ -92,35 +231,50 @@ class BagOfWords(Counter):
     important thing to understand is how words are read from a Tweet. A word is
     something that matches the word_re regex and is flanked by whitespace.
     """
-    word_re = re.compile("#?\w\w+\Z")
-
-    def random_trend_names(self, positive_trends, n=1):
-        """ Creates n unique topics that don't match any positive topics. """
-        total = 0
-        words = []
-        weights = []
-        for word, weight in self.items():
-            total += weight
-            weights.append(total)
-            words.append(word)
-
-        positive_names = set([trend.name for trend in positive_trends])
-        negative_names = []
+    word_re = WORD_RE
 
-        for _ in range(n):
-            name_words = []
+    def sampler(self):
+        """ Returns a WordSampler for the current counts of the model.
+
+        The sampler does not follow later changes to the counts. Build it
+        once and pass it to every random_trend_names call that should draw
+        from the same counts.
+        """
+        return WordSampler(list(self.keys()), list(self.values()))
 
-            while True:
-                name_words = []
-                for j in range(random.randint(1, 3)):
-                    i = random.randrange(total)
-                    x = bisect(weights, i)
-                    name_words.append(words[x - 1])
+    def random_trend_names(self, positive_trends, n=1, sampler=None):
+        """ Creates n unique topics that don't match any positive topics.
 
-                if ' '.join(name_words) not in positive_names or negative_names:
-                    break
+        Each name is one to three words drawn according to their counts.
+        Candidates are drawn in batches, and any that repeat a positive
+        trend or a name already drawn are thrown away. The draws are seeded
+        from the random module, so random.seed makes them reproducible.
+        Words are drawn from sampler, as returned by sampler(); by default
+        one is built for the current counts.
+        """
+        if sampler is None:
+            sampler = self.sampler()
+        rng = np.random.default_rng(random.getrandbits(64))
+        taken = set([trend.name for trend in positive_trends])
+        negative_names = []
 
-            negative_names.append(' '.join(name_words))
+        fruitless = 0
+        while len(negative_names) < n:
+            batch = 2 * (n - len(negative_names)) + 16
+            lengths = rng.integers(1, 4, size=batch)
+            words = sampler.sample(rng, (batch, 3))
+            before = len(negative_names)
+            for length, row in zip(lengths.tolist(), words.tolist()):
+                name = ' '.join(row[:length])
+                if name not in taken:
+                    taken.add(name)
+                    negative_names.append(name)
+                    if len(negative_names) == n:
+                        break
+            fruitless = fruitless + 1 if len(negative_names) == before else 0
+            if fruitless >= 10:
+                raise ValueError('Cannot draw %d unique trend names from a '
+                                 'vocabulary of %d words' % (n, len(self)))
         return negative_names
 
     @staticmethod
@@ -132,23 +286,96 @@ class BagOfWords(Counter):
         is required for model creation is just the 'text' field of the objects,
         so other fields can be dropped for bag of words model creation. The
         stopwords argument is a set containing the words to ignore when
-        constructing the model.
+        constructing the model. The file may be compressed.
         """
         bag_of_words = BagOfWords()
-        with open(json_file) as f:
-            for line in f:
-                tweet = json.loads(line)
-                words = tweet['text'].split()
-                for word in words:
-                    word = word.lower()
-                    if word in stopwords:
-                        continue
-                    elif BagOfWords.word_re.match(word) is None:
-                        continue
-                    else:
-                        bag_of_words[word] += 1
+        for line in read_lines(json_file):
+            tweet = json.loads(line)
+            bag_of_words.add_words(tokenize(tweet['text']), stopwords)
+        return bag_of_words
+
+    @staticmethod
+    def from_records(records, stopwords=set(), vocab=None):
+        """ Creates a word model from (timestamp, words) records.
+
+        The records are as yielded by read_tweets, which lets a build share
+        one parse of the tweet file with TrendLine.populate_from_records. If
+        they were read with a Vocabulary, pass it as vocab; the ids are then
+        counted and each distinct word is only filtered once.
+        """
+        if vocab is not None:
+            tokens = array('I')
+            for _, ids in records:
+                tokens.extend(ids)
+            counts = np.bincount(np.frombuffer(tokens, dtype=np.uint32),
+                                 minlength=len(vocab))
+            return BagOfWords.from_token_counts(vocab, counts, stopwords)
+
+        bag_of_words = BagOfWords()
+        for _, words in records:
+            bag_of_words.add_words(words, stopwords)
+        return bag_of_words
+
+    @staticmethod
+    def from_store(store, stopwords=set()):
+        """ Creates a word model from a TweetStore without decoding Tweets.
+
+        See from_token_counts; the result is the same as from_file on the
+        original JSON.
+        """
+        return BagOfWords.from_token_counts(store.vocab, store.word_counts(),
+                                            stopwords)
+
+    @staticmethod
+    def from_token_counts(vocab, counts, stopwords=set()):
+        """ Creates a word model from the number of occurrences of each id.
+
+        The lowercasing and filtering is done once per distinct word of the
+        Vocabulary. Words are added in order of first appearance, so the
+        result is the same as counting the Tweets one word at a time.
+        """
+        bag_of_words = BagOfWords()
+        words = vocab.bag_words()
+        ignored = vocab.stopword_ids(stopwords)
+        for token in np.flatnonzero(counts).tolist():
+            word = words[token]
+            if word is None or token in ignored:
+                continue
+            bag_of_words[word] += int(counts[token])
         return bag_of_words
 
+    def add_words(self, words, stopwords=set()):
+        """ Counts the words of a single Tweet into the model. """
+        for word in words:
+            word = word.lower()
+            if word in stopwords:
+                continue
+            elif BagOfWords.word_re.match(word) is None:
+                continue
+            else:
+                self[word] += 1
+
+
+class WordSampler:
+    """ Draws words at random with probability proportional to their counts.
+
+    The cumulative counts are kept in a NumPy array so that any number of
+    words can be drawn at once with a single searchsorted.
+    """
+
+    def __init__(self, words, counts):
+        self.words = np.array(words, dtype=object)
+        self.cumulative = np.cumsum(np.asarray(counts, dtype=np.int64))
+        self.total = int(self.cumulative[-1]) if len(self.cumulative) else 0
+
+    def sample(self, rng, size):
+        """ Draws an array of words of the given shape using rng. """
+        if self.total == 0:
+            raise ValueError('Cannot sample from an empty bag of words')
+        draws = rng.integers(0, self.total, size=size)
+        return self.words[np.searchsorted(self.cumulative, draws,
+                                          side='right')]
+
 
 class Stopwords(set):
     """ This class represents a set of words to ignore constructing a model.
@@ -159,10 +386,14 @@ class Stopwords(set):
 
     @staticmethod
     def from_csv(stopwords_file):
-        """ Load stopwords from a CSV file. """
+        """ Load stopwords from a CSV file.
+
+        Fields are stripped of surrounding whitespace (including the newline
+        ending each line), and empty fields are skipped. The file may be
+        compressed.
+        """
         sw = Stopwords()
-        with open(stopwords_file) as f:
-            for line in f:
-                words = line.split(",")
-                sw.update(words)
+        for line in read_lines(stopwords_file):
+            words = (word.strip() for word in line.decode('utf-8').split(","))
+            sw.update(word for word in words if word)
         return sw
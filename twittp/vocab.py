@@ -0,0 +1,98 @@
+from array import array
+import re
+
+
+# What counts as a word for the bag-of-words model, after lowercasing
+WORD_RE = re.compile(r"#?\w\w+\Z")
+
+
+def tokenize(text):
+    """ Splits the text of a Tweet or a trend name into tokens.
+
+    Tokens are exactly as str.split() gives them, so case is kept and a
+    trend matches a Tweet only if one of its words appears in it verbatim.
+    """
+    return text.split()
+
+
+class Vocabulary:
+    """ Interns tokens to small integer ids.
+
+    Ids are handed out in order of first appearance, so encoding the same
+    Tweets in the same order always gives the same ids. Each Tweet is then
+    an array('I') of ids instead of a list of strings, and trend names and
+    stopwords are resolved to ids once, so that counting and matching are
+    integer lookups.
+
+    The bag-of-words form of every token (lowercased, and None unless it
+    matches WORD_RE) is also worked out once per distinct token rather than
+    once per occurrence; see bag_words.
+    """
+
+    def __init__(self, words=()):
+        self.words = []
+        self.ids = {}
+        self.normalized = []
+        for word in words:
+            self.intern(word)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, token):
+        return self.words[token]
+
+    def __contains__(self, word):
+        return word in self.ids
+
+    def intern(self, word):
+        """ Returns the id of word, giving it the next id if it is new. """
+        token = self.ids.get(word)
+        if token is None:
+            token = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return token
+
+    def encode(self, words):
+        """ Interns a sequence of tokens, returning their ids as array('I').
+        """
+        ids = self.ids
+        encoded = array('I')
+        for word in words:
+            token = ids.get(word)
+            if token is None:
+                token = self.intern(word)
+            encoded.append(token)
+        return encoded
+
+    def encode_text(self, text):
+        """ Tokenizes and interns a piece of text. """
+        return self.encode(tokenize(text))
+
+    def lookup(self, words):
+        """ Maps tokens to ids, leaving out any that have never been seen. """
+        ids = self.ids
+        return [ids[word] for word in words if word in ids]
+
+    def decode(self, tokens):
+        """ Maps ids back to their tokens. """
+        words = self.words
+        return [words[token] for token in tokens]
+
+    def bag_words(self):
+        """ The bag-of-words form of each token, indexed by id.
+
+        This is the lowercased token if it matches WORD_RE, or None if the
+        bag-of-words model ignores it. Forms are only worked out for tokens
+        interned since the last call.
+        """
+        normalized = self.normalized
+        for word in self.words[len(normalized):]:
+            word = word.lower()
+            normalized.append(word if WORD_RE.match(word) else None)
+        return normalized
+
+    def stopword_ids(self, stopwords):
+        """ The ids of tokens whose bag-of-words form is a stopword. """
+        return set(token for token, word in enumerate(self.bag_words())
+                   if word is not None and word in stopwords)